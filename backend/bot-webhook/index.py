@@ -1,27 +1,1446 @@
+import atexit
+import bisect
+import cProfile
+import functools
+import hashlib
+import io
 import json
 import os
+import pstats
+import queue
+import random
+import re
+import threading
 import time
-from datetime import datetime
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from typing import Dict, Any
 import psycopg2
-from psycopg2.extras import RealDictCursor, Json
+import psycopg2.errors
+import psycopg2.pool
+from psycopg2.extras import RealDictCursor, Json, execute_values
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_POOL_CHECK_IDLE = float(os.environ.get('DB_POOL_CHECK_IDLE', '30'))
+STATEMENT_PREPARED_MAX = int(os.environ.get('STATEMENT_PREPARED_MAX', '64'))
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+METRICS_FUNCTION = 'bot-webhook'
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '60'))
+PROFILE_TOP = int(os.environ.get('PROFILE_TOP', '40'))
+WEBHOOK_INGEST_MODE = os.environ.get('WEBHOOK_INGEST_MODE', 'single')
+WEBHOOK_SPOOL_DIR = os.environ.get('WEBHOOK_SPOOL_DIR', '/tmp/bot-webhook-spool')
+WEBHOOK_FLUSH_MS = int(os.environ.get('WEBHOOK_FLUSH_MS', '500'))
+WEBHOOK_FLUSH_RECORDS = int(os.environ.get('WEBHOOK_FLUSH_RECORDS', '200'))
+WEBHOOK_SPOOL_SPLIT_ATTEMPTS = int(os.environ.get('WEBHOOK_SPOOL_SPLIT_ATTEMPTS', '3'))
+# Окно дедупликации повторов: ключи ingest_keys старше удаляются при сбросе spool не чаще раза в INGEST_KEYS_PRUNE_SECONDS
+INGEST_KEYS_TTL_HOURS = int(os.environ.get('INGEST_KEYS_TTL_HOURS', '168'))
+INGEST_KEYS_PRUNE_SECONDS = int(os.environ.get('INGEST_KEYS_PRUNE_SECONDS', '3600'))
+INGEST_KEYS_PRUNE_LIMIT = int(os.environ.get('INGEST_KEYS_PRUNE_LIMIT', '10000'))
+SESSION_GAP_MINUTES = int(os.environ.get('SESSION_GAP_MINUTES', '30'))
+PROJECTOR_NAME = 'read_models'
+PROJECTOR_BATCH_SIZE = int(os.environ.get('PROJECTOR_BATCH_SIZE', '1000'))
+PROJECTOR_MAX_BATCHES = int(os.environ.get('PROJECTOR_MAX_BATCHES', '10'))
+PROJECTOR_SETTLE_SECONDS = float(os.environ.get('PROJECTOR_SETTLE_SECONDS', '5'))
+PROJECTOR_REBUILD_KEY = os.environ.get('PROJECTOR_REBUILD_KEY')
+EVENT_QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', '1000'))
+EVENT_BATCH_SIZE = int(os.environ.get('EVENT_BATCH_SIZE', '200'))
+EVENT_FLUSH_MS = int(os.environ.get('EVENT_FLUSH_MS', '1000'))
+EVENT_SAMPLE_RATES = json.loads(os.environ.get('EVENT_SAMPLE_RATES', '{}'))
+WEBHOOK_QUEUE_TIMEOUT = float(os.environ.get('WEBHOOK_QUEUE_TIMEOUT', '2'))
+# -1 — доля WEBHOOK_DB_CONNECTIONS_SHARE от max_connections сервера, 0 — без лимита
+WEBHOOK_DB_CONNECTIONS_MAX = int(os.environ.get('WEBHOOK_DB_CONNECTIONS_MAX', '-1'))
+WEBHOOK_DB_CONNECTIONS_SHARE = float(os.environ.get('WEBHOOK_DB_CONNECTIONS_SHARE', '0.25'))
+WEBHOOK_DB_BUDGET_TTL = float(os.environ.get('WEBHOOK_DB_BUDGET_TTL', '5'))
+WEBHOOK_BACKGROUND_TIMEOUT = float(os.environ.get('WEBHOOK_BACKGROUND_TIMEOUT', '10'))
+ADMISSION_LOG_INTERVAL = 1.0
+ADMISSION_YIELD_POLL = 0.05
+
+# Полосы допуска делят пул: ingest (POST в режимах single/legacy/events), control (GET ?action=project|rebuild)
+# и background — фоновые записи (event_logs, сброс spool, проектор по таймеру, гистограммы латентности).
+# background уступает ingest: пока в очереди ingest есть запросы, фоновые записи ждут
+ADMISSION_LANES = {
+    'ingest': {
+        'limit': int(os.environ.get('WEBHOOK_MAX_CONCURRENT', str(max(1, DB_POOL_SIZE - 2)))),
+        'queue': int(os.environ.get('WEBHOOK_MAX_QUEUE', '16')),
+        'timeout': WEBHOOK_QUEUE_TIMEOUT
+    },
+    'control': {'limit': 1, 'queue': 2, 'timeout': WEBHOOK_QUEUE_TIMEOUT},
+    'background': {'limit': 1, 'queue': 8, 'timeout': WEBHOOK_BACKGROUND_TIMEOUT, 'yields_to': 'ingest'}
+}
+
+_pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+_pool_lock = threading.Lock()
+_pool_idle = []
+pool_stats = {'acquired': 0, 'created': 0, 'reconnects': 0, 'timeouts': 0, 'wait_ms_total': 0.0, 'wait_ms_max': 0.0}
+_budget_lock = threading.Lock()
+_budget = {'limit': None, 'connections': 0, 'opened': 0, 'checked_at': 0.0}
+
+_trace = threading.local()
+_latency_lock = threading.Lock()
+_latency_flush = {'at': time.monotonic()}
+_latency_pending = {}
+latency_stats = {}
+_profile_lock = threading.Lock()
+
+_statement_sql = {}
+_PLACEHOLDER_RE = re.compile(r'%\((\w+)\)s|%s')
+
+_spool_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_spool_state = {'pending': 0, 'first_at': None, 'pruned_at': None}
+_spool_retries = {}
+_spool_schedule_lock = threading.Lock()
+_spool_timer = {'timer': None, 'due': None}
+
+_event_queue = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+_event_lock = threading.Lock()
+_event_flusher = None
+event_stats = {'enqueued': 0, 'sampled_out': 0, 'dropped': 0, 'written': 0, 'failed': 0}
+
+_projector_lock = threading.Lock()
+_projector_schedule_lock = threading.Lock()
+_projector_state = {'timer': None}
+projector_stats = {'runs': 0, 'projected': 0, 'failed': 0, 'quarantined': 0, 'rebuilds': 0}
+
+_admission = {lane: {'cond': threading.Condition(), 'in_flight': 0, 'waiting': 0, 'service_ms': 100.0, 'logged_at': 0.0} for lane in ADMISSION_LANES}
+admission_stats = {
+    lane: {'admitted': 0, 'queued': 0, 'max_waiting': 0, 'rejected_queue_full': 0, 'rejected_timeout': 0, 'rejected_db': 0, 'wait_ms_total': 0.0}
+    for lane in ADMISSION_LANES
+}
+
+def _connection_alive(conn, idle_seconds):
+    '''Проверяет соединение из пула перед выдачей (SELECT 1 после долгого простоя)'''
+    if conn.closed:
+        return False
+    if idle_seconds < DB_POOL_CHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+class PreparedConnection(psycopg2.extensions.connection):
+    '''Соединение пула, которое помнит свои серверные prepared statements'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+def _check_connection_budget(conn):
+    '''
+    Общий для всех экземпляров лимит соединений bot-webhook: по умолчанию четверть max_connections сервера,
+    остальное остаётся читающим функциям дашборда. Проверяется только при открытии нового соединения, а подсчёт
+    по pg_stat_activity кэшируется на WEBHOOK_DB_BUDGET_TTL: пока оценка (последний подсчёт плюс открытые
+    с тех пор) ниже лимита, лишнего запроса нет. Сверх лимита соединение закрывается и поднимается PoolError.
+    '''
+    if WEBHOOK_DB_CONNECTIONS_MAX == 0:
+        return
+    with _budget_lock:
+        fresh = time.monotonic() - _budget['checked_at'] < WEBHOOK_DB_BUDGET_TTL
+        if fresh and _budget['limit'] is not None and _budget['connections'] + _budget['opened'] < _budget['limit']:
+            _budget['opened'] += 1
+            return
+    
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT COUNT(*) FILTER (WHERE application_name = %s), current_setting('max_connections')::int FROM pg_stat_activity",
+            (METRICS_FUNCTION,)
+        )
+        connections, max_connections = cur.fetchone()
+    conn.rollback()
+    limit = WEBHOOK_DB_CONNECTIONS_MAX if WEBHOOK_DB_CONNECTIONS_MAX > 0 else max(1, int(max_connections * WEBHOOK_DB_CONNECTIONS_SHARE))
+    with _budget_lock:
+        _budget.update(limit=limit, connections=connections, opened=0, checked_at=time.monotonic())
+    if connections > limit:
+        _close_quietly(conn)
+        raise psycopg2.pool.PoolError(METRICS_FUNCTION + ' holds ' + str(connections) + ' connections, budget is ' + str(limit))
 
 def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
-
-def log_event(cur, user_id, event_type, event_data, response_time_ms=None, success=True, error_message=None):
-    '''Логирует событие в таблицу event_logs'''
-    cur.execute(
-        "INSERT INTO event_logs (user_id, event_type, event_data, response_time_ms, success, error_message) VALUES (" + 
-        str(user_id) + ", '" + event_type + "', '" + json.dumps(event_data).replace("'", "''") + "', " + 
-        (str(response_time_ms) if response_time_ms else 'NULL') + ", " + str(success) + ", " + 
-        ("'" + error_message.replace("'", "''") + "'" if error_message else 'NULL') + ")"
+    '''Берёт соединение из тёплого пула модуля, который переживает вызовы функции'''
+    wait_start = time.perf_counter()
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        with _pool_lock:
+            pool_stats['timeouts'] += 1
+        raise psycopg2.pool.PoolError('Connection pool exhausted after ' + str(DB_POOL_TIMEOUT) + 's')
+    wait_ms = (time.perf_counter() - wait_start) * 1000
+    
+    conn = None
+    while conn is None:
+        with _pool_lock:
+            idle = _pool_idle.pop() if _pool_idle else None
+        if idle is None:
+            break
+        candidate, released_at = idle
+        if _connection_alive(candidate, time.monotonic() - released_at):
+            conn = candidate
+        else:
+            with _pool_lock:
+                pool_stats['reconnects'] += 1
+            _close_quietly(candidate)
+    
+    if conn is None:
+        try:
+            conn = psycopg2.connect(os.environ['DATABASE_URL'], connection_factory=PreparedConnection, application_name=METRICS_FUNCTION)
+            _check_connection_budget(conn)
+        except psycopg2.OperationalError as error:
+            _pool_slots.release()
+            raise psycopg2.pool.PoolError('Cannot open a database connection: ' + str(error).strip()) from error
+        except Exception:
+            _pool_slots.release()
+            raise
+        with _pool_lock:
+            pool_stats['created'] += 1
+    
+    with _pool_lock:
+        pool_stats['acquired'] += 1
+        pool_stats['wait_ms_total'] += wait_ms
+        pool_stats['wait_ms_max'] = max(pool_stats['wait_ms_max'], wait_ms)
+    record_span('connect', (time.perf_counter() - wait_start) * 1000)
+    return conn
+
+def release_db_connection(conn, broken=False):
+    '''Возвращает соединение в пул; сломанные соединения закрываются'''
+    try:
+        if not broken and not conn.closed:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            with _pool_lock:
+                _pool_idle.append((conn, time.monotonic()))
+            return
+    except psycopg2.Error:
+        pass
+    finally:
+        _pool_slots.release()
+    _close_quietly(conn)
+
+@contextmanager
+def db_connection():
+    '''Соединение из пула на время запроса с автоматическим возвратом'''
+    conn = get_db_connection()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        release_db_connection(conn, broken)
+
+LATENCY_FLUSH_SQL = (
+    "INSERT INTO latency_histograms (function, span, minute, count, total_ms, max_ms, buckets) VALUES %s " +
+    "ON CONFLICT (function, span, minute) DO UPDATE SET count = latency_histograms.count + EXCLUDED.count, " +
+    "total_ms = latency_histograms.total_ms + EXCLUDED.total_ms, max_ms = GREATEST(latency_histograms.max_ms, EXCLUDED.max_ms), " +
+    "buckets = latency_add_buckets(latency_histograms.buckets, EXCLUDED.buckets)"
+)
+
+def record_span(name, elapsed_ms):
+    '''Добавляет время участка к спанам текущего запроса (повторы суммируются); вне запроса — сразу в гистограмму'''
+    spans = getattr(_trace, 'spans', None)
+    if spans is None:
+        record_latency(name, elapsed_ms)
+    else:
+        spans[name] = spans.get(name, 0.0) + elapsed_ms
+
+@contextmanager
+def span(name):
+    '''Замеряет участок обработки запроса'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, (time.perf_counter() - start) * 1000)
+
+class AdmissionRejected(Exception):
+    '''Запрос не допущен в полосу: очередь полна (429), ожидание истекло или база не даёт соединение (503)'''
+    def __init__(self, lane, reason, status_code, retry_after):
+        super().__init__(lane + ': ' + reason)
+        self.lane = lane
+        self.reason = reason
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+def _retry_after(lane):
+    '''Оценка Retry-After в секундах: очередь полосы, поделённая на её параллельность, умноженная на EWMA времени обслуживания'''
+    state = _admission[lane]
+    seconds = (state['waiting'] + 1) * state['service_ms'] / ADMISSION_LANES[lane]['limit'] / 1000
+    return min(60, max(1, int(seconds + 0.999)))
+
+def _reject(lane, reason, status_code):
+    '''Считает отказ и не чаще ADMISSION_LOG_INTERVAL пишет метрику полосы в лог'''
+    state = _admission[lane]
+    stats = admission_stats[lane]
+    stats['rejected_' + reason] += 1
+    rejection = AdmissionRejected(lane, reason, status_code, _retry_after(lane))
+    now = time.monotonic()
+    if now - state['logged_at'] >= ADMISSION_LOG_INTERVAL:
+        state['logged_at'] = now
+        print(json.dumps({
+            'metric': 'webhook_admission', 'lane': lane, 'reason': reason, 'retry_after': rejection.retry_after,
+            'in_flight': state['in_flight'], 'waiting': state['waiting'], **stats
+        }))
+    return rejection
+
+def _lane_busy(lane):
+    '''Полоса занята: limit исчерпан или полоса, которой она уступает (yields_to), держит очередь'''
+    config = ADMISSION_LANES[lane]
+    if _admission[lane]['in_flight'] >= config['limit']:
+        return True
+    return 'yields_to' in config and _admission[config['yields_to']]['waiting'] > 0
+
+@contextmanager
+def admission(lane, timeout=None):
+    '''
+    Допуск запроса в полосу: не больше limit одновременно, до queue ждущих не дольше timeout (по умолчанию — из полосы).
+    Полная очередь — сразу AdmissionRejected с 429, истёкшее ожидание или PoolError внутри блока — с 503.
+    Время ожидания — спан admission.<lane>.
+    '''
+    config = ADMISSION_LANES[lane]
+    state = _admission[lane]
+    stats = admission_stats[lane]
+    start = time.perf_counter()
+    with state['cond']:
+        if _lane_busy(lane):
+            if state['waiting'] >= config['queue']:
+                raise _reject(lane, 'queue_full', 429)
+            state['waiting'] += 1
+            stats['queued'] += 1
+            stats['max_waiting'] = max(stats['max_waiting'], state['waiting'])
+            deadline = time.monotonic() + (config['timeout'] if timeout is None else timeout)
+            try:
+                while _lane_busy(lane):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise _reject(lane, 'timeout', 503)
+                    # Очередь чужой полосы не будит эту: уступающая полоса перепроверяет её с шагом ADMISSION_YIELD_POLL
+                    state['cond'].wait(min(remaining, ADMISSION_YIELD_POLL) if 'yields_to' in config else remaining)
+            finally:
+                state['waiting'] -= 1
+        state['in_flight'] += 1
+        stats['admitted'] += 1
+    
+    admitted_at = time.perf_counter()
+    wait_ms = (admitted_at - start) * 1000
+    stats['wait_ms_total'] += wait_ms
+    record_span('admission.' + lane, wait_ms)
+    try:
+        yield
+    except psycopg2.pool.PoolError as error:
+        with state['cond']:
+            rejection = _reject(lane, 'db', 503)
+        raise rejection from error
+    finally:
+        with state['cond']:
+            state['in_flight'] -= 1
+            state['service_ms'] = 0.8 * state['service_ms'] + 0.2 * (time.perf_counter() - admitted_at) * 1000
+            state['cond'].notify()
+
+def rejected_response(rejection):
+    '''Быстрый ответ перегруженной полосы с Retry-After: Telegram и бот повторят доставку позже'''
+    return {
+        'statusCode': rejection.status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+            'Retry-After': str(rejection.retry_after)
+        },
+        'body': json.dumps({'error': 'Webhook is overloaded, retry later', 'reason': rejection.reason, 'retry_after': rejection.retry_after}),
+        'isBase64Encoded': False
+    }
+
+def admission_snapshot():
+    '''Глубина очередей и счётчики отказов по полосам для GET-ответа'''
+    return {
+        lane: dict(admission_stats[lane], in_flight=_admission[lane]['in_flight'], waiting=_admission[lane]['waiting'],
+                   limit=ADMISSION_LANES[lane]['limit'], queue=ADMISSION_LANES[lane]['queue'])
+        for lane in ADMISSION_LANES
+    }
+
+def record_latency(name, elapsed_ms):
+    '''Гистограмма спана по верхним границам LATENCY_BUCKETS_MS (последняя корзина — всё, что дольше): в памяти и в дельте до сброса в БД'''
+    bucket = bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)
+    with _latency_lock:
+        for stats_by_span in (latency_stats, _latency_pending):
+            stats = stats_by_span.get(name)
+            if stats is None:
+                stats = stats_by_span[name] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+            stats['count'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['buckets'][bucket] += 1
+
+def _restore_latency_pending(pending):
+    '''Возвращает несброшенные гистограммы в дельту до следующего сброса'''
+    with _latency_lock:
+        for name, stats in pending.items():
+            current = _latency_pending.get(name)
+            if current is None:
+                _latency_pending[name] = stats
+                continue
+            current['count'] += stats['count']
+            current['total_ms'] += stats['total_ms']
+            current['max_ms'] = max(current['max_ms'], stats['max_ms'])
+            current['buckets'] = [a + b for a, b in zip(current['buckets'], stats['buckets'])]
+
+def flush_latency_stats(force=False):
+    '''Не чаще METRICS_FLUSH_INTERVAL дописывает накопленные гистограммы в latency_histograms (их читает функция metrics) и пишет в лог счётчики пула'''
+    with _latency_lock:
+        if not _latency_pending or (not force and time.monotonic() - _latency_flush['at'] < METRICS_FLUSH_INTERVAL):
+            return 0
+        pending = dict(_latency_pending)
+        _latency_pending.clear()
+        _latency_flush['at'] = time.monotonic()
+    with _pool_lock:
+        pool = dict(pool_stats, idle=len(_pool_idle), size=DB_POOL_SIZE)
+    print(json.dumps({'metric': 'db_pool', 'function': METRICS_FUNCTION, **pool}))
+    
+    rows = [(METRICS_FUNCTION, name, stats['count'], stats['total_ms'], stats['max_ms'], stats['buckets']) for name, stats in pending.items()]
+    try:
+        # Сброс идёт в конце запроса: занятую полосу background не ждём, гистограммы вернутся к следующему сбросу
+        with admission('background', timeout=0):
+            with db_connection() as conn:
+                with conn.cursor() as cur:
+                    execute_values(cur, LATENCY_FLUSH_SQL, rows, template="(%s, %s, date_trunc('minute', now()), %s, %s, %s, %s)")
+                conn.commit()
+    except AdmissionRejected:
+        _restore_latency_pending(pending)
+        return 0
+    except psycopg2.Error as error:
+        print(json.dumps({'metric': 'latency_flush_failed', 'spans': len(rows), 'error': str(error)}))
+        return 0
+    return len(rows)
+
+def server_timing(spans):
+    return ', '.join(name + ';dur=' + str(round(ms, 1)) for name, ms in spans.items())
+
+def dump_profile(profiler, context, spans):
+    '''Пишет в лог топ PROFILE_TOP функций профиля запроса по cumulative time вместе с его спанами'''
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_TOP)
+    print(json.dumps({
+        'metric': 'profile',
+        'function': METRICS_FUNCTION,
+        'request_id': getattr(context, 'request_id', None),
+        'spans': {name: round(ms, 3) for name, ms in spans.items()},
+        'profile': report.getvalue()
+    }, ensure_ascii=False))
+
+def traced(handler_fn):
+    '''
+    Оборачивает handler: спаны запроса (connect, sql.*, serialize, total) уходят в Server-Timing и гистограммы.
+    С ?profile=1 запрос дополнительно профилируется cProfile (по одному за раз) и профиль пишется в лог.
+    '''
+    @functools.wraps(handler_fn)
+    def wrapper(event, context):
+        params = event.get('queryStringParameters') or {}
+        profiler = None
+        if params.get('profile') == '1' and _profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+        
+        _trace.spans = {}
+        start = time.perf_counter()
+        try:
+            if profiler is None:
+                response = handler_fn(event, context)
+            else:
+                response = profiler.runcall(handler_fn, event, context)
+        finally:
+            spans = _trace.spans
+            _trace.spans = None
+            spans['total'] = (time.perf_counter() - start) * 1000
+            for name, elapsed_ms in spans.items():
+                record_latency(name, elapsed_ms)
+            if profiler is not None:
+                _profile_lock.release()
+        
+        if profiler is not None:
+            dump_profile(profiler, context, spans)
+        headers = response.setdefault('headers', {})
+        headers['Server-Timing'] = server_timing(spans)
+        exposed = headers.get('Access-Control-Expose-Headers')
+        headers['Access-Control-Expose-Headers'] = exposed + ', Server-Timing' if exposed else 'Server-Timing'
+        flush_latency_stats()
+        return response
+    
+    return wrapper
+
+def _server_statement(label, sql):
+    '''Имя prepared statement (метка + хэш текста), текст с $n вместо %(name)s / %s и порядок параметров'''
+    statement = _statement_sql.get(sql)
+    if statement is None:
+        names = []
+        
+        def number(match):
+            name = match.group(1)
+            if name is None or name not in names:
+                names.append(name)
+                return '$' + str(len(names))
+            return '$' + str(names.index(name) + 1)
+        
+        text = _PLACEHOLDER_RE.sub(number, sql).replace('%%', '%')
+        statement = (label + '_' + hashlib.md5(sql.encode()).hexdigest()[:10], text, names)
+        _statement_sql[sql] = statement
+    return statement
+
+def execute_prepared(cur, label, sql, params=None):
+    '''
+    Выполняет запрос как prepared statement соединения: PREPARE при первом вызове, дальше только EXECUTE
+    без повторного разбора. Сверх STATEMENT_PREPARED_MAX на соединение — обычный execute. Время идёт в спан sql.<label>.
+    '''
+    name, text, names = _server_statement(label, sql)
+    prepared = cur.connection.prepared
+    start = time.perf_counter()
+    if name not in prepared and len(prepared) < STATEMENT_PREPARED_MAX:
+        cur.execute('PREPARE ' + name + ' AS ' + text)
+        prepared.add(name)
+    if name in prepared:
+        values = [params[n] for n in names] if isinstance(params, dict) else list(params or ())
+        if values:
+            cur.execute('EXECUTE ' + name + ' (' + ', '.join(['%s'] * len(values)) + ')', values)
+        else:
+            cur.execute('EXECUTE ' + name)
+    else:
+        cur.execute(sql, params)
+    record_span('sql.' + label, (time.perf_counter() - start) * 1000)
+
+def _count_event(name, count=1):
+    with _event_lock:
+        event_stats[name] += count
+
+def log_event(user_id, event_type, event_data, response_time_ms=None, success=True, error_message=None):
+    '''Ставит событие event_logs в очередь без ожидания записи; сэмплирует по EVENT_SAMPLE_RATES, при переполнении отбрасывает'''
+    rate = float(EVENT_SAMPLE_RATES.get(event_type, EVENT_SAMPLE_RATES.get('*', 1.0)))
+    if success and rate < 1.0:
+        # Ошибки не сэмплируются; у остальных событий доля сохраняется в event_data для пересчёта
+        if random.random() >= rate:
+            _count_event('sampled_out')
+            return False
+        event_data = dict(event_data, sample_rate=rate)
+    
+    try:
+        _event_queue.put_nowait((user_id, event_type, Json(event_data), response_time_ms, success, error_message, datetime.now()))
+    except queue.Full:
+        _count_event('dropped')
+        return False
+    _count_event('enqueued')
+    _start_event_flusher()
+    return True
+
+def _start_event_flusher():
+    '''Запускает фоновый поток записи событий при первом событии (и после заморозки инстанса)'''
+    global _event_flusher
+    with _event_lock:
+        if _event_flusher is None or not _event_flusher.is_alive():
+            _event_flusher = threading.Thread(target=_event_flush_loop, name='event-log-flusher', daemon=True)
+            _event_flusher.start()
+
+def _take_events(timeout=None):
+    '''Забирает из очереди до EVENT_BATCH_SIZE событий; первое ждёт не дольше timeout (None — не ждёт)'''
+    try:
+        batch = [_event_queue.get(timeout=timeout) if timeout else _event_queue.get_nowait()]
+    except queue.Empty:
+        return []
+    while len(batch) < EVENT_BATCH_SIZE:
+        try:
+            batch.append(_event_queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+def write_events(batch):
+    '''Пишет пачку событий одним multi-row INSERT в полосе background; при ошибке или отказе полосы пачка отбрасывается и считается в failed'''
+    try:
+        with admission('background'):
+            with db_connection() as conn:
+                with conn.cursor() as cur:
+                    execute_values(
+                        cur,
+                        "INSERT INTO event_logs (user_id, event_type, event_data, response_time_ms, success, error_message, timestamp) VALUES %s",
+                        batch,
+                        page_size=EVENT_BATCH_SIZE
+                    )
+                conn.commit()
+    except (psycopg2.Error, AdmissionRejected) as error:
+        _count_event('failed', len(batch))
+        print(json.dumps({'metric': 'event_log_failed', 'events': len(batch), 'error': str(error)}))
+        return 0
+    _count_event('written', len(batch))
+    return len(batch)
+
+def _event_flush_loop():
+    while True:
+        batch = _take_events(EVENT_FLUSH_MS / 1000.0)
+        if batch:
+            write_events(batch)
+            print(json.dumps({'metric': 'event_log', 'batch': len(batch), 'queued': _event_queue.qsize(), **event_stats}))
+
+def flush_events():
+    '''Синхронно дописывает всё, что осталось в очереди; вызывается при завершении процесса'''
+    written = 0
+    batch = _take_events()
+    while batch:
+        written += write_events(batch)
+        batch = _take_events()
+    return written
+
+atexit.register(flush_events)
+
+DAU_SKETCH_SQL = '''
+    INSERT INTO dau_sketches (day, sketch)
+    SELECT %(today)s::date, set_byte(decode(repeat('00', 4096), 'hex'), %(hll_index)s, %(hll_rank)s)
+    WHERE %(has_messages)s::boolean
+    ON CONFLICT (day) DO UPDATE SET sketch = set_byte(dau_sketches.sketch, %(hll_index)s, %(hll_rank)s)
+    WHERE get_byte(dau_sketches.sketch, %(hll_index)s) < %(hll_rank)s
+'''
+
+def hll_register(telegram_id):
+    '''Регистр (старшие 12 бит) и ранг HyperLogLog по первым 64 битам md5(telegram_id), как в V0013'''
+    hashed = int(hashlib.md5(str(int(telegram_id)).encode()).hexdigest()[:16], 16)
+    rest = hashed & ((1 << 52) - 1)
+    return hashed >> 52, 53 - rest.bit_length()
+
+def message_event_data(payload):
+    '''event_data для message_received: обрезанные тексты, токены и модель'''
+    return {
+        'user_message': payload['user_message'][:100] if payload['user_message'] else None,
+        'assistant_message': payload['assistant_message'][:100] if payload['assistant_message'] else None,
+        'tokens': payload['tokens'],
+        'model': payload['model']
+    }
+
+# Статистика users_enhanced (V0018): сообщения, токены и сессии прибавляются атомарно в ON CONFLICT.
+# Новая сессия начинается, если первое сообщение пришло позже last_seen + SESSION_GAP_MINUTES;
+# total_sessions во вставляемой строке — 1 + число перерывов внутри батча (для одного сообщения это 1).
+USER_STATS_COLUMNS = (
+    "users_enhanced (telegram_user_id, username, status, first_seen, last_seen, session_started_at, " +
+    "total_messages_count, total_sessions, total_tokens_used)"
+)
+USER_STATS_NEW_SESSION = (
+    "(users_enhanced.last_seen IS NULL OR " +
+    "EXCLUDED.first_seen > users_enhanced.last_seen + make_interval(mins => " + str(SESSION_GAP_MINUTES) + "))"
+)
+USER_STATS_CONFLICT_SQL = (
+    " ON CONFLICT (telegram_user_id) DO UPDATE SET " +
+    "username = EXCLUDED.username, " +
+    "status = CASE WHEN users_enhanced.status = 'banned' THEN users_enhanced.status ELSE EXCLUDED.status END, " +
+    "first_seen = LEAST(users_enhanced.first_seen, EXCLUDED.first_seen), " +
+    "last_seen = GREATEST(users_enhanced.last_seen, EXCLUDED.last_seen), " +
+    "session_started_at = CASE WHEN EXCLUDED.total_sessions > 1 OR " + USER_STATS_NEW_SESSION + " " +
+    "THEN EXCLUDED.session_started_at ELSE users_enhanced.session_started_at END, " +
+    "total_sessions = users_enhanced.total_sessions + EXCLUDED.total_sessions - 1 + " + USER_STATS_NEW_SESSION + "::int, " +
+    "total_messages_count = users_enhanced.total_messages_count + EXCLUDED.total_messages_count, " +
+    "total_tokens_used = users_enhanced.total_tokens_used + EXCLUDED.total_tokens_used"
+)
+USER_STATS_SQL = (
+    "INSERT INTO " + USER_STATS_COLUMNS + " VALUES (%(telegram_id)s, %(username)s, " +
+    "CASE WHEN %(premium)s THEN 'premium' ELSE 'active' END, %(now)s, %(now)s, %(now)s, %(message_count)s, 1, %(tokens)s)" +
+    USER_STATS_CONFLICT_SQL
+)
+
+def message_count(payload):
+    '''Сколько строк messages даёт сообщение: непустые user_message и assistant_message'''
+    return int(bool(payload['user_message'])) + int(bool(payload['assistant_message']))
+
+def batch_user_stats(batch):
+    '''Строки upsert'а users_enhanced по батчу, отсортированному по received_at: сессии внутри батча считаются здесь'''
+    gap = timedelta(minutes=SESSION_GAP_MINUTES)
+    stats = {}
+    for r in batch:
+        telegram_id = int(r['telegram_id'])
+        received_at = datetime.fromisoformat(r['received_at'])
+        user = stats.get(telegram_id)
+        if user is None:
+            user = stats[telegram_id] = {'first': received_at, 'last': received_at, 'session_start': received_at, 'sessions': 1, 'messages': 0, 'tokens': 0}
+        elif received_at > user['last'] + gap:
+            user['sessions'] += 1
+            user['session_start'] = received_at
+        user['last'] = received_at
+        user['username'] = r['username'] or ''
+        user['status'] = 'premium' if r['premium'] else 'active'
+        user['messages'] += message_count(r)
+        user['tokens'] += r['tokens']
+    return [
+        (telegram_id, u['username'], u['status'], u['first'], u['last'], u['session_start'], u['messages'], u['sessions'], u['tokens'])
+        for telegram_id, u in stats.items()
+    ]
+
+def bump_data_version(conn):
+    '''
+    Сдвигает data_version_seq после коммита записи (autocommit, без BEGIN): nextval нетранзакционен, и сдвиг
+    до коммита давал читателям новую версию раньше данных — get-* кэшировали под ней снимок без этой записи.
+    '''
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            execute_prepared(cur, 'data_version_bump', "SELECT nextval('data_version_seq')")
+    finally:
+        conn.autocommit = False
+
+def ingest_legacy(conn, payload, start_time):
+    '''Исходный путь записи: ~10 последовательных запросов (счётчики users прибавляются в самом UPDATE)'''
+    telegram_id = payload['telegram_id']
+    tokens = payload['tokens']
+    username = payload['username'] or ''
+    user_message = payload['user_message']
+    assistant_message = payload['assistant_message']
+    now = datetime.now()
+    today = now.date()
+    
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    execute_prepared(cur, 'legacy_user', "SELECT id FROM users WHERE telegram_id = %s", (telegram_id,))
+    user = cur.fetchone()
+    
+    if user:
+        user_id = user['id']
+        execute_prepared(
+            cur,
+            'legacy_user_update',
+            "UPDATE users SET total_tokens = total_tokens + %s, dialogs_count = dialogs_count + 1, last_active = %s, premium = %s, username = %s WHERE id = %s",
+            (tokens, now, payload['premium'], username, user_id)
+        )
+    else:
+        execute_prepared(
+            cur,
+            'legacy_user_insert',
+            "INSERT INTO users (telegram_id, name, username, email, premium, total_tokens, dialogs_count, last_active) VALUES (%s, %s, %s, %s, %s, %s, 1, %s) RETURNING id",
+            (telegram_id, payload['name'], username, payload['email'] or None, payload['premium'], tokens, now)
+        )
+        user_id = cur.fetchone()['id']
+    
+    execute_prepared(
+        cur,
+        'legacy_dialog_insert',
+        "INSERT INTO dialogs (user_id, telegram_id, username, tokens, model, status, user_message, assistant_message, interaction_type, created_at, updated_at) " +
+        "VALUES (%(user_id)s, %(telegram_id)s, %(username)s, %(tokens)s, %(model)s, 'Завершён', %(user_message)s, %(assistant_message)s, %(interaction_type)s, %(now)s, %(now)s) RETURNING id",
+        {
+            'user_id': user_id,
+            'telegram_id': telegram_id,
+            'username': username,
+            'tokens': tokens,
+            'model': payload['model'],
+            'user_message': user_message or None,
+            'assistant_message': assistant_message or None,
+            'interaction_type': payload['interaction_type'],
+            'now': now
+        }
+    )
+    dialog_id = cur.fetchone()['id']
+    
+    execute_prepared(cur, 'legacy_token_stats', "SELECT id, total_tokens, active_users FROM token_stats WHERE date = %s", (today,))
+    stats = cur.fetchone()
+    
+    if stats:
+        execute_prepared(cur, 'legacy_token_stats_update', "UPDATE token_stats SET total_tokens = total_tokens + %s WHERE date = %s", (tokens, today))
+    else:
+        execute_prepared(
+            cur,
+            'legacy_active_users',
+            "SELECT COUNT(DISTINCT telegram_id) as count FROM dialogs WHERE created_at >= %s AND created_at < %s",
+            (today, today + timedelta(days=1))
+        )
+        active_count = cur.fetchone()['count']
+        
+        execute_prepared(
+            cur,
+            'legacy_token_stats_insert',
+            "INSERT INTO token_stats (date, total_tokens, active_users) VALUES (%s, %s, %s)",
+            (today, tokens, active_count)
+        )
+    
+    for message, sender in ((user_message, 'user'), (assistant_message, 'bot')):
+        if message:
+            execute_prepared(
+                cur,
+                'legacy_message_insert',
+                "INSERT INTO messages (user_id, message, sender, timestamp) VALUES (%s, %s, %s, %s)",
+                (telegram_id, message, sender, now)
+            )
+    
+    if tokens > 0:
+        execute_prepared(
+            cur,
+            'legacy_cost_insert',
+            "INSERT INTO costs (user_id, tokens_used, model, prompt_tokens, completion_tokens, date) VALUES (%s, %s, %s, %s, %s, %s)",
+            (telegram_id, tokens, payload['model'], payload['prompt_tokens'], payload['completion_tokens'], today)
+        )
+    
+    execute_prepared(cur, 'legacy_user_stats', USER_STATS_SQL, {
+        'telegram_id': telegram_id,
+        'username': username,
+        'premium': payload['premium'],
+        'now': now,
+        'message_count': message_count(payload),
+        'tokens': tokens
+    })
+    
+    hll_index, hll_rank = hll_register(telegram_id)
+    execute_prepared(cur, 'dau_sketch', DAU_SKETCH_SQL, {
+        'today': today,
+        'hll_index': hll_index,
+        'hll_rank': hll_rank,
+        'has_messages': bool(user_message or assistant_message)
+    })
+    
+    conn.commit()
+    cur.close()
+    bump_data_version(conn)
+    
+    return dialog_id, user_id
+
+INGEST_SQL = '''
+WITH upsert_user AS (
+    INSERT INTO users (telegram_id, name, username, email, premium, total_tokens, dialogs_count, last_active)
+    VALUES (%(telegram_id)s, %(name)s, %(username)s, %(email)s, %(premium)s, %(tokens)s, 1, %(now)s)
+    ON CONFLICT (telegram_id) DO UPDATE SET
+        total_tokens = users.total_tokens + EXCLUDED.total_tokens,
+        dialogs_count = users.dialogs_count + 1,
+        last_active = EXCLUDED.last_active,
+        premium = EXCLUDED.premium,
+        username = EXCLUDED.username
+    RETURNING id
+), new_dialog AS (
+    INSERT INTO dialogs (user_id, telegram_id, username, tokens, model, status, user_message, assistant_message, interaction_type, created_at, updated_at)
+    SELECT id, %(telegram_id)s, %(username)s, %(tokens)s, %(model)s, 'Завершён', %(user_message)s, %(assistant_message)s, %(interaction_type)s, %(now)s, %(now)s
+    FROM upsert_user
+    RETURNING id, user_id
+), daily_tokens AS (
+    INSERT INTO token_stats (date, total_tokens, active_users)
+    VALUES (%(today)s, %(tokens)s, 1)
+    ON CONFLICT (date) DO UPDATE SET total_tokens = token_stats.total_tokens + EXCLUDED.total_tokens
+), chat_messages AS (
+    INSERT INTO messages (user_id, message, sender, timestamp)
+    SELECT %(telegram_id)s, m.message, m.sender, %(now)s
+    FROM (VALUES (%(user_message)s, 'user'), (%(assistant_message)s, 'bot')) AS m(message, sender)
+    WHERE m.message IS NOT NULL AND m.message <> ''
+), token_costs AS (
+    INSERT INTO costs (user_id, tokens_used, model, prompt_tokens, completion_tokens, date)
+    SELECT %(telegram_id)s, %(tokens)s, %(model)s, %(prompt_tokens)s, %(completion_tokens)s, %(today)s
+    WHERE %(tokens)s > 0
+), user_stats AS (''' + USER_STATS_SQL + '''
+), dau_sketch AS (''' + DAU_SKETCH_SQL + ''')
+SELECT id AS dialog_id, user_id FROM new_dialog
+'''
+
+def ingest_single_statement(conn, payload, start_time):
+    '''Записывает сообщение одним CTE с upsert'ами за один round-trip (autocommit, bind-параметры)'''
+    now = datetime.now()
+    hll_index, hll_rank = hll_register(payload['telegram_id'])
+    params = dict(payload, hll_index=hll_index, hll_rank=hll_rank)
+    params.update({
+        'username': payload['username'] or '',
+        'email': payload['email'] or None,
+        'user_message': payload['user_message'] or None,
+        'assistant_message': payload['assistant_message'] or None,
+        'now': now,
+        'today': now.date(),
+        'message_count': message_count(payload),
+        'has_messages': bool(payload['user_message'] or payload['assistant_message'])
+    })
+    
+    conn.autocommit = True
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            execute_prepared(cur, 'ingest', INGEST_SQL, params)
+            row = cur.fetchone()
+    finally:
+        conn.autocommit = False
+    bump_data_version(conn)
+    
+    return row['dialog_id'], row['user_id']
+
+INT4_MAX = 2 ** 31 - 1
+INT8_MAX = 2 ** 63 - 1
+# Длины строк — как у колонок users, dialogs, costs и ingest_events: длиннее база не примет весь батч
+PAYLOAD_TEXT_LIMITS = {'name': 255, 'username': 255, 'email': 255, 'model': 50, 'interaction_type': 50}
+
+def _payload_int(body_data, field, maximum, default=None):
+    value = body_data.get(field)
+    if value is None:
+        return default
+    if isinstance(value, bool) or not (isinstance(value, int) or (isinstance(value, str) and value.isdigit())) or int(value) > maximum:
+        raise ValueError(field + ' must be an integer from 0 to ' + str(maximum))
+    return int(value)
+
+def _payload_text(body_data, field, default=None):
+    value = body_data.get(field)
+    if value is None:
+        return default
+    if not isinstance(value, str):
+        raise ValueError(field + ' must be a string')
+    limit = PAYLOAD_TEXT_LIMITS.get(field)
+    if limit and len(value) > limit:
+        raise ValueError(field + ' must be at most ' + str(limit) + ' characters')
+    return value
+
+def parse_payload(body_data):
+    '''
+    Приводит тело вебхука к типам колонок до записи и до ответа боту; ValueError — ответ 400.
+    Иначе запись, принятая в spool или ingest_events с 202, падала бы при сбросе вместе со всем батчем.
+    '''
+    if not isinstance(body_data, dict):
+        raise ValueError('body must be a JSON object')
+    telegram_id = _payload_int(body_data, 'telegram_id', INT8_MAX)
+    if not telegram_id:
+        raise ValueError('telegram_id is required')
+    premium = body_data.get('premium')
+    if premium is not None and not isinstance(premium, bool):
+        raise ValueError('premium must be a boolean')
+    return {
+        'telegram_id': telegram_id,
+        'name': _payload_text(body_data, 'name', 'Пользователь'),
+        'username': _payload_text(body_data, 'username'),
+        'tokens': _payload_int(body_data, 'tokens', INT4_MAX, 0),
+        'prompt_tokens': _payload_int(body_data, 'prompt_tokens', INT4_MAX),
+        'completion_tokens': _payload_int(body_data, 'completion_tokens', INT4_MAX),
+        'model': _payload_text(body_data, 'model', 'GPT-3.5'),
+        'premium': bool(premium),
+        'email': _payload_text(body_data, 'email'),
+        'user_message': _payload_text(body_data, 'user_message'),
+        'assistant_message': _payload_text(body_data, 'assistant_message'),
+        'interaction_type': _payload_text(body_data, 'interaction_type', 'chat')
+    }
+
+def spool_payload(payload):
+    '''Дописывает сообщение в локальный spool с fsync до ответа боту; возвращает True, если пора сбрасывать батч'''
+    line = json.dumps(payload, ensure_ascii=False) + '\n'
+    with _spool_lock:
+        os.makedirs(WEBHOOK_SPOOL_DIR, exist_ok=True)
+        with open(os.path.join(WEBHOOK_SPOOL_DIR, 'pending.ndjson'), 'a', encoding='utf-8') as spool:
+            spool.write(line)
+            spool.flush()
+            os.fsync(spool.fileno())
+        
+        _spool_state['pending'] += 1
+        if _spool_state['first_at'] is None:
+            _spool_state['first_at'] = time.monotonic()
+            schedule_spool_flush(WEBHOOK_FLUSH_MS / 1000.0)
+        
+        age_ms = (time.monotonic() - _spool_state['first_at']) * 1000
+        return _spool_state['pending'] >= WEBHOOK_FLUSH_RECORDS or age_ms >= WEBHOOK_FLUSH_MS
+
+def _spool_timer_fired():
+    with _spool_schedule_lock:
+        _spool_timer['timer'] = None
+        _spool_timer['due'] = None
+    flush_spool()
+
+def schedule_spool_flush(delay):
+    '''Запускает flush_spool в фоне через delay секунд; более поздний уже запланированный запуск переносится на раньше'''
+    due = time.monotonic() + delay
+    with _spool_schedule_lock:
+        if _spool_timer['timer'] is not None:
+            if _spool_timer['due'] <= due:
+                return
+            _spool_timer['timer'].cancel()
+        timer = threading.Timer(delay, _spool_timer_fired)
+        timer.daemon = True
+        _spool_timer['timer'] = timer
+        _spool_timer['due'] = due
+        timer.start()
+
+def _rotate_pending_spool():
+    '''Атомарно превращает накопленный pending.ndjson в отдельный файл батча'''
+    with _spool_lock:
+        pending = os.path.join(WEBHOOK_SPOOL_DIR, 'pending.ndjson')
+        if os.path.exists(pending) and os.path.getsize(pending) > 0:
+            batch_name = 'batch-' + str(time.time_ns()) + '-' + uuid.uuid4().hex[:8] + '.ndjson'
+            os.replace(pending, os.path.join(WEBHOOK_SPOOL_DIR, batch_name))
+        _spool_state['pending'] = 0
+        _spool_state['first_at'] = None
+
+def _read_spool_batch(path):
+    records = []
+    with open(path, encoding='utf-8') as spool:
+        for line in spool:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Оборванная строка после сбоя: fsync не завершился, боту 2xx не отправлялся
+                continue
+    return records
+
+def _transient_error(error):
+    '''Сбой связи или пула, а не данных: батч повторяется целиком, не делясь'''
+    return isinstance(error, (AdmissionRejected, psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.pool.PoolError))
+
+def _dead_letter(records, error):
+    '''Откладывает записи, которые не проходят в базу ни в каком батче, в deadletter.ndjson рядом со spool'''
+    failed_at = datetime.now().isoformat()
+    with _spool_lock:
+        with open(os.path.join(WEBHOOK_SPOOL_DIR, 'deadletter.ndjson'), 'a', encoding='utf-8') as dead:
+            for record in records:
+                dead.write(json.dumps({'record': record, 'error': str(error), 'failed_at': failed_at}, ensure_ascii=False, default=str) + '\n')
+            dead.flush()
+            os.fsync(dead.fileno())
+    print(json.dumps({'metric': 'webhook_dead_letter', 'records': len(records), 'error': str(error)}))
+
+def _write_isolating(records):
+    '''
+    Пишет батч делением пополам: половины без ошибок коммитятся, одиночная запись с ошибкой данных уходит
+    в dead-letter. Сбой связи прерывает разбор: уже записанные части при повторе отсеет ingest_keys.
+    '''
+    try:
+        with db_connection() as conn:
+            return write_batch(conn, records)
+    except Exception as error:
+        if _transient_error(error):
+            raise
+        if len(records) == 1:
+            _dead_letter(records, error)
+            return 0
+    middle = len(records) // 2
+    return _write_isolating(records[:middle]) + _write_isolating(records[middle:])
+
+def flush_spool(timeout=None):
+    '''
+    Сбрасывает батчи из spool в БД в полосе background; неудачные (и не допущенные за timeout) остаются на диске
+    и повторяются с экспоненциальным backoff. После WEBHOOK_SPOOL_SPLIT_ATTEMPTS неудач батч пишется делением
+    пополам, и записи, которые база не принимает, уходят в dead-letter вместо того, чтобы держать весь батч.
+    Пока на диске остаются батчи, таймер перезапускается к ближайшему повтору.
+    '''
+    if not _flush_lock.acquire(blocking=False):
+        return 0
+    flushed = 0
+    next_retry = None
+    try:
+        if not os.path.isdir(WEBHOOK_SPOOL_DIR):
+            return 0
+        _rotate_pending_spool()
+        for batch_name in sorted(f for f in os.listdir(WEBHOOK_SPOOL_DIR) if f.startswith('batch-')):
+            attempts, retry_at = _spool_retries.get(batch_name, (0, 0.0))
+            if time.monotonic() < retry_at:
+                next_retry = retry_at if next_retry is None else min(next_retry, retry_at)
+                continue
+            path = os.path.join(WEBHOOK_SPOOL_DIR, batch_name)
+            records = _read_spool_batch(path)
+            try:
+                with admission('background', timeout):
+                    if records and attempts >= WEBHOOK_SPOOL_SPLIT_ATTEMPTS:
+                        flushed += _write_isolating(records)
+                    else:
+                        with db_connection() as conn:
+                            flushed += write_batch(conn, records)
+            except Exception as error:
+                retry_at = time.monotonic() + min(60.0, 0.5 * 2 ** attempts)
+                _spool_retries[batch_name] = (attempts + 1, retry_at)
+                next_retry = retry_at if next_retry is None else min(next_retry, retry_at)
+                print(json.dumps({'metric': 'webhook_flush_failed', 'batch': batch_name, 'records': len(records), 'attempts': attempts + 1, 'error': str(error)}))
+                continue
+            os.remove(path)
+            _spool_retries.pop(batch_name, None)
+        if next_retry is None:
+            prune_ingest_keys(timeout)
+    finally:
+        _flush_lock.release()
+    if next_retry is not None:
+        schedule_spool_flush(max(0.0, next_retry - time.monotonic()))
+    return flushed
+
+def prune_ingest_keys(timeout=None):
+    '''
+    Удаляет ключи ingest_keys старше INGEST_KEYS_TTL_HOURS порцией до INGEST_KEYS_PRUNE_LIMIT, не чаще раза
+    в INGEST_KEYS_PRUNE_SECONDS. Повтор старше окна уже не отсеется, поэтому окно берётся с запасом к backoff бота.
+    '''
+    now = time.monotonic()
+    if _spool_state['pruned_at'] is not None and now - _spool_state['pruned_at'] < INGEST_KEYS_PRUNE_SECONDS:
+        return 0
+    _spool_state['pruned_at'] = now
+    try:
+        with admission('background', timeout):
+            with db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "DELETE FROM ingest_keys WHERE idempotency_key IN (SELECT idempotency_key FROM ingest_keys " +
+                        "WHERE created_at < now() - %s * interval '1 hour' ORDER BY created_at LIMIT %s)",
+                        (INGEST_KEYS_TTL_HOURS, INGEST_KEYS_PRUNE_LIMIT)
+                    )
+                    pruned = cur.rowcount
+                conn.commit()
+    except (AdmissionRejected, psycopg2.Error, psycopg2.pool.PoolError) as error:
+        # Не вышло — попробуем при следующем сбросе, а не через час
+        _spool_state['pruned_at'] = None
+        print(json.dumps({'metric': 'ingest_keys_prune_failed', 'error': str(error)}))
+        return 0
+    if pruned:
+        print(json.dumps({'metric': 'ingest_keys_pruned', 'rows': pruned}))
+    return pruned
+
+def write_batch(conn, records):
+    '''Пишет батч multi-row INSERT'ами в одной транзакции; уже применённые idempotency_key пропускаются'''
+    unique_records = {}
+    for record in records:
+        unique_records.setdefault(record['idempotency_key'], record)
+    
+    cur = conn.cursor()
+    fresh_keys = execute_values(
+        cur,
+        "INSERT INTO ingest_keys (idempotency_key) VALUES %s ON CONFLICT DO NOTHING RETURNING idempotency_key",
+        [(key,) for key in unique_records],
+        fetch=True
+    )
+    batch = [unique_records[row[0]] for row in fresh_keys]
+    batch.sort(key=lambda record: record['received_at'])
+    if not batch:
+        conn.commit()
+        cur.close()
+        return 0
+    
+    user_ids = apply_batch(cur, batch)
+    conn.commit()
+    cur.close()
+    bump_data_version(conn)
+    
+    for r in batch:
+        log_event(user_ids[int(r['telegram_id'])], 'message_received', dict(message_event_data(r), idempotency_key=r['idempotency_key']), r.get('response_time_ms'))
+    return len(batch)
+
+def apply_batch(cur, batch):
+    '''
+    Раскладывает батч сообщений по read-моделям multi-row INSERT'ами (users, dialogs, token_stats, users_enhanced,
+    messages, dau_sketches, costs) без commit и без сдвига data_version: его делает вызывающий после commit.
+    event_id записи (если есть) попадает в dialogs/messages/costs.
+    Возвращает {telegram_id: users.id}.
+    '''
+    users = {}
+    daily = {}
+    for record in batch:
+        telegram_id = int(record['telegram_id'])
+        user = users.setdefault(telegram_id, {'tokens': 0, 'dialogs': 0})
+        user.update({
+            'name': record['name'],
+            'username': record['username'] or '',
+            'email': record['email'] or None,
+            'premium': record['premium'],
+            'last_active': record['received_at']
+        })
+        user['tokens'] += record['tokens']
+        user['dialogs'] += 1
+        
+        day = daily.setdefault(record['received_at'][:10], {'tokens': 0, 'users': set()})
+        day['tokens'] += record['tokens']
+        day['users'].add(telegram_id)
+    
+    user_ids = dict(execute_values(
+        cur,
+        "INSERT INTO users (telegram_id, name, username, email, premium, total_tokens, dialogs_count, last_active) VALUES %s "
+        "ON CONFLICT (telegram_id) DO UPDATE SET "
+        "total_tokens = users.total_tokens + EXCLUDED.total_tokens, "
+        "dialogs_count = users.dialogs_count + EXCLUDED.dialogs_count, "
+        "last_active = GREATEST(users.last_active, EXCLUDED.last_active), "
+        "premium = EXCLUDED.premium, username = EXCLUDED.username "
+        "RETURNING telegram_id, id",
+        [(telegram_id, u['name'], u['username'], u['email'], u['premium'], u['tokens'], u['dialogs'], u['last_active']) for telegram_id, u in users.items()],
+        fetch=True
+    ))
+    
+    execute_values(
+        cur,
+        "INSERT INTO dialogs (user_id, telegram_id, username, tokens, model, status, user_message, assistant_message, interaction_type, created_at, updated_at, event_id) VALUES %s",
+        [(
+            user_ids[int(r['telegram_id'])], int(r['telegram_id']), r['username'] or '', r['tokens'], r['model'], 'Завершён',
+            r['user_message'] or None, r['assistant_message'] or None, r['interaction_type'], r['received_at'], r['received_at'], r.get('event_id')
+        ) for r in batch],
+        page_size=WEBHOOK_FLUSH_RECORDS
+    )
+    
+    execute_values(cur, "INSERT INTO " + USER_STATS_COLUMNS + " VALUES %s" + USER_STATS_CONFLICT_SQL, batch_user_stats(batch))
+    
+    execute_values(
+        cur,
+        "INSERT INTO token_stats (date, total_tokens, active_users) VALUES %s "
+        "ON CONFLICT (date) DO UPDATE SET total_tokens = token_stats.total_tokens + EXCLUDED.total_tokens",
+        [(day, stats['tokens'], len(stats['users'])) for day, stats in daily.items()]
+    )
+    
+    message_rows = []
+    for r in batch:
+        if r['user_message']:
+            message_rows.append((int(r['telegram_id']), r['user_message'], 'user', r['received_at'], r.get('event_id')))
+        if r['assistant_message']:
+            message_rows.append((int(r['telegram_id']), r['assistant_message'], 'bot', r['received_at'], r.get('event_id')))
+    if message_rows:
+        execute_values(
+            cur,
+            "INSERT INTO messages (user_id, message, sender, timestamp, event_id) VALUES %s",
+            message_rows,
+            page_size=WEBHOOK_FLUSH_RECORDS * 2
+        )
+    
+    sketches = {}
+    for r in batch:
+        if r['user_message'] or r['assistant_message']:
+            hll_index, hll_rank = hll_register(r['telegram_id'])
+            sketch = sketches.setdefault(r['received_at'][:10], bytearray(4096))
+            sketch[hll_index] = max(sketch[hll_index], hll_rank)
+    if sketches:
+        execute_values(
+            cur,
+            "INSERT INTO dau_sketches (day, sketch) VALUES %s ON CONFLICT (day) DO UPDATE SET sketch = hll_merge(dau_sketches.sketch, EXCLUDED.sketch)",
+            [(day, bytes(sketch)) for day, sketch in sketches.items()]
+        )
+    
+    cost_rows = [(
+        int(r['telegram_id']), r['tokens'], r['model'], r.get('prompt_tokens'), r.get('completion_tokens'), r['received_at'][:10], r.get('event_id')
+    ) for r in batch if r['tokens'] > 0]
+    if cost_rows:
+        execute_values(
+            cur,
+            "INSERT INTO costs (user_id, tokens_used, model, prompt_tokens, completion_tokens, date, event_id) VALUES %s",
+            cost_rows,
+            page_size=WEBHOOK_FLUSH_RECORDS
+        )
+    
+    return user_ids
+
+EVENT_APPEND_SQL = (
+    "INSERT INTO ingest_events (idempotency_key, telegram_id, name, username, email, premium, tokens, prompt_tokens, completion_tokens, " +
+    "model, user_message, assistant_message, interaction_type, response_time_ms) VALUES (%(idempotency_key)s, %(telegram_id)s, " +
+    "%(name)s, %(username)s, %(email)s, %(premium)s, %(tokens)s, %(prompt_tokens)s, %(completion_tokens)s, %(model)s, " +
+    "%(user_message)s, %(assistant_message)s, %(interaction_type)s, %(response_time_ms)s) ON CONFLICT (idempotency_key) DO NOTHING RETURNING id"
+)
+EVENTS_BATCH_SQL = (
+    "SELECT id AS event_id, idempotency_key, received_at, received_at < now() - make_interval(secs => %(settle)s) AS settled, " +
+    "telegram_id, name, username, email, premium, tokens, prompt_tokens, completion_tokens, model, user_message, assistant_message, interaction_type, response_time_ms " +
+    "FROM ingest_events WHERE id > %(after)s ORDER BY id LIMIT %(limit)s"
+)
+
+QUARANTINE_SQL = (
+    "WITH moved AS (DELETE FROM ingest_events WHERE id = %(event_id)s RETURNING *) " +
+    "INSERT INTO ingest_events_quarantine (event_id, idempotency_key, event, error) " +
+    "SELECT id, idempotency_key, to_jsonb(moved), %(error)s FROM moved"
+)
+
+class ProjectionFailed(Exception):
+    '''Батч проектора не применился из-за данных (не связи): batch — события батча, error — исходная ошибка'''
+    def __init__(self, batch, error):
+        super().__init__(str(error))
+        self.batch = batch
+        self.error = error
+
+def append_event(conn, payload):
+    '''Единственная запись webhook в режиме events: строка ingest_events; None, если idempotency_key уже был'''
+    params = dict(payload)
+    params.update({
+        'username': payload['username'] or '',
+        'email': payload['email'] or None,
+        'user_message': payload['user_message'] or None,
+        'assistant_message': payload['assistant_message'] or None
+    })
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            execute_prepared(cur, 'event_append', EVENT_APPEND_SQL, params)
+            row = cur.fetchone()
+    finally:
+        conn.autocommit = False
+    return row[0] if row else None
+
+def project_events(conn, limit=PROJECTOR_BATCH_SIZE, log=True):
+    '''
+    Проецирует следующий батч ingest_events после чекпоинта в read-модели (apply_batch) и сдвигает чекпоинт
+    в той же транзакции: каждое событие применяется ровно один раз. Чекпоинт берётся FOR UPDATE SKIP LOCKED,
+    так что параллельный проектор просто пропускает ход.
+    
+    id выдаются последовательностью до commit, поэтому дырка в id может быть ещё не закоммиченной вставкой
+    (или номером, сгоревшим на дубле idempotency_key). Проектор останавливается перед дыркой, пока событие
+    за ней не старше PROJECTOR_SETTLE_SECONDS. Возвращает (число событий, догнал ли хвост).
+    '''
+    read = conn.cursor(cursor_factory=RealDictCursor)
+    execute_prepared(read, 'projector_checkpoint', "SELECT last_event_id FROM projector_checkpoints WHERE name = %s FOR UPDATE SKIP LOCKED", (PROJECTOR_NAME,))
+    checkpoint = read.fetchone()
+    if checkpoint is None:
+        read.close()
+        conn.rollback()
+        return 0, False
+    
+    execute_prepared(read, 'projector_events', EVENTS_BATCH_SQL, {
+        'after': checkpoint['last_event_id'],
+        'settle': PROJECTOR_SETTLE_SECONDS,
+        'limit': limit
+    })
+    rows = read.fetchall()
+    read.close()
+    
+    batch = []
+    expected = checkpoint['last_event_id'] + 1
+    for row in rows:
+        if row['event_id'] != expected and not row['settled']:
+            break
+        record = dict(row)
+        del record['settled']
+        record['received_at'] = record['received_at'].isoformat()
+        batch.append(record)
+        expected = row['event_id'] + 1
+    caught_up = len(batch) == len(rows) and len(rows) < limit
+    if not batch:
+        conn.rollback()
+        return 0, caught_up
+    
+    cur = conn.cursor()
+    try:
+        user_ids = apply_batch(cur, batch)
+    except Exception as error:
+        cur.close()
+        conn.rollback()
+        if _transient_error(error):
+            raise
+        raise ProjectionFailed(batch, error) from error
+    execute_prepared(
+        cur,
+        'projector_advance',
+        "UPDATE projector_checkpoints SET last_event_id = %s, events_projected = events_projected + %s, updated_at = now() WHERE name = %s",
+        (batch[-1]['event_id'], len(batch), PROJECTOR_NAME)
     )
+    conn.commit()
+    cur.close()
+    bump_data_version(conn)
+    
+    if log:
+        for r in batch:
+            log_event(user_ids[int(r['telegram_id'])], 'message_received', dict(message_event_data(r), event_id=r['event_id']), r['response_time_ms'])
+    return len(batch), caught_up
+
+def quarantine_event(conn, event_id, error):
+    '''
+    Переносит событие в ingest_events_quarantine и сдвигает чекпоинт за него; если чекпоинт уже дальше
+    (событие перенёс параллельный проектор), ничего не делает
+    '''
+    with conn.cursor() as cur:
+        cur.execute(
+            "UPDATE projector_checkpoints SET last_event_id = %s, updated_at = now() WHERE name = %s AND last_event_id < %s",
+            (event_id, PROJECTOR_NAME, event_id)
+        )
+        moved = cur.rowcount == 1
+        if moved:
+            cur.execute(QUARANTINE_SQL, {'event_id': event_id, 'error': str(error)})
+    conn.commit()
+    if moved:
+        projector_stats['quarantined'] += 1
+        print(json.dumps({'metric': 'projector_quarantined', 'event_id': event_id, 'error': str(error)}))
+    return moved
+
+def project_next(log=True):
+    '''
+    Один батч проектора. Батч, который не применяется из-за данных, делится пополам до одного события,
+    и оно уходит в карантин: одно плохое событие больше не держит чекпоинт. Возвращает как project_events.
+    '''
+    limit = PROJECTOR_BATCH_SIZE
+    while True:
+        try:
+            with db_connection() as conn:
+                return project_events(conn, limit, log)
+        except ProjectionFailed as failure:
+            if len(failure.batch) > 1:
+                limit = len(failure.batch) // 2
+                continue
+            with db_connection() as conn:
+                quarantine_event(conn, failure.batch[0]['event_id'], failure.error)
+            limit = PROJECTOR_BATCH_SIZE
+
+def run_projector(max_batches=PROJECTOR_MAX_BATCHES):
+    '''До max_batches батчей проектора подряд; если хвост упёрся в дырку в id, повтор через PROJECTOR_SETTLE_SECONDS'''
+    if not _projector_lock.acquire(blocking=False):
+        return 0
+    projected = 0
+    caught_up = True
+    try:
+        projector_stats['runs'] += 1
+        for _ in range(max_batches):
+            count, caught_up = project_next()
+            projected += count
+            if caught_up or count == 0:
+                break
+    except Exception as error:
+        projector_stats['failed'] += 1
+        print(json.dumps({'metric': 'projector_failed', 'projected': projected, 'error': str(error)}))
+    finally:
+        projector_stats['projected'] += projected
+        _projector_lock.release()
+    if not caught_up:
+        schedule_projection(PROJECTOR_SETTLE_SECONDS)
+    return projected
+
+def _projector_timer():
+    with _projector_schedule_lock:
+        _projector_state['timer'] = None
+    try:
+        with admission('background'):
+            run_projector()
+    except AdmissionRejected:
+        schedule_projection(PROJECTOR_SETTLE_SECONDS)
+
+def schedule_projection(delay):
+    '''Запускает проектор в фоне через delay секунд, если запуск ещё не запланирован (по крону — GET ?action=project с X-Api-Key)'''
+    with _projector_schedule_lock:
+        if _projector_state['timer'] is not None:
+            return
+        timer = threading.Timer(delay, _projector_timer)
+        timer.daemon = True
+        _projector_state['timer'] = timer
+        timer.start()
+
+REPLAYED_SESSIONS_SQL = (
+    "SELECT COUNT(*) AS users, COALESCE(SUM(e.total_sessions), 0) AS sessions, " +
+    "COUNT(*) FILTER (WHERE e.total_sessions = 0 OR e.session_started_at IS NULL) AS users_without_sessions " +
+    "FROM users_enhanced e WHERE e.telegram_user_id IN (SELECT DISTINCT telegram_id FROM ingest_events)"
+)
 
+def rebuild_projections():
+    '''
+    Пересборка read-моделей: reset_event_projections() удаляет строки из событий и вычитает их вклад из агрегатов
+    (отказывается, если секции с ними отсоединены), затем события проецируются заново батчами без повторной записи
+    в event_logs. Возвращает (число событий, сводка сессий пересобранных пользователей).
+    '''
+    with _projector_lock:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT reset_event_projections(%s)", (SESSION_GAP_MINUTES,))
+            conn.commit()
+            bump_data_version(conn)
+        
+        projected = 0
+        while True:
+            count, caught_up = project_next(log=False)
+            projected += count
+            if caught_up or count == 0:
+                break
+        projector_stats['rebuilds'] += 1
+    
+    with db_connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(REPLAYED_SESSIONS_SQL)
+            sessions = dict(cur.fetchone())
+        conn.rollback()
+    return projected, sessions
+
+def _idempotency_key(event, body_data):
+    '''
+    Ключ идемпотентности: Idempotency-Key, затем idempotency_key/update_id из тела, иначе sha256 тела
+    в каноническом JSON — повтор того же запроса ботом получает тот же ключ и отсеивается
+    '''
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    key = headers.get('idempotency-key') or body_data.get('idempotency_key') or body_data.get('update_id')
+    if key:
+        return str(key)[:128]
+    canonical = json.dumps(body_data, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return 'body-' + hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+@traced
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Receives dialog data from Telegram bot and stores in database
-    Args: event - dict with httpMethod, body (JSON with user_id, telegram_id, name, tokens, model, premium)
+    Args: event - dict with httpMethod, body (JSON with user_id, telegram_id, name, tokens, prompt_tokens, completion_tokens, model, premium);
+                  GET queryStringParameters action=project|rebuild runs the ingest_events projector (X-Api-Key required)
           context - object with request_id attribute
     Returns: HTTP response dict with success/error status
     '''
@@ -42,113 +1461,70 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     if method == 'POST':
         start_time = time.time()
-        body_data = json.loads(event.get('body', '{}'))
-        
-        telegram_id = body_data.get('telegram_id')
-        name = body_data.get('name', 'Пользователь')
-        username = body_data.get('username')
-        tokens = body_data.get('tokens', 0)
-        model = body_data.get('model', 'GPT-3.5')
-        premium = body_data.get('premium', False)
-        email = body_data.get('email')
-        user_message = body_data.get('user_message')
-        assistant_message = body_data.get('assistant_message')
-        interaction_type = body_data.get('interaction_type', 'chat')
-        
-        if not telegram_id:
+        try:
+            body_data = json.loads(event.get('body') or '{}')
+            payload = parse_payload(body_data)
+        except ValueError as error:
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'telegram_id is required'}),
+                'body': json.dumps({'error': str(error)}),
                 'isBase64Encoded': False
             }
         
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cur.execute(
-            "SELECT id, total_tokens, dialogs_count FROM users WHERE telegram_id = " + str(telegram_id)
-        )
-        user = cur.fetchone()
-        
-        if user:
-            user_id = user['id']
-            new_total_tokens = user['total_tokens'] + tokens
-            new_dialogs_count = user['dialogs_count'] + 1
+        if WEBHOOK_INGEST_MODE == 'buffered':
+            payload['idempotency_key'] = _idempotency_key(event, body_data)
+            payload['received_at'] = datetime.now().isoformat()
+            payload['response_time_ms'] = int((time.time() - start_time) * 1000) or None
+            if spool_payload(payload):
+                # Ответ боту не ждёт занятой полосы background: батч останется в spool до таймера
+                flush_spool(timeout=0)
             
-            cur.execute(
-                "UPDATE users SET total_tokens = " + str(new_total_tokens) + ", dialogs_count = " + str(new_dialogs_count) + ", last_active = '" + datetime.now().isoformat() + "', premium = " + str(premium) + ", username = '" + (username.replace("'", "''") if username else '') + "' WHERE id = " + str(user_id)
-            )
-        else:
-            cur.execute(
-                "INSERT INTO users (telegram_id, name, username, email, premium, total_tokens, dialogs_count, last_active) VALUES (" + str(telegram_id) + ", '" + name.replace("'", "''") + "', '" + (username.replace("'", "''") if username else '') + "', " + ("'" + email.replace("'", "''") + "'" if email else 'NULL') + ", " + str(premium) + ", " + str(tokens) + ", 1, '" + datetime.now().isoformat() + "') RETURNING id"
-            )
-            user_id = cur.fetchone()['id']
-        
-        cur.execute(
-            "INSERT INTO dialogs (user_id, telegram_id, username, tokens, model, status, user_message, assistant_message, interaction_type, created_at, updated_at) VALUES (" + str(user_id) + ", " + str(telegram_id) + ", '" + (username.replace("'", "''") if username else '') + "', " + str(tokens) + ", '" + model.replace("'", "''") + "', 'Завершён', " + ("'" + user_message.replace("'", "''") + "'" if user_message else 'NULL') + ", " + ("'" + assistant_message.replace("'", "''") + "'" if assistant_message else 'NULL') + ", '" + interaction_type.replace("'", "''") + "', '" + datetime.now().isoformat() + "', '" + datetime.now().isoformat() + "') RETURNING id"
-        )
-        dialog_id = cur.fetchone()['id']
-        
-        today = datetime.now().date()
-        cur.execute(
-            "SELECT id, total_tokens, active_users FROM token_stats WHERE date = '" + str(today) + "'"
-        )
-        stats = cur.fetchone()
+            return {
+                'statusCode': 202,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'queued': True,
+                    'idempotency_key': payload['idempotency_key']
+                }),
+                'isBase64Encoded': False
+            }
         
-        if stats:
-            cur.execute(
-                "UPDATE token_stats SET total_tokens = total_tokens + " + str(tokens) + " WHERE date = '" + str(today) + "'"
-            )
-        else:
-            cur.execute(
-                "SELECT COUNT(DISTINCT telegram_id) as count FROM dialogs WHERE DATE(created_at) = '" + str(today) + "'"
-            )
-            active_count = cur.fetchone()['count']
+        if WEBHOOK_INGEST_MODE == 'events':
+            payload['idempotency_key'] = _idempotency_key(event, body_data)
+            payload['response_time_ms'] = int((time.time() - start_time) * 1000) or None
+            try:
+                with admission('ingest'):
+                    with db_connection() as conn:
+                        event_id = append_event(conn, payload)
+            except AdmissionRejected as rejection:
+                return rejected_response(rejection)
+            schedule_projection(WEBHOOK_FLUSH_MS / 1000.0)
             
-            cur.execute(
-                "INSERT INTO token_stats (date, total_tokens, active_users) VALUES ('" + str(today) + "', " + str(tokens) + ", " + str(active_count) + ")"
-            )
-        
-        response_time_ms = int((time.time() - start_time) * 1000)
-        
-        log_event(
-            cur, 
-            user_id, 
-            'message_received',
-            {
-                'user_message': user_message[:100] if user_message else None,
-                'assistant_message': assistant_message[:100] if assistant_message else None,
-                'tokens': tokens,
-                'model': model
-            },
-            response_time_ms=response_time_ms,
-            success=True
-        )
-        
-        if user_message:
-            cur.execute(
-                "INSERT INTO messages (user_id, message, sender, timestamp) VALUES (" + 
-                str(telegram_id) + ", '" + user_message.replace("'", "''") + "', 'user', '" + 
-                datetime.now().isoformat() + "')"
-            )
-        
-        if assistant_message:
-            cur.execute(
-                "INSERT INTO messages (user_id, message, sender, timestamp) VALUES (" + 
-                str(telegram_id) + ", '" + assistant_message.replace("'", "''") + "', 'bot', '" + 
-                datetime.now().isoformat() + "')"
-            )
-        
-        if tokens > 0:
-            cur.execute(
-                "INSERT INTO costs (user_id, tokens_used, date) VALUES (" + 
-                str(telegram_id) + ", " + str(tokens) + ", '" + str(datetime.now().date()) + "')"
-            )
+            return {
+                'statusCode': 202,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'queued': True,
+                    'duplicate': event_id is None,
+                    'event_id': event_id,
+                    'idempotency_key': payload['idempotency_key']
+                }),
+                'isBase64Encoded': False
+            }
         
-        conn.commit()
-        cur.close()
-        conn.close()
+        try:
+            with admission('ingest'):
+                with db_connection() as conn:
+                    if WEBHOOK_INGEST_MODE == 'legacy':
+                        dialog_id, user_id = ingest_legacy(conn, payload, start_time)
+                    else:
+                        dialog_id, user_id = ingest_single_statement(conn, payload, start_time)
+        except AdmissionRejected as rejection:
+            return rejected_response(rejection)
+        log_event(user_id, 'message_received', message_event_data(payload), int((time.time() - start_time) * 1000) or None)
         
         return {
             'statusCode': 200,
@@ -162,10 +1538,61 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     if method == 'GET':
+        params = event.get('queryStringParameters') or {}
+        action = params.get('action')
+        
+        if action in ('project', 'rebuild'):
+            headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+            if not PROJECTOR_REBUILD_KEY or headers.get('x-api-key') != PROJECTOR_REBUILD_KEY:
+                return {
+                    'statusCode': 403,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': action + ' requires X-Api-Key matching PROJECTOR_REBUILD_KEY'}),
+                    'isBase64Encoded': False
+                }
+        
+        if action == 'project':
+            try:
+                with admission('control'):
+                    projected = run_projector()
+            except AdmissionRejected as rejection:
+                return rejected_response(rejection)
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'projected': projected, 'projector': projector_stats}),
+                'isBase64Encoded': False
+            }
+        
+        if action == 'rebuild':
+            try:
+                with admission('control'):
+                    projected, sessions = rebuild_projections()
+            except AdmissionRejected as rejection:
+                return rejected_response(rejection)
+            except psycopg2.errors.ObjectNotInPrerequisiteState as error:
+                return {
+                    'statusCode': 409,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': error.diag.message_primary}),
+                    'isBase64Encoded': False
+                }
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'rebuilt': True, 'projected': projected, 'sessions': sessions, 'projector': projector_stats}),
+                'isBase64Encoded': False
+            }
+        
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'status': 'Bot webhook API is running'}),
+            'body': json.dumps({
+                'status': 'Bot webhook API is running',
+                'event_log': dict(event_stats, queued=_event_queue.qsize()),
+                'projector': projector_stats,
+                'admission': admission_snapshot()
+            }),
             'isBase64Encoded': False
         }
     
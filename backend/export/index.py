@@ -0,0 +1,382 @@
+import bisect
+import cProfile
+import csv
+import functools
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, Any
+import psycopg2
+import psycopg2.pool
+from psycopg2.extras import execute_values
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_POOL_CHECK_IDLE = float(os.environ.get('DB_POOL_CHECK_IDLE', '30'))
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+METRICS_FUNCTION = 'export'
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '60'))
+PROFILE_TOP = int(os.environ.get('PROFILE_TOP', '40'))
+EXPORT_ITERSIZE = int(os.environ.get('EXPORT_ITERSIZE', '2000'))
+EXPORT_MAX_ROWS = int(os.environ.get('EXPORT_MAX_ROWS', '50000'))
+MAX_TOP = 1000
+
+EXPORT_TABLES = {
+    'users': ('id', 'telegram_id', 'name', 'username', 'email', 'premium', 'total_tokens', 'dialogs_count', 'created_at', 'last_active'),
+    'dialogs': ('id', 'user_id', 'telegram_id', 'username', 'tokens', 'model', 'status', 'interaction_type', 'user_message', 'assistant_message', 'created_at', 'updated_at'),
+    'messages': ('id', 'user_id', 'message', 'sender', 'timestamp', 'quality_score')
+}
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8'
+}
+
+_pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+_pool_lock = threading.Lock()
+_pool_idle = []
+pool_stats = {'acquired': 0, 'created': 0, 'reconnects': 0, 'timeouts': 0, 'wait_ms_total': 0.0, 'wait_ms_max': 0.0}
+
+_trace = threading.local()
+_latency_lock = threading.Lock()
+_latency_flush = {'at': time.monotonic()}
+_latency_pending = {}
+latency_stats = {}
+_profile_lock = threading.Lock()
+
+def _connection_alive(conn, idle_seconds):
+    '''Проверяет соединение из пула перед выдачей (SELECT 1 после долгого простоя)'''
+    if conn.closed:
+        return False
+    if idle_seconds < DB_POOL_CHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+def get_db_connection():
+    '''Берёт соединение из тёплого пула модуля, который переживает вызовы функции'''
+    wait_start = time.perf_counter()
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        with _pool_lock:
+            pool_stats['timeouts'] += 1
+        raise psycopg2.pool.PoolError('Connection pool exhausted after ' + str(DB_POOL_TIMEOUT) + 's')
+    wait_ms = (time.perf_counter() - wait_start) * 1000
+    
+    conn = None
+    while conn is None:
+        with _pool_lock:
+            idle = _pool_idle.pop() if _pool_idle else None
+        if idle is None:
+            break
+        candidate, released_at = idle
+        if _connection_alive(candidate, time.monotonic() - released_at):
+            conn = candidate
+        else:
+            with _pool_lock:
+                pool_stats['reconnects'] += 1
+            _close_quietly(candidate)
+    
+    if conn is None:
+        try:
+            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        except Exception:
+            _pool_slots.release()
+            raise
+        with _pool_lock:
+            pool_stats['created'] += 1
+    
+    with _pool_lock:
+        pool_stats['acquired'] += 1
+        pool_stats['wait_ms_total'] += wait_ms
+        pool_stats['wait_ms_max'] = max(pool_stats['wait_ms_max'], wait_ms)
+    record_span('connect', (time.perf_counter() - wait_start) * 1000)
+    return conn
+
+def release_db_connection(conn, broken=False):
+    '''Возвращает соединение в пул; сломанные соединения закрываются'''
+    try:
+        if not broken and not conn.closed:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            with _pool_lock:
+                _pool_idle.append((conn, time.monotonic()))
+            return
+    except psycopg2.Error:
+        pass
+    finally:
+        _pool_slots.release()
+    _close_quietly(conn)
+
+@contextmanager
+def db_connection():
+    '''Соединение из пула на время запроса с автоматическим возвратом'''
+    conn = get_db_connection()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        release_db_connection(conn, broken)
+
+LATENCY_FLUSH_SQL = (
+    "INSERT INTO latency_histograms (function, span, minute, count, total_ms, max_ms, buckets) VALUES %s " +
+    "ON CONFLICT (function, span, minute) DO UPDATE SET count = latency_histograms.count + EXCLUDED.count, " +
+    "total_ms = latency_histograms.total_ms + EXCLUDED.total_ms, max_ms = GREATEST(latency_histograms.max_ms, EXCLUDED.max_ms), " +
+    "buckets = latency_add_buckets(latency_histograms.buckets, EXCLUDED.buckets)"
+)
+
+def record_span(name, elapsed_ms):
+    '''Добавляет время участка к спанам текущего запроса (повторы суммируются); вне запроса — сразу в гистограмму'''
+    spans = getattr(_trace, 'spans', None)
+    if spans is None:
+        record_latency(name, elapsed_ms)
+    else:
+        spans[name] = spans.get(name, 0.0) + elapsed_ms
+
+@contextmanager
+def span(name):
+    '''Замеряет участок обработки запроса'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, (time.perf_counter() - start) * 1000)
+
+def record_latency(name, elapsed_ms):
+    '''Гистограмма спана по верхним границам LATENCY_BUCKETS_MS (последняя корзина — всё, что дольше): в памяти и в дельте до сброса в БД'''
+    bucket = bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)
+    with _latency_lock:
+        for stats_by_span in (latency_stats, _latency_pending):
+            stats = stats_by_span.get(name)
+            if stats is None:
+                stats = stats_by_span[name] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+            stats['count'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['buckets'][bucket] += 1
+
+def flush_latency_stats(force=False):
+    '''Не чаще METRICS_FLUSH_INTERVAL дописывает накопленные гистограммы в latency_histograms (их читает функция metrics) и пишет в лог счётчики пула'''
+    with _latency_lock:
+        if not _latency_pending or (not force and time.monotonic() - _latency_flush['at'] < METRICS_FLUSH_INTERVAL):
+            return 0
+        pending = dict(_latency_pending)
+        _latency_pending.clear()
+        _latency_flush['at'] = time.monotonic()
+    with _pool_lock:
+        pool = dict(pool_stats, idle=len(_pool_idle), size=DB_POOL_SIZE)
+    print(json.dumps({'metric': 'db_pool', 'function': METRICS_FUNCTION, **pool}))
+    
+    rows = [(METRICS_FUNCTION, name, stats['count'], stats['total_ms'], stats['max_ms'], stats['buckets']) for name, stats in pending.items()]
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                execute_values(cur, LATENCY_FLUSH_SQL, rows, template="(%s, %s, date_trunc('minute', now()), %s, %s, %s, %s)")
+            conn.commit()
+    except psycopg2.Error as error:
+        print(json.dumps({'metric': 'latency_flush_failed', 'spans': len(rows), 'error': str(error)}))
+        return 0
+    return len(rows)
+
+def server_timing(spans):
+    return ', '.join(name + ';dur=' + str(round(ms, 1)) for name, ms in spans.items())
+
+def dump_profile(profiler, context, spans):
+    '''Пишет в лог топ PROFILE_TOP функций профиля запроса по cumulative time вместе с его спанами'''
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_TOP)
+    print(json.dumps({
+        'metric': 'profile',
+        'function': METRICS_FUNCTION,
+        'request_id': getattr(context, 'request_id', None),
+        'spans': {name: round(ms, 3) for name, ms in spans.items()},
+        'profile': report.getvalue()
+    }, ensure_ascii=False))
+
+def traced(handler_fn):
+    '''
+    Оборачивает handler: спаны запроса (connect, sql.*, serialize, total) уходят в Server-Timing и гистограммы.
+    С ?profile=1 запрос дополнительно профилируется cProfile (по одному за раз) и профиль пишется в лог.
+    '''
+    @functools.wraps(handler_fn)
+    def wrapper(event, context):
+        params = event.get('queryStringParameters') or {}
+        profiler = None
+        if params.get('profile') == '1' and _profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+        
+        _trace.spans = {}
+        start = time.perf_counter()
+        try:
+            if profiler is None:
+                response = handler_fn(event, context)
+            else:
+                response = profiler.runcall(handler_fn, event, context)
+        finally:
+            spans = _trace.spans
+            _trace.spans = None
+            spans['total'] = (time.perf_counter() - start) * 1000
+            for name, elapsed_ms in spans.items():
+                record_latency(name, elapsed_ms)
+            if profiler is not None:
+                _profile_lock.release()
+        
+        if profiler is not None:
+            dump_profile(profiler, context, spans)
+        headers = response.setdefault('headers', {})
+        headers['Server-Timing'] = server_timing(spans)
+        exposed = headers.get('Access-Control-Expose-Headers')
+        headers['Access-Control-Expose-Headers'] = exposed + ', Server-Timing' if exposed else 'Server-Timing'
+        flush_latency_stats()
+        return response
+    
+    return wrapper
+
+def _json_default(value):
+    '''Типы вне стандартного JSON: Decimal — число, дата и время — ISO 8601'''
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError('Object of type ' + type(value).__name__ + ' is not JSON serializable')
+
+def encode_json(value):
+    '''Сериализует тело ответа через orjson, если он установлен, иначе через json с теми же правилами'''
+    if orjson is not None:
+        return orjson.dumps(value, default=_json_default).decode()
+    return json.dumps(value, default=_json_default, ensure_ascii=False, separators=(',', ':'))
+
+def encode_chunk(columns, rows, fmt):
+    '''Кодирует порцию строк в NDJSON или CSV'''
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerows(rows)
+        return buffer.getvalue()
+    return ''.join(encode_json(dict(zip(columns, row))) + '\n' for row in rows)
+
+def export_chunks(conn, table, fmt, stats, after_id=0, limit=EXPORT_MAX_ROWS, top=None):
+    '''
+    Читает таблицу именованным (серверным) курсором по EXPORT_ITERSIZE строк и отдаёт текст порциями.
+    В памяти одновременно только одна порция; в stats пишутся число строк и последний id.
+    '''
+    columns = EXPORT_TABLES[table]
+    query = "SELECT " + ', '.join(columns) + " FROM " + table
+    if top:
+        query += " ORDER BY total_tokens DESC, id LIMIT %(limit)s"
+    else:
+        query += " WHERE id > %(after_id)s ORDER BY id LIMIT %(limit)s"
+    
+    cur = conn.cursor(name='export_' + table)
+    cur.itersize = EXPORT_ITERSIZE
+    with span('sql.export_' + table):
+        cur.execute(query, {'after_id': after_id, 'limit': top or limit})
+    
+    if fmt == 'csv':
+        yield encode_chunk(columns, [columns], fmt)
+    stats.update({'rows': 0, 'last_id': after_id})
+    while True:
+        with span('sql.export_fetch'):
+            rows = cur.fetchmany(EXPORT_ITERSIZE)
+        if not rows:
+            break
+        stats['rows'] += len(rows)
+        stats['last_id'] = rows[-1][0]
+        with span('serialize'):
+            chunk = encode_chunk(columns, rows, fmt)
+        yield chunk
+    cur.close()
+
+@traced
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Exports users, dialogs or messages as NDJSON or CSV in id-ordered chunks, or top users by tokens
+    Args: event with httpMethod, queryStringParameters (table, format, after_id, limit, top); context with request_id
+    Returns: HTTP response with the exported rows; X-Next-After-Id points to the next chunk
+    '''
+    method: str = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    if method == 'GET':
+        params = event.get('queryStringParameters') or {}
+        table = params.get('table', 'users')
+        fmt = params.get('format', 'ndjson')
+        try:
+            after_id = int(params.get('after_id', 0))
+            limit = min(int(params.get('limit', EXPORT_MAX_ROWS)), EXPORT_MAX_ROWS)
+            top = int(params['top']) if params.get('top') else None
+            if table not in EXPORT_TABLES or fmt not in EXPORT_FORMATS or after_id < 0 or limit < 1:
+                raise ValueError
+            if top is not None and (table != 'users' or not 1 <= top <= MAX_TOP):
+                raise ValueError
+        except ValueError:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'error': 'table must be one of ' + ', '.join(EXPORT_TABLES) + ', format one of ' + ', '.join(EXPORT_FORMATS) +
+                    '; after_id, limit and top (users only, up to ' + str(MAX_TOP) + ') must be positive integers'
+                }),
+                'isBase64Encoded': False
+            }
+        
+        with db_connection() as conn:
+            stats = {}
+            body = ''.join(export_chunks(conn, table, fmt, stats, after_id, limit, top))
+        
+        headers = {
+            'Content-Type': EXPORT_FORMATS[fmt],
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'X-Row-Count, X-Next-After-Id',
+            'X-Row-Count': str(stats['rows'])
+        }
+        if not top and stats['rows'] == limit:
+            headers['X-Next-After-Id'] = str(stats['last_id'])
+        
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': body,
+            'isBase64Encoded': False
+        }
+    
+    return {
+        'statusCode': 405,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'error': 'Method not allowed'}),
+        'isBase64Encoded': False
+    }
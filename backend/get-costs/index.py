@@ -1,19 +1,424 @@
+import bisect
+import cProfile
+import functools
+import hashlib
+import io
 import json
 import os
-from datetime import date
+import pstats
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 from typing import Dict, Any
+from urllib.parse import urlencode
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.pool
+from psycopg2.extras import RealDictCursor, execute_values
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_POOL_CHECK_IDLE = float(os.environ.get('DB_POOL_CHECK_IDLE', '30'))
+STATEMENT_PREPARED_MAX = int(os.environ.get('STATEMENT_PREPARED_MAX', '64'))
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+METRICS_FUNCTION = 'get-costs'
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '60'))
+PROFILE_TOP = int(os.environ.get('PROFILE_TOP', '40'))
+CACHE_TTL = float(os.environ.get('CACHE_TTL', '30'))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', '128'))
+CACHE_VERSION_CHECK_INTERVAL = float(os.environ.get('CACHE_VERSION_CHECK_INTERVAL', '1'))
+CACHE_SQLITE_PATH = os.environ.get('CACHE_SQLITE_PATH')
+CACHE_ENDPOINT = 'get-costs'
+MAX_RANGE_DAYS = 366
+
+COSTS_ROLLUP_QUERY = (
+    "SELECT day, NULLIF(model, '') as model, tokens_used as total, prompt_tokens as prompt, completion_tokens as completion, " +
+    "cost_dollars as cost, records_count as records FROM cost_rollups " +
+    "WHERE day >= %(start)s AND day < %(end)s AND records_count > 0 ORDER BY day, model"
+)
+
+_pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+_pool_lock = threading.Lock()
+_pool_idle = []
+pool_stats = {'acquired': 0, 'created': 0, 'reconnects': 0, 'timeouts': 0, 'wait_ms_total': 0.0, 'wait_ms_max': 0.0}
+
+_trace = threading.local()
+_latency_lock = threading.Lock()
+_latency_flush = {'at': time.monotonic()}
+_latency_pending = {}
+latency_stats = {}
+_profile_lock = threading.Lock()
+
+_statement_sql = {}
+_PLACEHOLDER_RE = re.compile(r'%\((\w+)\)s|%s')
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_db = None
+_data_version = {'value': None, 'checked_at': 0.0}
+
+def _connection_alive(conn, idle_seconds):
+    '''Проверяет соединение из пула перед выдачей (SELECT 1 после долгого простоя)'''
+    if conn.closed:
+        return False
+    if idle_seconds < DB_POOL_CHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+class PreparedConnection(psycopg2.extensions.connection):
+    '''Соединение пула, которое помнит свои серверные prepared statements'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
 
 def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    '''Берёт соединение из тёплого пула модуля, который переживает вызовы функции'''
+    wait_start = time.perf_counter()
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        with _pool_lock:
+            pool_stats['timeouts'] += 1
+        raise psycopg2.pool.PoolError('Connection pool exhausted after ' + str(DB_POOL_TIMEOUT) + 's')
+    wait_ms = (time.perf_counter() - wait_start) * 1000
+    
+    conn = None
+    while conn is None:
+        with _pool_lock:
+            idle = _pool_idle.pop() if _pool_idle else None
+        if idle is None:
+            break
+        candidate, released_at = idle
+        if _connection_alive(candidate, time.monotonic() - released_at):
+            conn = candidate
+        else:
+            with _pool_lock:
+                pool_stats['reconnects'] += 1
+            _close_quietly(candidate)
+    
+    if conn is None:
+        try:
+            conn = psycopg2.connect(os.environ['DATABASE_URL'], connection_factory=PreparedConnection)
+        except Exception:
+            _pool_slots.release()
+            raise
+        with _pool_lock:
+            pool_stats['created'] += 1
+    
+    with _pool_lock:
+        pool_stats['acquired'] += 1
+        pool_stats['wait_ms_total'] += wait_ms
+        pool_stats['wait_ms_max'] = max(pool_stats['wait_ms_max'], wait_ms)
+    record_span('connect', (time.perf_counter() - wait_start) * 1000)
+    return conn
+
+def release_db_connection(conn, broken=False):
+    '''Возвращает соединение в пул; сломанные соединения закрываются'''
+    try:
+        if not broken and not conn.closed:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            with _pool_lock:
+                _pool_idle.append((conn, time.monotonic()))
+            return
+    except psycopg2.Error:
+        pass
+    finally:
+        _pool_slots.release()
+    _close_quietly(conn)
+
+@contextmanager
+def db_connection():
+    '''Соединение из пула на время запроса с автоматическим возвратом'''
+    conn = get_db_connection()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        release_db_connection(conn, broken)
+
+LATENCY_FLUSH_SQL = (
+    "INSERT INTO latency_histograms (function, span, minute, count, total_ms, max_ms, buckets) VALUES %s " +
+    "ON CONFLICT (function, span, minute) DO UPDATE SET count = latency_histograms.count + EXCLUDED.count, " +
+    "total_ms = latency_histograms.total_ms + EXCLUDED.total_ms, max_ms = GREATEST(latency_histograms.max_ms, EXCLUDED.max_ms), " +
+    "buckets = latency_add_buckets(latency_histograms.buckets, EXCLUDED.buckets)"
+)
+
+def record_span(name, elapsed_ms):
+    '''Добавляет время участка к спанам текущего запроса (повторы суммируются); вне запроса — сразу в гистограмму'''
+    spans = getattr(_trace, 'spans', None)
+    if spans is None:
+        record_latency(name, elapsed_ms)
+    else:
+        spans[name] = spans.get(name, 0.0) + elapsed_ms
+
+@contextmanager
+def span(name):
+    '''Замеряет участок обработки запроса'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, (time.perf_counter() - start) * 1000)
+
+def record_latency(name, elapsed_ms):
+    '''Гистограмма спана по верхним границам LATENCY_BUCKETS_MS (последняя корзина — всё, что дольше): в памяти и в дельте до сброса в БД'''
+    bucket = bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)
+    with _latency_lock:
+        for stats_by_span in (latency_stats, _latency_pending):
+            stats = stats_by_span.get(name)
+            if stats is None:
+                stats = stats_by_span[name] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+            stats['count'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['buckets'][bucket] += 1
+
+def flush_latency_stats(force=False):
+    '''Не чаще METRICS_FLUSH_INTERVAL дописывает накопленные гистограммы в latency_histograms (их читает функция metrics) и пишет в лог счётчики пула'''
+    with _latency_lock:
+        if not _latency_pending or (not force and time.monotonic() - _latency_flush['at'] < METRICS_FLUSH_INTERVAL):
+            return 0
+        pending = dict(_latency_pending)
+        _latency_pending.clear()
+        _latency_flush['at'] = time.monotonic()
+    with _pool_lock:
+        pool = dict(pool_stats, idle=len(_pool_idle), size=DB_POOL_SIZE)
+    print(json.dumps({'metric': 'db_pool', 'function': METRICS_FUNCTION, **pool}))
+    
+    rows = [(METRICS_FUNCTION, name, stats['count'], stats['total_ms'], stats['max_ms'], stats['buckets']) for name, stats in pending.items()]
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                execute_values(cur, LATENCY_FLUSH_SQL, rows, template="(%s, %s, date_trunc('minute', now()), %s, %s, %s, %s)")
+            conn.commit()
+    except psycopg2.Error as error:
+        print(json.dumps({'metric': 'latency_flush_failed', 'spans': len(rows), 'error': str(error)}))
+        return 0
+    return len(rows)
+
+def server_timing(spans):
+    return ', '.join(name + ';dur=' + str(round(ms, 1)) for name, ms in spans.items())
+
+def dump_profile(profiler, context, spans):
+    '''Пишет в лог топ PROFILE_TOP функций профиля запроса по cumulative time вместе с его спанами'''
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_TOP)
+    print(json.dumps({
+        'metric': 'profile',
+        'function': METRICS_FUNCTION,
+        'request_id': getattr(context, 'request_id', None),
+        'spans': {name: round(ms, 3) for name, ms in spans.items()},
+        'profile': report.getvalue()
+    }, ensure_ascii=False))
+
+def traced(handler_fn):
+    '''
+    Оборачивает handler: спаны запроса (connect, sql.*, serialize, total) уходят в Server-Timing и гистограммы.
+    С ?profile=1 запрос дополнительно профилируется cProfile (по одному за раз) и профиль пишется в лог.
+    '''
+    @functools.wraps(handler_fn)
+    def wrapper(event, context):
+        params = event.get('queryStringParameters') or {}
+        profiler = None
+        if params.get('profile') == '1' and _profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+        
+        _trace.spans = {}
+        start = time.perf_counter()
+        try:
+            if profiler is None:
+                response = handler_fn(event, context)
+            else:
+                response = profiler.runcall(handler_fn, event, context)
+        finally:
+            spans = _trace.spans
+            _trace.spans = None
+            spans['total'] = (time.perf_counter() - start) * 1000
+            for name, elapsed_ms in spans.items():
+                record_latency(name, elapsed_ms)
+            if profiler is not None:
+                _profile_lock.release()
+        
+        if profiler is not None:
+            dump_profile(profiler, context, spans)
+        headers = response.setdefault('headers', {})
+        headers['Server-Timing'] = server_timing(spans)
+        exposed = headers.get('Access-Control-Expose-Headers')
+        headers['Access-Control-Expose-Headers'] = exposed + ', Server-Timing' if exposed else 'Server-Timing'
+        flush_latency_stats()
+        return response
+    
+    return wrapper
+
+def _server_statement(label, sql):
+    '''Имя prepared statement (метка + хэш текста), текст с $n вместо %(name)s / %s и порядок параметров'''
+    statement = _statement_sql.get(sql)
+    if statement is None:
+        names = []
+        
+        def number(match):
+            name = match.group(1)
+            if name is None or name not in names:
+                names.append(name)
+                return '$' + str(len(names))
+            return '$' + str(names.index(name) + 1)
+        
+        text = _PLACEHOLDER_RE.sub(number, sql).replace('%%', '%')
+        statement = (label + '_' + hashlib.md5(sql.encode()).hexdigest()[:10], text, names)
+        _statement_sql[sql] = statement
+    return statement
+
+def execute_prepared(cur, label, sql, params=None):
+    '''
+    Выполняет запрос как prepared statement соединения: PREPARE при первом вызове, дальше только EXECUTE
+    без повторного разбора. Сверх STATEMENT_PREPARED_MAX на соединение — обычный execute. Время идёт в спан sql.<label>.
+    '''
+    name, text, names = _server_statement(label, sql)
+    prepared = cur.connection.prepared
+    start = time.perf_counter()
+    if name not in prepared and len(prepared) < STATEMENT_PREPARED_MAX:
+        cur.execute('PREPARE ' + name + ' AS ' + text)
+        prepared.add(name)
+    if name in prepared:
+        values = [params[n] for n in names] if isinstance(params, dict) else list(params or ())
+        if values:
+            cur.execute('EXECUTE ' + name + ' (' + ', '.join(['%s'] * len(values)) + ')', values)
+        else:
+            cur.execute('EXECUTE ' + name)
+    else:
+        cur.execute(sql, params)
+    record_span('sql.' + label, (time.perf_counter() - start) * 1000)
+
+def parse_date_range(params):
+    '''Разбирает from/to (YYYY-MM-DD, включительно) в полуоткрытый интервал [start, end); по умолчанию — сегодня'''
+    date_to = date.fromisoformat(params['to']) if params.get('to') else date.today()
+    date_from = date.fromisoformat(params['from']) if params.get('from') else date_to
+    if date_from > date_to or (date_to - date_from).days >= MAX_RANGE_DAYS:
+        raise ValueError('from must not be after to and the range must be under ' + str(MAX_RANGE_DAYS) + ' days')
+    return date_from, date_to, date_to + timedelta(days=1)
+
+def current_data_version():
+    '''Версия данных (data_version_seq), которую bot-webhook сдвигает после коммита каждой записи; перечитывается не чаще CACHE_VERSION_CHECK_INTERVAL'''
+    now = time.monotonic()
+    if _data_version['value'] is not None and now - _data_version['checked_at'] < CACHE_VERSION_CHECK_INTERVAL:
+        return _data_version['value']
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(cur, 'data_version', "SELECT last_value FROM data_version_seq")
+            version = cur.fetchone()[0]
+    _data_version.update({'value': version, 'checked_at': now})
+    return version
+
+def _cache_sqlite():
+    global _cache_db
+    if _cache_db is None and CACHE_SQLITE_PATH:
+        _cache_db = sqlite3.connect(CACHE_SQLITE_PATH, check_same_thread=False)
+        _cache_db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, version INTEGER, expires_at REAL, body TEXT, etag TEXT)")
+    return _cache_db
+
+def cache_key(params):
+    '''Ключ кэша: функция + текущая дата (для относительных диапазонов) + отсортированные параметры запроса'''
+    return CACHE_ENDPOINT + '|' + str(date.today()) + '|' + urlencode(sorted(params.items()))
+
+def cache_get(key, version):
+    '''Ищет ответ в LRU процесса, затем в SQLite; годится только запись той же версии данных и не старше TTL'''
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry and entry['version'] == version and entry['expires_at'] > time.time():
+            _cache.move_to_end(key)
+            return entry
+        db = _cache_sqlite()
+        if db is None:
+            return None
+        row = db.execute("SELECT version, expires_at, body, etag FROM responses WHERE key = ?", (key,)).fetchone()
+        if not row or row[0] != version or row[1] <= time.time():
+            return None
+        entry = {'version': row[0], 'expires_at': row[1], 'body': row[2], 'etag': row[3]}
+        _cache[key] = entry
+        if len(_cache) > CACHE_MAX_ENTRIES:
+            _cache.popitem(last=False)
+        return entry
+
+def cache_put(key, version, body):
+    entry = {
+        'version': version,
+        'expires_at': time.time() + CACHE_TTL,
+        'body': body,
+        'etag': '"' + hashlib.sha1(body.encode()).hexdigest() + '"'
+    }
+    with _cache_lock:
+        _cache[key] = entry
+        _cache.move_to_end(key)
+        if len(_cache) > CACHE_MAX_ENTRIES:
+            _cache.popitem(last=False)
+        db = _cache_sqlite()
+        if db is not None:
+            db.execute("INSERT OR REPLACE INTO responses (key, version, expires_at, body, etag) VALUES (?, ?, ?, ?, ?)", (key, version, entry['expires_at'], body, entry['etag']))
+            db.commit()
+    return entry
+
+def cached_response(event, entry):
+    '''200 с телом и ETag или 304, если клиент прислал тот же ETag в If-None-Match'''
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    response_headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+        'ETag': entry['etag'],
+        'Cache-Control': 'no-cache'
+    }
+    if entry['etag'] in [tag.strip() for tag in headers.get('if-none-match', '').split(',')]:
+        return {'statusCode': 304, 'headers': response_headers, 'body': '', 'isBase64Encoded': False}
+    return {'statusCode': 200, 'headers': response_headers, 'body': entry['body'], 'isBase64Encoded': False}
+
+def _json_default(value):
+    '''Типы вне стандартного JSON: Decimal — число, дата и время — ISO 8601'''
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError('Object of type ' + type(value).__name__ + ' is not JSON serializable')
 
+def encode_json(value):
+    '''Сериализует тело ответа через orjson, если он установлен, иначе через json с теми же правилами; время идёт в спан serialize'''
+    start = time.perf_counter()
+    if orjson is not None:
+        body = orjson.dumps(value, default=_json_default).decode()
+    else:
+        body = json.dumps(value, default=_json_default, ensure_ascii=False, separators=(',', ':'))
+    record_span('serialize', (time.perf_counter() - start) * 1000)
+    return body
+
+@traced
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Business: Returns token usage and costs for today
-    Args: event - dict with httpMethod
+    Business: Returns token usage and costs for a date range (today by default)
+    Args: event - dict with httpMethod, queryStringParameters (from, to as YYYY-MM-DD, inclusive)
           context - object with request_id attribute
-    Returns: HTTP response dict with token stats and cost in USD
+    Returns: HTTP response dict with token stats and cost in USD over the range, per day and per model (from cost_rollups)
     '''
     method: str = event.get('httpMethod', 'GET')
     
@@ -23,7 +428,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -31,31 +436,61 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     if method == 'GET':
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        today = date.today()
-        
-        cur.execute(
-            "SELECT SUM(tokens_used) as total, SUM(cost_dollars) as cost FROM costs WHERE date = '" + str(today) + "'"
-        )
-        
-        result = cur.fetchone()
-        total_tokens = int(result['total']) if result and result['total'] else 0
-        total_cost = float(result['cost']) if result and result['cost'] else 0.0
+        params = event.get('queryStringParameters') or {}
+        try:
+            date_from, date_to, date_end = parse_date_range(params)
+        except ValueError as error:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': str(error)}),
+                'isBase64Encoded': False
+            }
         
-        cur.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'date': str(today),
+        version = current_data_version()
+        key = cache_key(params)
+        entry = cache_get(key, version)
+        if entry is None:
+            with db_connection() as conn:
+                cur = conn.cursor(cursor_factory=RealDictCursor)
+                
+                execute_prepared(cur, 'costs_rollup', COSTS_ROLLUP_QUERY, {'start': date_from, 'end': date_end})
+                rows = cur.fetchall()
+                
+                cur.close()
+            
+            days = {}
+            models = {}
+            for row in rows:
+                day = days.setdefault(row['day'], {'total_tokens': 0, 'cost_usd': 0.0})
+                model = models.setdefault(row['model'], {'total_tokens': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cost_usd': 0.0, 'requests': 0})
+                for stats in (day, model):
+                    stats['total_tokens'] += int(row['total'] or 0)
+                    stats['cost_usd'] += float(row['cost'] or 0)
+                model['prompt_tokens'] += int(row['prompt'] or 0)
+                model['completion_tokens'] += int(row['completion'] or 0)
+                model['requests'] += int(row['records'])
+            
+            total_tokens = sum(day['total_tokens'] for day in days.values())
+            total_cost = sum(day['cost_usd'] for day in days.values())
+            daily = [{
+                'date': str(day),
+                'total_tokens': stats['total_tokens'],
+                'cost_usd': round(stats['cost_usd'], 4)
+            } for day, stats in sorted(days.items())]
+            by_model = [dict(stats, model=model, cost_usd=round(stats['cost_usd'], 4)) for model, stats in sorted(models.items(), key=lambda item: -item[1]['cost_usd'])]
+            
+            entry = cache_put(key, version, encode_json({
+                'date': str(date_to),
+                'from': str(date_from),
+                'to': str(date_to),
                 'total_tokens': total_tokens,
-                'cost_usd': round(total_cost, 4)
-            }),
-            'isBase64Encoded': False
-        }
+                'cost_usd': round(total_cost, 4),
+                'daily': daily if date_from != date_to else [],
+                'models': by_model
+            }))
+        
+        return cached_response(event, entry)
     
     return {
         'statusCode': 405,
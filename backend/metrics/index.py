@@ -0,0 +1,207 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Any
+import psycopg2
+import psycopg2.pool
+from psycopg2.extras import RealDictCursor
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_POOL_CHECK_IDLE = float(os.environ.get('DB_POOL_CHECK_IDLE', '30'))
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+DEFAULT_WINDOW_MINUTES = 60
+MAX_WINDOW_MINUTES = 7 * 24 * 60
+QUANTILES = (('p50_ms', 0.5), ('p95_ms', 0.95), ('p99_ms', 0.99))
+
+HISTOGRAMS_QUERY = (
+    "SELECT function, span, SUM(count)::bigint as count, SUM(total_ms) as total_ms, MAX(max_ms) as max_ms, " +
+    "latency_sum_buckets(buckets) as buckets FROM latency_histograms " +
+    "WHERE minute >= date_trunc('minute', now()) - make_interval(mins => %(minutes)s - 1) AND (%(function)s::text IS NULL OR function = %(function)s) " +
+    "AND (%(span)s::text IS NULL OR span = %(span)s) GROUP BY function, span ORDER BY function, span"
+)
+
+_pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+_pool_lock = threading.Lock()
+_pool_idle = []
+pool_stats = {'acquired': 0, 'created': 0, 'reconnects': 0, 'timeouts': 0, 'wait_ms_total': 0.0, 'wait_ms_max': 0.0}
+
+def _connection_alive(conn, idle_seconds):
+    '''Проверяет соединение из пула перед выдачей (SELECT 1 после долгого простоя)'''
+    if conn.closed:
+        return False
+    if idle_seconds < DB_POOL_CHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+def get_db_connection():
+    '''Берёт соединение из тёплого пула модуля, который переживает вызовы функции'''
+    wait_start = time.perf_counter()
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        with _pool_lock:
+            pool_stats['timeouts'] += 1
+        raise psycopg2.pool.PoolError('Connection pool exhausted after ' + str(DB_POOL_TIMEOUT) + 's')
+    wait_ms = (time.perf_counter() - wait_start) * 1000
+    
+    conn = None
+    while conn is None:
+        with _pool_lock:
+            idle = _pool_idle.pop() if _pool_idle else None
+        if idle is None:
+            break
+        candidate, released_at = idle
+        if _connection_alive(candidate, time.monotonic() - released_at):
+            conn = candidate
+        else:
+            with _pool_lock:
+                pool_stats['reconnects'] += 1
+            _close_quietly(candidate)
+    
+    if conn is None:
+        try:
+            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        except Exception:
+            _pool_slots.release()
+            raise
+        with _pool_lock:
+            pool_stats['created'] += 1
+    
+    with _pool_lock:
+        pool_stats['acquired'] += 1
+        pool_stats['wait_ms_total'] += wait_ms
+        pool_stats['wait_ms_max'] = max(pool_stats['wait_ms_max'], wait_ms)
+    return conn
+
+def release_db_connection(conn, broken=False):
+    '''Возвращает соединение в пул; сломанные соединения закрываются'''
+    try:
+        if not broken and not conn.closed:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            with _pool_lock:
+                _pool_idle.append((conn, time.monotonic()))
+            return
+    except psycopg2.Error:
+        pass
+    finally:
+        _pool_slots.release()
+    _close_quietly(conn)
+
+@contextmanager
+def db_connection():
+    '''Соединение из пула на время запроса с автоматическим возвратом'''
+    conn = get_db_connection()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        release_db_connection(conn, broken)
+
+def bucket_quantile(buckets, count, max_ms, quantile):
+    '''Квантиль по гистограмме: линейная интерполяция внутри корзины; последняя корзина — до max_ms'''
+    if not count:
+        return 0.0
+    rank = quantile * count
+    seen = 0
+    for index, bucket_count in enumerate(buckets):
+        if not bucket_count or seen + bucket_count < rank:
+            seen += bucket_count
+            continue
+        lower = LATENCY_BUCKETS_MS[index - 1] if index > 0 else 0.0
+        upper = LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else max(max_ms, lower)
+        return round(min(lower + (upper - lower) * (rank - seen) / bucket_count, max_ms), 3)
+    return round(max_ms, 3)
+
+def summarize_histogram(row):
+    '''Строка latency_histograms за окно -> count, mean, p50/p95/p99, max'''
+    count = int(row['count'])
+    buckets = [int(value) for value in row['buckets']]
+    max_ms = float(row['max_ms'])
+    summary = {
+        'function': row['function'],
+        'span': row['span'],
+        'count': count,
+        'mean_ms': round(float(row['total_ms']) / count, 3) if count else 0.0
+    }
+    for name, quantile in QUANTILES:
+        summary[name] = bucket_quantile(buckets, count, max_ms, quantile)
+    summary['max_ms'] = round(max_ms, 3)
+    summary['buckets'] = buckets
+    return summary
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Returns latency histograms and p50/p95/p99 per function and span (connect, sql.*, serialize, total)
+    Args: event - dict with httpMethod, queryStringParameters (minutes, function, span)
+          context - object with request_id attribute
+    Returns: HTTP response dict with one summary per function and span over the window
+    '''
+    method: str = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    if method == 'GET':
+        params = event.get('queryStringParameters') or {}
+        try:
+            minutes = int(params.get('minutes', DEFAULT_WINDOW_MINUTES))
+            if not 1 <= minutes <= MAX_WINDOW_MINUTES:
+                raise ValueError
+        except ValueError:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'minutes must be between 1 and ' + str(MAX_WINDOW_MINUTES)}),
+                'isBase64Encoded': False
+            }
+        
+        with db_connection() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(HISTOGRAMS_QUERY, {'minutes': minutes, 'function': params.get('function'), 'span': params.get('span')})
+            spans = [summarize_histogram(row) for row in cur.fetchall()]
+            cur.close()
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({
+                'minutes': minutes,
+                'buckets_ms': list(LATENCY_BUCKETS_MS),
+                'spans': spans
+            }),
+            'isBase64Encoded': False
+        }
+    
+    return {
+        'statusCode': 405,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'error': 'Method not allowed'}),
+        'isBase64Encoded': False
+    }
@@ -0,0 +1,515 @@
+import base64
+import bisect
+import cProfile
+import functools
+import hashlib
+import io
+import json
+import os
+import pstats
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, Any
+import psycopg2
+import psycopg2.pool
+from psycopg2.extras import RealDictCursor, execute_values
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_POOL_CHECK_IDLE = float(os.environ.get('DB_POOL_CHECK_IDLE', '30'))
+STATEMENT_PREPARED_MAX = int(os.environ.get('STATEMENT_PREPARED_MAX', '64'))
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+METRICS_FUNCTION = 'search'
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '60'))
+PROFILE_TOP = int(os.environ.get('PROFILE_TOP', '40'))
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MAX_QUERY_LENGTH = 200
+MIN_SUBSTRING_LENGTH = 3
+SNIPPET_CHARS = 160
+
+# Где искать: таблица, текстовая колонка с search_vector и триграммным индексом (V0019), колонки результата
+SEARCH_SOURCES = {
+    'messages': {
+        'table': 'messages',
+        'text': 'message',
+        'user': 'user_id',
+        'ts': 'timestamp',
+        'columns': 'id, user_id AS telegram_id, sender, timestamp'
+    },
+    'dialogs': {
+        'table': 'dialogs',
+        'text': 'user_message',
+        'user': 'telegram_id',
+        'ts': 'created_at',
+        'columns': 'id, telegram_id, username, model, created_at AS timestamp'
+    }
+}
+SEARCH_MODES = ('fts', 'substring')
+HEADLINE_OPTIONS = 'StartSel=<mark>, StopSel=</mark>, MaxWords=35, MinWords=15, MaxFragments=2, FragmentDelimiter=" … "'
+
+_pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+_pool_lock = threading.Lock()
+_pool_idle = []
+pool_stats = {'acquired': 0, 'created': 0, 'reconnects': 0, 'timeouts': 0, 'wait_ms_total': 0.0, 'wait_ms_max': 0.0}
+
+_trace = threading.local()
+_latency_lock = threading.Lock()
+_latency_flush = {'at': time.monotonic()}
+_latency_pending = {}
+latency_stats = {}
+_profile_lock = threading.Lock()
+
+_statement_sql = {}
+_PLACEHOLDER_RE = re.compile(r'%\((\w+)\)s|%s')
+
+def _connection_alive(conn, idle_seconds):
+    '''Проверяет соединение из пула перед выдачей (SELECT 1 после долгого простоя)'''
+    if conn.closed:
+        return False
+    if idle_seconds < DB_POOL_CHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+class PreparedConnection(psycopg2.extensions.connection):
+    '''Соединение пула, которое помнит свои серверные prepared statements'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+def get_db_connection():
+    '''Берёт соединение из тёплого пула модуля, который переживает вызовы функции'''
+    wait_start = time.perf_counter()
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        with _pool_lock:
+            pool_stats['timeouts'] += 1
+        raise psycopg2.pool.PoolError('Connection pool exhausted after ' + str(DB_POOL_TIMEOUT) + 's')
+    wait_ms = (time.perf_counter() - wait_start) * 1000
+    
+    conn = None
+    while conn is None:
+        with _pool_lock:
+            idle = _pool_idle.pop() if _pool_idle else None
+        if idle is None:
+            break
+        candidate, released_at = idle
+        if _connection_alive(candidate, time.monotonic() - released_at):
+            conn = candidate
+        else:
+            with _pool_lock:
+                pool_stats['reconnects'] += 1
+            _close_quietly(candidate)
+    
+    if conn is None:
+        try:
+            conn = psycopg2.connect(os.environ['DATABASE_URL'], connection_factory=PreparedConnection)
+        except Exception:
+            _pool_slots.release()
+            raise
+        with _pool_lock:
+            pool_stats['created'] += 1
+    
+    with _pool_lock:
+        pool_stats['acquired'] += 1
+        pool_stats['wait_ms_total'] += wait_ms
+        pool_stats['wait_ms_max'] = max(pool_stats['wait_ms_max'], wait_ms)
+    record_span('connect', (time.perf_counter() - wait_start) * 1000)
+    return conn
+
+def release_db_connection(conn, broken=False):
+    '''Возвращает соединение в пул; сломанные соединения закрываются'''
+    try:
+        if not broken and not conn.closed:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            with _pool_lock:
+                _pool_idle.append((conn, time.monotonic()))
+            return
+    except psycopg2.Error:
+        pass
+    finally:
+        _pool_slots.release()
+    _close_quietly(conn)
+
+@contextmanager
+def db_connection():
+    '''Соединение из пула на время запроса с автоматическим возвратом'''
+    conn = get_db_connection()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        release_db_connection(conn, broken)
+
+LATENCY_FLUSH_SQL = (
+    "INSERT INTO latency_histograms (function, span, minute, count, total_ms, max_ms, buckets) VALUES %s " +
+    "ON CONFLICT (function, span, minute) DO UPDATE SET count = latency_histograms.count + EXCLUDED.count, " +
+    "total_ms = latency_histograms.total_ms + EXCLUDED.total_ms, max_ms = GREATEST(latency_histograms.max_ms, EXCLUDED.max_ms), " +
+    "buckets = latency_add_buckets(latency_histograms.buckets, EXCLUDED.buckets)"
+)
+
+def record_span(name, elapsed_ms):
+    '''Добавляет время участка к спанам текущего запроса (повторы суммируются); вне запроса — сразу в гистограмму'''
+    spans = getattr(_trace, 'spans', None)
+    if spans is None:
+        record_latency(name, elapsed_ms)
+    else:
+        spans[name] = spans.get(name, 0.0) + elapsed_ms
+
+@contextmanager
+def span(name):
+    '''Замеряет участок обработки запроса'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, (time.perf_counter() - start) * 1000)
+
+def record_latency(name, elapsed_ms):
+    '''Гистограмма спана по верхним границам LATENCY_BUCKETS_MS (последняя корзина — всё, что дольше): в памяти и в дельте до сброса в БД'''
+    bucket = bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)
+    with _latency_lock:
+        for stats_by_span in (latency_stats, _latency_pending):
+            stats = stats_by_span.get(name)
+            if stats is None:
+                stats = stats_by_span[name] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+            stats['count'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['buckets'][bucket] += 1
+
+def flush_latency_stats(force=False):
+    '''Не чаще METRICS_FLUSH_INTERVAL дописывает накопленные гистограммы в latency_histograms (их читает функция metrics) и пишет в лог счётчики пула'''
+    with _latency_lock:
+        if not _latency_pending or (not force and time.monotonic() - _latency_flush['at'] < METRICS_FLUSH_INTERVAL):
+            return 0
+        pending = dict(_latency_pending)
+        _latency_pending.clear()
+        _latency_flush['at'] = time.monotonic()
+    with _pool_lock:
+        pool = dict(pool_stats, idle=len(_pool_idle), size=DB_POOL_SIZE)
+    print(json.dumps({'metric': 'db_pool', 'function': METRICS_FUNCTION, **pool}))
+    
+    rows = [(METRICS_FUNCTION, name, stats['count'], stats['total_ms'], stats['max_ms'], stats['buckets']) for name, stats in pending.items()]
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                execute_values(cur, LATENCY_FLUSH_SQL, rows, template="(%s, %s, date_trunc('minute', now()), %s, %s, %s, %s)")
+            conn.commit()
+    except psycopg2.Error as error:
+        print(json.dumps({'metric': 'latency_flush_failed', 'spans': len(rows), 'error': str(error)}))
+        return 0
+    return len(rows)
+
+def server_timing(spans):
+    return ', '.join(name + ';dur=' + str(round(ms, 1)) for name, ms in spans.items())
+
+def dump_profile(profiler, context, spans):
+    '''Пишет в лог топ PROFILE_TOP функций профиля запроса по cumulative time вместе с его спанами'''
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_TOP)
+    print(json.dumps({
+        'metric': 'profile',
+        'function': METRICS_FUNCTION,
+        'request_id': getattr(context, 'request_id', None),
+        'spans': {name: round(ms, 3) for name, ms in spans.items()},
+        'profile': report.getvalue()
+    }, ensure_ascii=False))
+
+def traced(handler_fn):
+    '''
+    Оборачивает handler: спаны запроса (connect, sql.*, serialize, total) уходят в Server-Timing и гистограммы.
+    С ?profile=1 запрос дополнительно профилируется cProfile (по одному за раз) и профиль пишется в лог.
+    '''
+    @functools.wraps(handler_fn)
+    def wrapper(event, context):
+        params = event.get('queryStringParameters') or {}
+        profiler = None
+        if params.get('profile') == '1' and _profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+        
+        _trace.spans = {}
+        start = time.perf_counter()
+        try:
+            if profiler is None:
+                response = handler_fn(event, context)
+            else:
+                response = profiler.runcall(handler_fn, event, context)
+        finally:
+            spans = _trace.spans
+            _trace.spans = None
+            spans['total'] = (time.perf_counter() - start) * 1000
+            for name, elapsed_ms in spans.items():
+                record_latency(name, elapsed_ms)
+            if profiler is not None:
+                _profile_lock.release()
+        
+        if profiler is not None:
+            dump_profile(profiler, context, spans)
+        headers = response.setdefault('headers', {})
+        headers['Server-Timing'] = server_timing(spans)
+        exposed = headers.get('Access-Control-Expose-Headers')
+        headers['Access-Control-Expose-Headers'] = exposed + ', Server-Timing' if exposed else 'Server-Timing'
+        flush_latency_stats()
+        return response
+    
+    return wrapper
+
+def _server_statement(label, sql):
+    '''Имя prepared statement (метка + хэш текста), текст с $n вместо %(name)s / %s и порядок параметров'''
+    statement = _statement_sql.get(sql)
+    if statement is None:
+        names = []
+        
+        def number(match):
+            name = match.group(1)
+            if name is None or name not in names:
+                names.append(name)
+                return '$' + str(len(names))
+            return '$' + str(names.index(name) + 1)
+        
+        text = _PLACEHOLDER_RE.sub(number, sql).replace('%%', '%')
+        statement = (label + '_' + hashlib.md5(sql.encode()).hexdigest()[:10], text, names)
+        _statement_sql[sql] = statement
+    return statement
+
+def execute_prepared(cur, label, sql, params=None):
+    '''
+    Выполняет запрос как prepared statement соединения: PREPARE при первом вызове, дальше только EXECUTE
+    без повторного разбора. Сверх STATEMENT_PREPARED_MAX на соединение — обычный execute. Время идёт в спан sql.<label>.
+    '''
+    name, text, names = _server_statement(label, sql)
+    prepared = cur.connection.prepared
+    start = time.perf_counter()
+    if name not in prepared and len(prepared) < STATEMENT_PREPARED_MAX:
+        cur.execute('PREPARE ' + name + ' AS ' + text)
+        prepared.add(name)
+    if name in prepared:
+        values = [params[n] for n in names] if isinstance(params, dict) else list(params or ())
+        if values:
+            cur.execute('EXECUTE ' + name + ' (' + ', '.join(['%s'] * len(values)) + ')', values)
+        else:
+            cur.execute('EXECUTE ' + name)
+    else:
+        cur.execute(sql, params)
+    record_span('sql.' + label, (time.perf_counter() - start) * 1000)
+
+
+def encode_cursor(key, row_id):
+    '''Непрозрачный курсор keyset-пагинации: (rank, id) для fts, (timestamp, id) для substring'''
+    raw = key.isoformat() if isinstance(key, datetime) else repr(float(key))
+    return base64.urlsafe_b64encode((raw + '|' + str(row_id)).encode()).decode()
+
+def decode_cursor(cursor, mode):
+    raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+    key, row_id = raw.rsplit('|', 1)
+    return (float(key) if mode == 'fts' else datetime.fromisoformat(key)), int(row_id)
+
+def fts_query(source, by_user, after):
+    '''
+    Полнотекстовый поиск: запрос разбирается websearch_to_tsquery в обоих словарях, совпадения ранжируются ts_rank_cd.
+    ts_headline (дорогой) считается только для строк страницы.
+    '''
+    spec = SEARCH_SOURCES[source]
+    rank = "ts_rank_cd(search_vector, query.tsq)::float8"
+    where = "search_vector @@ query.tsq"
+    if by_user:
+        where += " AND " + spec['user'] + " = %(telegram_id)s"
+    if after:
+        where += " AND (" + rank + ", id) < (%(after_key)s, %(after_id)s)"
+    return (
+        "WITH query AS (SELECT websearch_to_tsquery('russian', %(q)s) || websearch_to_tsquery('english', %(q)s) AS tsq), " +
+        "page AS (SELECT " + spec['columns'] + ", " + spec['text'] + " AS body, " + rank + " AS rank " +
+        "FROM " + spec['table'] + ", query WHERE " + where + " ORDER BY rank DESC, id DESC LIMIT %(limit)s) " +
+        "SELECT page.*, ts_headline('russian', page.body, query.tsq, %(headline)s) AS snippet " +
+        "FROM page, query ORDER BY page.rank DESC, page.id DESC"
+    )
+
+def substring_query(source, by_user, after):
+    '''Поиск подстроки: ILIKE по триграммному GIN-индексу, новые совпадения первыми'''
+    spec = SEARCH_SOURCES[source]
+    where = spec['text'] + " ILIKE %(pattern)s"
+    if by_user:
+        where += " AND " + spec['user'] + " = %(telegram_id)s"
+    if after:
+        where += " AND (" + spec['ts'] + ", id) < (%(after_key)s, %(after_id)s)"
+    return (
+        "SELECT " + spec['columns'] + ", " + spec['text'] + " AS body FROM " + spec['table'] +
+        " WHERE " + where + " ORDER BY " + spec['ts'] + " DESC, id DESC LIMIT %(limit)s"
+    )
+
+def like_pattern(q):
+    '''%q% для ILIKE с экранированными \\, % и _'''
+    return '%' + q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def substring_snippet(text, q):
+    '''Фрагмент около первого вхождения q с той же разметкой <mark>, что и у ts_headline'''
+    position = text.lower().find(q.lower())
+    if position < 0:
+        return text[:SNIPPET_CHARS]
+    start = max(0, position - (SNIPPET_CHARS - len(q)) // 2)
+    end = min(len(text), start + SNIPPET_CHARS)
+    return (
+        ('…' if start > 0 else '') + text[start:position] + '<mark>' + text[position:position + len(q)] + '</mark>' +
+        text[position + len(q):end] + ('…' if end < len(text) else '')
+    )
+
+def _json_default(value):
+    '''Типы вне стандартного JSON: Decimal — число, дата и время — ISO 8601'''
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError('Object of type ' + type(value).__name__ + ' is not JSON serializable')
+
+def encode_json(value):
+    '''Сериализует тело ответа через orjson, если он установлен, иначе через json с теми же правилами; время идёт в спан serialize'''
+    start = time.perf_counter()
+    if orjson is not None:
+        body = orjson.dumps(value, default=_json_default).decode()
+    else:
+        body = json.dumps(value, default=_json_default, ensure_ascii=False, separators=(',', ':'))
+    record_span('serialize', (time.perf_counter() - start) * 1000)
+    return body
+
+@traced
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Searches conversation history (messages.message or dialogs.user_message) across all users
+    Args: event - dict with httpMethod, queryStringParameters (q, source, mode, telegram_id, limit, cursor)
+          context - object with request_id attribute
+    Returns: HTTP response dict with a ranked page of matches with highlighted snippets and next_cursor
+    '''
+    method: str = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    if method == 'GET':
+        params = event.get('queryStringParameters') or {}
+        q = (params.get('q') or '').strip()
+        source = params.get('source', 'messages')
+        mode = params.get('mode', 'fts')
+        
+        if not q or len(q) > MAX_QUERY_LENGTH or source not in SEARCH_SOURCES or mode not in SEARCH_MODES:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'error': 'q (up to ' + str(MAX_QUERY_LENGTH) + ' chars) is required; source is one of ' +
+                             ', '.join(SEARCH_SOURCES) + '; mode is one of ' + ', '.join(SEARCH_MODES)
+                }),
+                'isBase64Encoded': False
+            }
+        
+        if mode == 'substring' and len(q) < MIN_SUBSTRING_LENGTH:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'substring search needs at least ' + str(MIN_SUBSTRING_LENGTH) + ' characters'}),
+                'isBase64Encoded': False
+            }
+        
+        try:
+            telegram_id = int(params['telegram_id']) if params.get('telegram_id') else None
+            limit = min(int(params.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+            after = decode_cursor(params['cursor'], mode) if params.get('cursor') else None
+            if limit < 1:
+                raise ValueError('limit must be positive')
+        except ValueError:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'telegram_id, limit and cursor must be valid'}),
+                'isBase64Encoded': False
+            }
+        
+        build_query = fts_query if mode == 'fts' else substring_query
+        query = build_query(source, telegram_id is not None, after)
+        
+        with db_connection() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            
+            execute_prepared(cur, 'search_' + source + '_' + mode, query, {
+                'q': q,
+                'pattern': like_pattern(q),
+                'headline': HEADLINE_OPTIONS,
+                'telegram_id': telegram_id,
+                'after_key': after[0] if after else None,
+                'after_id': after[1] if after else None,
+                'limit': limit + 1
+            })
+            
+            rows = cur.fetchall()
+            cur.close()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        results = []
+        for r in rows:
+            result = dict(r)
+            body = result.pop('body') or ''
+            if mode == 'substring':
+                result['snippet'] = substring_snippet(body, q)
+            results.append(result)
+        
+        next_cursor = None
+        if has_more:
+            last = rows[-1]
+            next_cursor = encode_cursor(last['rank'] if mode == 'fts' else last['timestamp'], last['id'])
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': encode_json({
+                'q': q,
+                'source': source,
+                'mode': mode,
+                'results': results,
+                'count': len(results),
+                'has_more': has_more,
+                'next_cursor': next_cursor
+            }),
+            'isBase64Encoded': False
+        }
+    
+    return {
+        'statusCode': 405,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'error': 'Method not allowed'}),
+        'isBase64Encoded': False
+    }
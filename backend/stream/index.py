@@ -0,0 +1,321 @@
+import json
+import math
+import os
+import queue
+import select
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, Any
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+STREAM_CHANNEL = 'analytics_events'
+STREAM_COALESCE_MS = int(os.environ.get('STREAM_COALESCE_MS', '500'))
+STREAM_HOLD_SECONDS = float(os.environ.get('STREAM_HOLD_SECONDS', '25'))
+STREAM_RETRY_MS = int(os.environ.get('STREAM_RETRY_MS', '1000'))
+STREAM_BACKLOG = int(os.environ.get('STREAM_BACKLOG', '256'))
+STREAM_CLIENT_QUEUE = int(os.environ.get('STREAM_CLIENT_QUEUE', '32'))
+STREAM_MAX_DIALOGS = int(os.environ.get('STREAM_MAX_DIALOGS', '50'))
+STREAM_IDLE_SECONDS = float(os.environ.get('STREAM_IDLE_SECONDS', '60'))
+STREAM_SEEN_IDS = 10000
+HLL_REGISTERS = 4096
+
+# Те же строки, что в списке диалогов get-analytics, но только из диапазонов id пришедших уведомлений
+DIALOGS_QUERY = (
+    "SELECT d.id, u.name as user, u.username, d.telegram_id, d.tokens, d.model, d.status, u.premium, d.user_message, d.assistant_message, " +
+    "d.interaction_type, to_char(d.created_at AT TIME ZONE 'UTC' AT TIME ZONE 'Europe/Moscow', 'DD.MM.YYYY HH24:MI') as date " +
+    "FROM dialogs d JOIN users u ON d.user_id = u.id " +
+    "WHERE d.id BETWEEN %(min_id)s AND %(max_id)s AND d.created_at >= %(since)s ORDER BY d.id DESC LIMIT %(limit)s"
+)
+# Счётчики за сегодня из агрегатов (dialog_rollups, cost_rollups, dau_sketches) и качество как в get-quality
+COUNTERS_QUERY = (
+    "SELECT CURRENT_DATE as day, " +
+    "(SELECT COALESCE(SUM(dialogs_count), 0)::bigint FROM dialog_rollups WHERE day = CURRENT_DATE) as dialogs, " +
+    "(SELECT COALESCE(SUM(tokens), 0)::bigint FROM dialog_rollups WHERE day = CURRENT_DATE) as tokens, " +
+    "(SELECT COALESCE(SUM(cost_dollars), 0) FROM cost_rollups WHERE day = CURRENT_DATE) as cost, " +
+    "(SELECT sketch FROM dau_sketches WHERE day = CURRENT_DATE) as sketch, " +
+    "(SELECT COUNT(*) FILTER (WHERE LENGTH(message) > 50) * 100.0 / NULLIF(COUNT(*), 0) FROM messages " +
+    "WHERE timestamp >= CURRENT_DATE AND sender = 'bot') as quality_pct"
+)
+
+_stream_lock = threading.Lock()
+_stream_ready = threading.Condition(_stream_lock)
+_subscribers = {}
+_backlog = deque(maxlen=STREAM_BACKLOG)
+_seen_ids = deque(maxlen=STREAM_SEEN_IDS)
+_stream_state = {'thread': None, 'epoch': None, 'seq': 0, 'counters': None, 'idle_since': None}
+stream_stats = {'notifications': 0, 'flushes': 0, 'events': 0, 'overflows': 0, 'reconnects': 0}
+
+def hll_estimate(registers):
+    '''Оценка числа уникальных пользователей по регистрам HLL (с linear counting на малых значениях)'''
+    m = HLL_REGISTERS
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / sum(2.0 ** -rank for rank in registers)
+    zeros = registers.count(0)
+    if raw <= 2.5 * m and zeros:
+        return int(round(m * math.log(m / zeros)))
+    return int(round(raw))
+
+def read_counters(cur):
+    cur.execute(COUNTERS_QUERY)
+    row = cur.fetchone()
+    return {
+        'date': str(row['day']),
+        'dialogs': row['dialogs'],
+        'tokens': row['tokens'],
+        'cost_usd': round(float(row['cost']), 4),
+        'dau': hll_estimate(bytes(row['sketch'])) if row['sketch'] else 0,
+        'quality': round(float(row['quality_pct'] or 0), 2)
+    }
+
+def publish(kind, data):
+    '''Кладёт событие в backlog и в очереди подписчиков; переполненная очередь помечается, клиент получит resync'''
+    with _stream_lock:
+        _stream_state['seq'] += 1
+        event = {'id': _stream_state['epoch'] + '-' + str(_stream_state['seq']), 'seq': _stream_state['seq'], 'event': kind, 'data': data}
+        _backlog.append(event)
+        for subscriber in _subscribers.values():
+            try:
+                subscriber['queue'].put_nowait(event)
+            except queue.Full:
+                if not subscriber['overflow']:
+                    stream_stats['overflows'] += 1
+                subscriber['overflow'] = True
+        stream_stats['events'] += 1
+        _stream_ready.notify_all()
+
+def flush_notifications(conn, batches):
+    '''
+    Одно событие update на окно коалесинга: сумма дельт всех уведомлений, новые диалоги одним запросом
+    по объединённому диапазону id (уже отправленные id отсекаются) и свежие счётчики за сегодня
+    '''
+    delta = {'dialogs': sum(b['dialogs'] for b in batches), 'tokens': sum(b['tokens'] for b in batches)}
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(DIALOGS_QUERY, {
+            'min_id': min(b['min_id'] for b in batches),
+            'max_id': max(b['max_id'] for b in batches),
+            'since': min(b['since'] for b in batches),
+            'limit': STREAM_MAX_DIALOGS
+        })
+        seen = set(_seen_ids)
+        dialogs = [dict(row) for row in cur.fetchall() if row['id'] not in seen]
+        counters = read_counters(cur)
+    _seen_ids.extend(row['id'] for row in dialogs)
+    _stream_state['counters'] = counters
+    stream_stats['flushes'] += 1
+    publish('update', {'delta': delta, 'dialogs': dialogs, 'counters': counters})
+
+def _listen():
+    '''
+    Единственный LISTEN на экземпляр функции: уведомления копятся STREAM_COALESCE_MS и расходятся всем
+    подписчикам одним событием, так что нагрузка на базу зависит от частоты записи, а не от числа вкладок.
+    Без подписчиков дольше STREAM_IDLE_SECONDS поток закрывает соединение и выходит.
+    '''
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn.autocommit = True
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("LISTEN " + STREAM_CHANNEL)
+                counters = read_counters(cur)
+            with _stream_lock:
+                # Уведомления до LISTEN потеряны: новая эпоха, клиенты со старыми id получат resync
+                _stream_state.update({'epoch': uuid.uuid4().hex[:8], 'seq': 0, 'counters': counters})
+                _backlog.clear()
+                _stream_ready.notify_all()
+            
+            pending = []
+            first_at = None
+            while True:
+                timeout = max(0.0, first_at + STREAM_COALESCE_MS / 1000.0 - time.monotonic()) if pending else 1.0
+                if select.select([conn], [], [], timeout)[0]:
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        stream_stats['notifications'] += 1
+                        try:
+                            pending.append(json.loads(notify.payload))
+                        except ValueError:
+                            continue
+                        if first_at is None:
+                            first_at = time.monotonic()
+                if pending and time.monotonic() - first_at >= STREAM_COALESCE_MS / 1000.0:
+                    flush_notifications(conn, pending)
+                    pending = []
+                    first_at = None
+                with _stream_lock:
+                    idle = not _subscribers and time.monotonic() - (_stream_state['idle_since'] or time.monotonic()) > STREAM_IDLE_SECONDS
+                    if idle:
+                        _stream_state.update({'thread': None, 'epoch': None, 'counters': None})
+                        _backlog.clear()
+                if idle:
+                    return
+        except psycopg2.Error as error:
+            stream_stats['reconnects'] += 1
+            print(json.dumps({'metric': 'stream_listen_failed', 'error': str(error)}))
+            with _stream_lock:
+                _stream_state.update({'epoch': None, 'counters': None})
+            time.sleep(1.0)
+        finally:
+            if conn is not None and not conn.closed:
+                conn.close()
+
+def _listen_loop():
+    '''Тело потока LISTEN: при любом выходе, в том числе по исключению не из psycopg2, состояние потока сбрасывается'''
+    try:
+        _listen()
+    finally:
+        # Следующий subscribe запустит поток заново, а ждущие эпоху подписчики сразу получат 503
+        with _stream_lock:
+            if _stream_state['thread'] is threading.current_thread():
+                _stream_state.update({'thread': None, 'epoch': None, 'counters': None})
+                _backlog.clear()
+            _stream_ready.notify_all()
+
+def subscribe(last_event_id):
+    '''
+    Регистрирует клиента и возвращает (id подписки, события к отправке сразу). Клиент без Last-Event-ID
+    или с id другой эпохи (рестарт, переполнение backlog) получает resync со снимком счётчиков.
+    '''
+    with _stream_lock:
+        if _stream_state['thread'] is None:
+            thread = threading.Thread(target=_listen_loop, daemon=True)
+            _stream_state['thread'] = thread
+            thread.start()
+        deadline = time.monotonic() + STREAM_HOLD_SECONDS
+        while _stream_state['epoch'] is None and _stream_state['thread'] is not None and time.monotonic() < deadline:
+            _stream_ready.wait(deadline - time.monotonic())
+        if _stream_state['epoch'] is None:
+            return None, []
+        
+        epoch, _, seq = (last_event_id or '').partition('-')
+        oldest = _backlog[0]['seq'] if _backlog else _stream_state['seq'] + 1
+        if epoch == _stream_state['epoch'] and seq.isdigit() and int(seq) + 1 >= oldest:
+            replay = [event for event in _backlog if event['seq'] > int(seq)]
+        else:
+            replay = [{
+                'id': _stream_state['epoch'] + '-' + str(_stream_state['seq']),
+                'event': 'resync',
+                'data': {'counters': _stream_state['counters']}
+            }]
+        
+        subscription = uuid.uuid4().hex
+        _subscribers[subscription] = {'queue': queue.Queue(maxsize=STREAM_CLIENT_QUEUE), 'overflow': False}
+        _stream_state['idle_since'] = None
+        return subscription, replay
+
+def unsubscribe(subscription):
+    with _stream_lock:
+        _subscribers.pop(subscription, None)
+        if not _subscribers:
+            _stream_state['idle_since'] = time.monotonic()
+
+def wait_events(subscription):
+    '''Ждёт первое событие до STREAM_HOLD_SECONDS и забирает всё, что успело накопиться в очереди клиента'''
+    subscriber = _subscribers[subscription]
+    events = []
+    try:
+        events.append(subscriber['queue'].get(timeout=STREAM_HOLD_SECONDS))
+    except queue.Empty:
+        return events
+    while True:
+        try:
+            events.append(subscriber['queue'].get_nowait())
+        except queue.Empty:
+            break
+    if subscriber['overflow']:
+        last = events[-1]
+        events = [{'id': last['id'], 'event': 'resync', 'data': {'counters': _stream_state['counters']}}]
+    return events
+
+def _json_default(value):
+    '''Типы вне стандартного JSON: Decimal — число, дата и время — ISO 8601'''
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError('Object of type ' + type(value).__name__ + ' is not JSON serializable')
+
+def encode_json(value):
+    '''Сериализует значение через orjson, если он установлен, иначе через json с теми же правилами'''
+    if orjson is not None:
+        return orjson.dumps(value, default=_json_default).decode()
+    return json.dumps(value, default=_json_default, ensure_ascii=False, separators=(',', ':'))
+
+def encode_sse(events):
+    '''Кадры text/event-stream: retry для переподключения EventSource, затем id/event/data каждого события'''
+    frames = ['retry: ' + str(STREAM_RETRY_MS) + '\n\n']
+    for event in events:
+        frames.append('id: ' + event['id'] + '\nevent: ' + event['event'] + '\ndata: ' + encode_json(event['data']) + '\n\n')
+    if not events:
+        frames.append(': keepalive\n\n')
+    return ''.join(frames)
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Pushes dashboard deltas (new dialogs, today's DAU/cost/quality counters) as Server-Sent Events fed by LISTEN/NOTIFY
+    Args: event - dict with httpMethod, headers (Last-Event-ID), queryStringParameters (lastEventId for clients without the header)
+          context - object with request_id attribute
+    Returns: text/event-stream response held until the next coalesced update (or STREAM_HOLD_SECONDS); EventSource reconnects with Last-Event-ID
+    '''
+    method: str = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, Last-Event-ID',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    if method == 'GET':
+        headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+        params = event.get('queryStringParameters') or {}
+        last_event_id = headers.get('last-event-id') or params.get('lastEventId')
+        
+        subscription, events = subscribe(last_event_id)
+        if subscription is None:
+            return {
+                'statusCode': 503,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Retry-After': str(max(1, STREAM_RETRY_MS // 1000))},
+                'body': json.dumps({'error': 'Event listener is not connected yet'}),
+                'isBase64Encoded': False
+            }
+        try:
+            if not events:
+                events = wait_events(subscription)
+        finally:
+            unsubscribe(subscription)
+        
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'text/event-stream; charset=utf-8',
+                'Cache-Control': 'no-cache',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': encode_sse(events),
+            'isBase64Encoded': False
+        }
+    
+    return {
+        'statusCode': 405,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'error': 'Method not allowed'}),
+        'isBase64Encoded': False
+    }
@@ -0,0 +1,89 @@
+'''
+Память при выгрузке таблицы: fetchall() в RealDictCursor (как get-analytics до серверных курсоров)
+против export_chunks из backend/export (именованный курсор, itersize, порции NDJSON/CSV).
+
+Пиковая память Python — tracemalloc; рост RSS процесса — ru_maxrss (ловит и буфер libpq,
+который tracemalloc не видит). Потоковый режим запускается первым, чтобы рост RSS у fetchall
+не маскировался уже достигнутым пиком.
+
+--synthetic N добавляет N пользователей через generate_series внутри транзакции, которая
+откатывается в конце, поэтому можно запускать на копии рабочей базы.
+
+Запуск: DATABASE_URL=postgres://... python benchmarks/bench_export_memory.py --table users --synthetic 200000
+'''
+import argparse
+import json
+import resource
+import time
+import tracemalloc
+
+from psycopg2.extras import RealDictCursor
+
+from common import load_function
+
+SYNTHETIC_USERS_SQL = (
+    "INSERT INTO users (telegram_id, name, username, total_tokens, dialogs_count, premium, last_active) " +
+    "SELECT 800000000000 + g, 'Bench ' || g, 'bench_' || g, (random() * 100000)::int, (random() * 500)::int, random() < 0.1, " +
+    "now() - random() * interval '300 days' FROM generate_series(1, %s) AS g"
+)
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def measure(fn):
+    rss_before = rss_mb()
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = fn()
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'ms': round(elapsed_ms, 1),
+        'bytes_out': size,
+        'tracemalloc_peak_mb': round(peak / 1024 / 1024, 2),
+        'rss_growth_mb': round(rss_mb() - rss_before, 2)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--table', choices=['users', 'dialogs', 'messages'], default='users')
+    parser.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+    parser.add_argument('--synthetic', type=int, default=0)
+    args = parser.parse_args()
+    
+    export = load_function('export')
+    columns = ', '.join(export.EXPORT_TABLES[args.table])
+    
+    with export.db_connection() as conn:
+        if args.synthetic and args.table == 'users':
+            with conn.cursor() as cur:
+                cur.execute(SYNTHETIC_USERS_SQL, (args.synthetic,))
+
+        def streaming():
+            size = 0
+            stats = {}
+            for piece in export.export_chunks(conn, args.table, args.format, stats, limit=2 ** 31 - 1):
+                size += len(piece)
+            return size
+
+        def fetchall():
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute("SELECT " + columns + " FROM " + args.table + " ORDER BY id")
+            rows = [dict(row) for row in cur.fetchall()]
+            cur.close()
+            return len(export.encode_json(rows))
+        
+        results = {
+            'table': args.table,
+            'format': args.format,
+            'itersize': export.EXPORT_ITERSIZE,
+            'streaming': measure(streaming),
+            'fetchall': measure(fetchall)
+        }
+        conn.rollback()
+    
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+'''
+Сериализация списка users из get-analytics на синтетических данных (100k пользователей):
+legacy (astimezone/strftime по строкам + json.dumps всего ответа) против encode_rows
+(даты уже отформатированы в SQL через to_char, orjson/json порциями по JSON_CHUNK_ROWS).
+
+Время форматирования дат в Postgres сюда не входит: оно переезжает в запрос.
+
+Запуск: python benchmarks/bench_json_encoding.py --users 100000 --repeat 5
+'''
+import argparse
+import json
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+from common import load_function, summarize
+
+class ListCursor:
+    '''Минимальный курсор с fetchmany поверх готовых строк'''
+    def __init__(self, rows):
+        self.rows = rows
+        self.position = 0
+
+    def fetchmany(self, size):
+        chunk = self.rows[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+def make_users(count, seed):
+    rng = random.Random(seed)
+    base = datetime(2025, 1, 1)
+    users = []
+    for i in range(count):
+        users.append({
+            'id': i + 1,
+            'telegram_id': 900000000 + i,
+            'name': 'Пользователь ' + str(i),
+            'username': 'user_' + str(i),
+            'email': 'user' + str(i) + '@example.com' if rng.random() < 0.3 else None,
+            'total_tokens': rng.randint(0, 2000000),
+            'dialogs_count': rng.randint(0, 5000),
+            'premium': rng.random() < 0.1,
+            'last_active': base + timedelta(seconds=rng.randint(0, 300 * 86400))
+        })
+    return users
+
+def preformat(users):
+    '''То, что возвращает запрос с to_char(last_active AT TIME ZONE ...) as "lastActive"'''
+    moscow_tz = timezone(timedelta(hours=3))
+    rows = []
+    for user in users:
+        row = {k: v for k, v in user.items() if k != 'last_active'}
+        row['lastActive'] = user['last_active'].replace(tzinfo=timezone.utc).astimezone(moscow_tz).strftime('%d.%m.%Y')
+        rows.append(row)
+    return rows
+
+def encode_legacy(users):
+    users = [dict(user) for user in users]
+    moscow_tz = timezone(timedelta(hours=3))
+    for user in users:
+        utc_time = user['last_active'].replace(tzinfo=timezone.utc)
+        moscow_time = utc_time.astimezone(moscow_tz)
+        user['lastActive'] = moscow_time.strftime('%d.%m.%Y')
+        del user['last_active']
+    return json.dumps({'users': users})
+
+def encode_fast(analytics, rows):
+    return analytics.encode_object([('users', analytics.encode_rows(ListCursor(rows)))])
+
+def measure(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result = summarize(samples)
+    result['peak_mb'] = round(peak / 1024 / 1024, 2)
+    result['body_mb'] = round(len(body.encode()) / 1024 / 1024, 2)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    
+    analytics = load_function('get-analytics')
+    users = make_users(args.users, args.seed)
+    rows = preformat(users)
+    
+    legacy_body = json.loads(encode_legacy(users))
+    fast_body = json.loads(encode_fast(analytics, rows))
+    assert legacy_body == fast_body, 'encoders disagree'
+    
+    results = {
+        'encoder': 'orjson' if analytics.orjson is not None else 'json',
+        'legacy': measure(lambda: encode_legacy(users), args.repeat),
+        'fast': measure(lambda: encode_fast(analytics, rows), args.repeat)
+    }
+    results['speedup_p50'] = round(results['legacy']['p50_ms'] / results['fast']['p50_ms'], 2) if results['fast']['p50_ms'] else None
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
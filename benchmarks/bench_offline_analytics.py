@@ -0,0 +1,133 @@
+'''
+Офлайн-аналитика (offline_analytics) на синтетическом наборе: по умолчанию 10M сообщений от 500k пользователей
+за 180 дней, 2M строк costs, 3M диалогов. С --write набор сначала пишется в снимки формата auto-backup
+и читается обратно через load_table (memory map), иначе метрики считаются по таблицам в памяти.
+
+Запуск: python benchmarks/bench_offline_analytics.py --messages 10000000 --users 500000 [--write /tmp/bench_snapshots]
+'''
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import offline_analytics
+
+UTM_SOURCES = ['yandex_direct', 'telegram', 'organic', None]
+CATEGORIES = ['productivity', 'learning', 'creative', 'health', 'business', None]
+MODELS = ['openai/gpt-4.1-mini', 'GPT-4', 'GPT-3.5']
+START = np.datetime64('2025-01-01T00:00:00', 'us')
+DAY_US = 86400 * 10 ** 6
+
+def make_dataset(rng, messages, users, costs, dialogs, days):
+    '''Пользователи приходят равномерно, активность затухает экспоненциально, нагрузка по пользователям — степенная'''
+    telegram_ids = np.arange(users, dtype=np.int64) + 900000000
+    first_day = rng.integers(0, days, users)
+    weights = rng.pareto(1.5, users) + 1
+    weights /= weights.sum()
+
+    def events(count):
+        owner = rng.choice(users, count, p=weights)
+        day = np.minimum(first_day[owner] + rng.exponential(14, count).astype(np.int64), days - 1)
+        return owner, START + (day * DAY_US + rng.integers(0, DAY_US, count)).astype('timedelta64[us]')
+    
+    owner, ts = events(messages)
+    message_table = pa.table({
+        'id': np.arange(1, messages + 1, dtype=np.int64),
+        'user_id': telegram_ids[owner],
+        'timestamp': pa.array(ts, pa.timestamp('us'))
+    })
+    owner, ts = events(costs)
+    cost_table = pa.table({
+        'id': np.arange(1, costs + 1, dtype=np.int64),
+        'user_id': telegram_ids[owner],
+        'tokens_used': rng.integers(50, 3000, costs),
+        'cost_dollars': rng.random(costs) / 100,
+        'date': pa.array(ts.astype('datetime64[D]'), pa.date32())
+    })
+    owner, ts = events(dialogs)
+    dialog_table = pa.table({
+        'id': np.arange(1, dialogs + 1, dtype=np.int64),
+        'created_at': pa.array(ts, pa.timestamp('us')),
+        'tokens': rng.integers(50, 3000, dialogs),
+        'model': pa.array(np.array(MODELS)[rng.integers(0, len(MODELS), dialogs)]),
+        'status': pa.array(np.where(rng.random(dialogs) < 0.8, 'Активный', 'Завершён'))
+    })
+    profile_table = pa.table({
+        'id': np.arange(1, users + 1, dtype=np.int64),
+        'telegram_user_id': telegram_ids,
+        'status': pa.array(np.where(rng.random(users) < 0.05, 'premium', 'active')),
+        'utm_source': pa.array([UTM_SOURCES[i] for i in rng.integers(0, len(UTM_SOURCES), users)], pa.string()),
+        'utm_campaign': pa.nulls(users, pa.string()),
+        'first_question_category': pa.array([CATEGORIES[i] for i in rng.integers(0, len(CATEGORIES), users)], pa.string())
+    })
+    return {'messages': message_table, 'costs': cost_table, 'dialogs': dialog_table, 'users_enhanced': profile_table}
+
+def write_snapshots(root, dataset):
+    '''Раскладывает таблицы по партициям date=YYYY-MM-DD (users_enhanced — snapshot=) как auto-backup'''
+    day_columns = {'messages': 'timestamp', 'costs': 'date', 'dialogs': 'created_at'}
+    for name, table in dataset.items():
+        if name not in day_columns:
+            os.makedirs(os.path.join(root, name, 'snapshot=2025-07-01'), exist_ok=True)
+            pq.write_table(table, os.path.join(root, name, 'snapshot=2025-07-01', 'part-00000.parquet'), compression='zstd')
+            continue
+        days = table.column(day_columns[name]).cast(pa.date32()).to_numpy()
+        order = np.argsort(days, kind='stable')
+        table, days = table.take(order), days[order]
+        bounds = np.flatnonzero(np.diff(days.astype(np.int64))) + 1
+        for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(days)]):
+            directory = os.path.join(root, name, 'date=' + str(days[start]))
+            os.makedirs(directory, exist_ok=True)
+            pq.write_table(table.slice(start, stop - start), os.path.join(directory, 'part-0.parquet'), compression='zstd')
+
+def timed(results, name, fn):
+    start = time.perf_counter()
+    value = fn()
+    results[name] = round((time.perf_counter() - start) * 1000, 1)
+    return value
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=10000000)
+    parser.add_argument('--users', type=int, default=500000)
+    parser.add_argument('--costs', type=int, default=2000000)
+    parser.add_argument('--dialogs', type=int, default=3000000)
+    parser.add_argument('--days', type=int, default=180)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--write', help='каталог для снимков; без него метрики считаются по таблицам в памяти')
+    args = parser.parse_args()
+    
+    rng = np.random.default_rng(args.seed)
+    timings = {}
+    dataset = timed(timings, 'generate_ms', lambda: make_dataset(rng, args.messages, args.users, args.costs, args.dialogs, args.days))
+    
+    if args.write:
+        timed(timings, 'write_snapshots_ms', lambda: write_snapshots(args.write, dataset))
+        dataset = timed(timings, 'load_snapshots_ms', lambda: {
+            name: offline_analytics.load_table(args.write, name) for name in dataset
+        })
+    
+    messages, profiles = dataset['messages'], dataset['users_enhanced']
+    activity = timed(timings, 'user_activity_ms', lambda: offline_analytics.user_activity(messages))
+    timed(timings, 'retention_ms', lambda: offline_analytics.retention(activity, 'week', 12))
+    timed(timings, 'retention_by_utm_ms', lambda: offline_analytics.retention(activity, 'week', 12, profiles, 'utm_source'))
+    timed(timings, 'cohort_matrix_ms', lambda: offline_analytics.cohort_matrix(activity, 'week', 12))
+    timed(timings, 'cost_per_cohort_ms', lambda: offline_analytics.cost_per_cohort(activity, dataset['costs'], 'week'))
+    timed(timings, 'funnel_by_utm_ms', lambda: offline_analytics.funnel(activity, profiles, 'utm_source'))
+    timed(timings, 'summary_ms', lambda: offline_analytics.summary(dataset['dialogs'], profiles, messages, 7))
+    
+    print(json.dumps({
+        'messages': args.messages,
+        'users': args.users,
+        'messages_per_second_user_activity': round(args.messages / (timings['user_activity_ms'] / 1000)) if timings['user_activity_ms'] else None,
+        'timings': timings
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
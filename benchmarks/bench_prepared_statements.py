@@ -0,0 +1,65 @@
+'''
+Латентность типовых запросов чтения: обычный execute (текст разбирается и планируется на каждый вызов)
+против execute_prepared (PREPARE один раз на соединение, дальше EXECUTE с готовым планом).
+
+Запросы берутся из самих функций: страница get-messages, сводка и последние диалоги get-analytics.
+В конце печатаются гистограммы latency_stats, которые функции копят по спанам sql.<метка>.
+
+Запуск: DATABASE_URL=postgres://... python benchmarks/bench_prepared_statements.py --repeat 2000 --telegram-id 900000001
+'''
+import argparse
+import json
+import time
+
+from psycopg2.extras import RealDictCursor
+
+from common import load_function, summarize
+
+MESSAGES_PAGE_QUERY = (
+    "SELECT id AS cursor_id, timestamp AS cursor_ts, message, sender, timestamp FROM messages " +
+    "WHERE user_id = %(telegram_id)s ORDER BY timestamp DESC, id DESC LIMIT %(limit)s"
+)
+RECENT_DIALOGS_QUERY = (
+    "SELECT d.id, u.name as user, d.tokens, d.model, d.status FROM dialogs d JOIN users u ON d.user_id = u.id " +
+    "WHERE d.model = %(model)s ORDER BY d.created_at DESC LIMIT 100"
+)
+
+def run(conn, fn, repeat):
+    samples = []
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn(cur)
+            cur.fetchall()
+            samples.append((time.perf_counter() - start) * 1000)
+    return summarize(samples)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--telegram-id', type=int, default=900000001)
+    args = parser.parse_args()
+
+    analytics = load_function('get-analytics')
+    cases = {
+        'messages_page': (MESSAGES_PAGE_QUERY, {'telegram_id': args.telegram_id, 'limit': 101}),
+        'recent_dialogs': (RECENT_DIALOGS_QUERY, {'model': 'GPT-4'}),
+        'summary': (analytics.SUMMARY_QUERY, None)
+    }
+
+    results = {}
+    with analytics.db_connection() as conn:
+        for label, (sql, params) in cases.items():
+            results[label] = {
+                'plain': run(conn, lambda cur: cur.execute(sql, params), args.repeat),
+                'prepared': run(conn, lambda cur: analytics.execute_prepared(cur, label, sql, params), args.repeat)
+            }
+            plain, prepared = results[label]['plain'], results[label]['prepared']
+            results[label]['speedup_p50'] = round(plain['p50_ms'] / prepared['p50_ms'], 2) if prepared['p50_ms'] else None
+        conn.rollback()
+
+    results['histograms'] = {'buckets_ms': list(analytics.LATENCY_BUCKETS_MS) + ['inf'], **analytics.latency_stats}
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+'''
+Сравнение латентности записи одного сообщения в bot-webhook:
+legacy (~10 последовательных запросов) против single (один CTE с upsert'ами).
+
+Запуск: DATABASE_URL=postgres://... python benchmarks/bench_webhook_ingest.py --messages 2000
+'''
+import argparse
+import json
+import random
+import time
+
+from common import load_function, summarize
+
+def make_payload(rng, users):
+    telegram_id = rng.randint(1, users)
+    tokens = rng.randint(50, 3000)
+    # Разбивка без лишних вызовов rng: поток нагрузки load_test остаётся тем же, что в baseline
+    prompt_tokens = tokens // 3
+    return {
+        'telegram_id': 900000000 + telegram_id,
+        'name': 'Bench User ' + str(telegram_id),
+        'username': 'bench_' + str(telegram_id),
+        'tokens': tokens,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': tokens - prompt_tokens,
+        'model': rng.choice(['openai/gpt-4.1-mini', 'GPT-4', 'GPT-3.5']),
+        'premium': rng.random() < 0.1,
+        'email': None,
+        'user_message': 'Как начать копить? ' * rng.randint(1, 5),
+        'assistant_message': 'Начните с бюджета. ' * rng.randint(5, 40),
+        'interaction_type': 'chat'
+    }
+
+def run_mode(webhook, ingest, messages, users, seed):
+    rng = random.Random(seed)
+    samples = []
+    with webhook.db_connection() as conn:
+        for _ in range(messages):
+            payload = make_payload(rng, users)
+            start = time.perf_counter()
+            ingest(conn, payload, time.time())
+            samples.append((time.perf_counter() - start) * 1000)
+    return summarize(samples)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    
+    webhook = load_function('bot-webhook')
+    results = {
+        'legacy': run_mode(webhook, webhook.ingest_legacy, args.messages, args.users, args.seed),
+        'single': run_mode(webhook, webhook.ingest_single_statement, args.messages, args.users, args.seed)
+    }
+    results['speedup_p50'] = round(results['legacy']['p50_ms'] / results['single']['p50_ms'], 2) if results['single']['p50_ms'] else None
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
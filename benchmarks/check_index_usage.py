@@ -0,0 +1,86 @@
+'''
+Регрессионная проверка планов: запросы диапазонов дат должны использовать индексы,
+а не Seq Scan. Запросы берутся прямо из модулей функций, поэтому проверка ловит
+возврат к DATE(column) = ... и подобным несаргабельным предикатам.
+
+Автоматически проверка идёт в каждом прогоне load_test.py (до нагрузки, на той же базе): провал
+попадает в regressions отчёта и даёт код выхода 1. Отдельно, вручную:
+DATABASE_URL=postgres://... python benchmarks/check_index_usage.py
+Код возврата 1, если хоть один запрос читает таблицу последовательным сканом.
+'''
+import os
+import sys
+from datetime import date, timedelta
+
+import psycopg2
+
+from common import load_function
+
+WEBHOOK_ACTIVE_USERS_QUERY = "SELECT COUNT(DISTINCT telegram_id) as count FROM dialogs WHERE created_at >= %(start)s AND created_at < %(end)s"
+
+def index_checks():
+    '''(название, запрос, таблица) — запросы диапазонов дат из текущего кода функций'''
+    dau, quality, costs, dashboard = (load_function(name) for name in ('get-dau', 'get-quality', 'get-costs', 'dashboard'))
+    return [
+        ('get-dau', dau.DAU_QUERY, 'messages'),
+        ('get-dau daily', dau.DAU_DAILY_QUERY, 'messages'),
+        ('get-dau sketches', dau.SKETCH_QUERY, 'dau_sketches'),
+        ('get-quality', quality.QUALITY_QUERY, 'messages'),
+        ('get-quality daily', quality.QUALITY_DAILY_QUERY, 'messages'),
+        ('get-costs rollup', costs.COSTS_ROLLUP_QUERY, 'cost_rollups'),
+        ('dashboard activity', dashboard.ACTIVITY_QUERY, 'messages'),
+        ('dashboard costs daily', dashboard.COSTS_DAILY_QUERY, 'cost_rollups'),
+        ('dashboard models', dashboard.MODELS_QUERY, 'dialog_rollups'),
+        ('bot-webhook active users', WEBHOOK_ACTIVE_USERS_QUERY, 'dialogs')
+    ]
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+def _table_of(relation, tables):
+    '''Секции messages_p2024_01 / messages_default относятся к родительской таблице'''
+    for table in tables:
+        if relation == table or relation == table + '_default' or relation.startswith(table + '_p'):
+            return table
+    return relation
+
+def scans_by_relation(cur, query, params, tables=()):
+    '''Возвращает {таблица: {типы узлов сканирования}} из EXPLAIN (FORMAT JSON)'''
+    cur.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+    plan = cur.fetchone()[0][0]['Plan']
+    scans = {}
+    for node in plan_nodes(plan):
+        if 'Relation Name' in node:
+            scans.setdefault(_table_of(node['Relation Name'], tables), set()).add(node['Node Type'])
+    return scans
+
+def check_index_usage(database_url):
+    '''[{name, relation, scans, ok}] по каждому запросу; ok — таблица читается и ни одним Seq Scan'''
+    checks = index_checks()
+    tables = {relation for _, _, relation in checks}
+    params = {'start': date.today() - timedelta(days=6), 'end': date.today() + timedelta(days=1)}
+    
+    conn = psycopg2.connect(database_url)
+    try:
+        cur = conn.cursor()
+        # На маленьких таблицах планировщик честно выбирает Seq Scan; проверяем, что индекс применим вообще
+        cur.execute('SET enable_seqscan = off')
+        results = []
+        for name, query, relation in checks:
+            scans = scans_by_relation(cur, query, params, tables).get(relation, set())
+            results.append({'name': name, 'relation': relation, 'scans': sorted(scans), 'ok': bool(scans) and 'Seq Scan' not in scans})
+        conn.rollback()
+    finally:
+        conn.close()
+    return results
+
+def main():
+    results = check_index_usage(os.environ['DATABASE_URL'])
+    for result in results:
+        print(('OK   ' if result['ok'] else 'FAIL ') + result['name'] + ': ' + result['relation'] + ' -> ' + (', '.join(result['scans']) or 'not scanned'))
+    sys.exit(0 if all(result['ok'] for result in results) else 1)
+
+if __name__ == '__main__':
+    main()
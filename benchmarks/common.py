@@ -0,0 +1,33 @@
+'''Общие утилиты бенчмарков: загрузка облачных функций из backend/ и перцентили'''
+import importlib.util
+import os
+import statistics
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+
+def load_function(name):
+    '''Импортирует backend/<name>/index.py как отдельный модуль (в имени функции есть дефис)'''
+    path = os.path.join(BACKEND_DIR, name, 'index.py')
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def percentile(samples, pct):
+    '''Перцентиль по отсортированной выборке (nearest-rank)'''
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[rank]
+
+def summarize(samples_ms):
+    '''Сводка латентности в миллисекундах'''
+    return {
+        'count': len(samples_ms),
+        'mean_ms': round(statistics.mean(samples_ms), 3) if samples_ms else 0.0,
+        'p50_ms': round(percentile(samples_ms, 50), 3),
+        'p95_ms': round(percentile(samples_ms, 95), 3),
+        'p99_ms': round(percentile(samples_ms, 99), 3),
+        'max_ms': round(max(samples_ms), 3) if samples_ms else 0.0
+    }
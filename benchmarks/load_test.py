@@ -0,0 +1,337 @@
+'''
+Нагрузочный прогон облачных функций in-process: handler(event, context) вызывается напрямую, как в рантайме,
+против локального Postgres (--local: временный кластер + db_migrations) или базы из --database-url.
+
+Фазы:
+  1. (--users/--dialogs/--messages) seed.py заполняет базу синтетикой нужного масштаба, затем check_index_usage.py
+     проверяет планы запросов диапазонов дат (Seq Scan вместо индекса — регрессия, код выхода 1);
+  2. читающие функции гоняются замкнутым циклом в --concurrency потоков, по --requests вызовов на функцию;
+  3. bot-webhook получает поток сообщений с частотой --rps в течение --duration секунд. Модель открытая:
+     латентность считается от запланированного момента отправки, так что очередь при перегрузке видна в хвостах.
+
+По каждой функции печатаются запросы, ошибки, отказы по перегрузке (429/503 с Retry-After), пропускная способность, перцентили латентности, среднее число
+SQL-запросов на вызов (psycopg2.connect подменяется внутри процесса бенчмарка, код функций не меняется)
+и средние спаны из Server-Timing. Запросы фоновых потоков (очередь событий, сброс гистограмм) идут в background.
+
+С --baseline результаты сравниваются с сохранённым прогоном того же масштаба: рост p95 или падение
+пропускной способности больше --tolerance, рост числа запросов на вызов, новые ошибки или отказы — код выхода 1.
+--update-baseline перезаписывает файл текущим прогоном.
+
+Запуск: python benchmarks/load_test.py --local --users 10000 --dialogs 100000 --messages 200000 \\
+            --requests 500 --rps 50 --duration 30 --baseline benchmarks/baseline.json
+'''
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import psycopg2
+import psycopg2.extensions
+
+from bench_webhook_ingest import make_payload
+from check_index_usage import check_index_usage
+from common import load_function, summarize
+from local_db import apply_migrations, start_local_postgres
+from seed import TELEGRAM_ID_BASE, seed
+
+READ_HANDLERS = (
+    'get-analytics', 'get-dau', 'get-costs', 'get-quality', 'get-messages', 'get-user-history',
+    'dashboard', 'export', 'metrics', 'search', 'leaderboard'
+)
+WEBHOOK = 'bot-webhook'
+
+_current = threading.local()
+_query_counts = {}
+_query_lock = threading.Lock()
+_counting_classes = {}
+
+def _count_query():
+    name = getattr(_current, 'handler', None) or 'background'
+    with _query_lock:
+        _query_counts[name] = _query_counts.get(name, 0) + 1
+
+def _counting_cursor(base):
+    '''Подкласс курсора (обычного, RealDictCursor, именованного), который считает execute/executemany'''
+    cls = _counting_classes.get(base)
+    if cls is None:
+        class CountingCursor(base):
+            def execute(self, query, vars=None):
+                _count_query()
+                return super().execute(query, vars)
+
+            def executemany(self, query, vars_list):
+                _count_query()
+                return super().executemany(query, vars_list)
+        
+        cls = _counting_classes[base] = CountingCursor
+    return cls
+
+def _counting_connection(base):
+    '''Подкласс connection_factory функции (например, PreparedConnection), выдающий считающие курсоры'''
+    cls = _counting_classes.get(base)
+    if cls is None:
+        class CountingConnection(base):
+            def cursor(self, *args, **kwargs):
+                factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+                kwargs['cursor_factory'] = _counting_cursor(factory)
+                return super().cursor(*args, **kwargs)
+        
+        cls = _counting_classes[base] = CountingConnection
+    return cls
+
+def install_query_counter():
+    '''Подменяет psycopg2.connect: все соединения, которые откроют функции, считают свои запросы'''
+    connect = psycopg2.connect
+
+    def counting_connect(dsn=None, connection_factory=None, **kwargs):
+        factory = _counting_connection(connection_factory or psycopg2.extensions.connection)
+        return connect(dsn, connection_factory=factory, **kwargs)
+    
+    psycopg2.connect = counting_connect
+
+def take_query_counts():
+    with _query_lock:
+        counts = dict(_query_counts)
+        _query_counts.clear()
+    return counts
+
+class Context:
+    def __init__(self, function_name, request_id):
+        self.function_name = function_name
+        self.request_id = request_id
+
+def parse_server_timing(header):
+    '''"connect;dur=1.2, sql.dau;dur=3.4" -> {'connect': 1.2, 'sql.dau': 3.4}'''
+    spans = {}
+    for part in (header or '').split(','):
+        name, _, dur = part.strip().partition(';dur=')
+        if name and dur:
+            spans[name] = float(dur)
+    return spans
+
+# Ответы admission control bot-webhook: функция жива, но полоса переполнена — считаются отдельно от ошибок
+REJECTED_STATUS_CODES = (429, 503)
+
+class HandlerStats:
+    '''Латентности, ошибки, отказы по перегрузке и суммы спанов одной функции за фазу (пишут несколько потоков)'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+        self.errors = 0
+        self.rejected = 0
+        self.span_totals = {}
+
+    def record(self, elapsed_ms, response):
+        spans = parse_server_timing((response.get('headers') or {}).get('Server-Timing')) if response else {}
+        with self.lock:
+            self.samples.append(elapsed_ms)
+            status_code = response.get('statusCode', 500) if response else 500
+            if status_code in REJECTED_STATUS_CODES:
+                self.rejected += 1
+            elif status_code >= 400:
+                self.errors += 1
+            for name, ms in spans.items():
+                self.span_totals[name] = self.span_totals.get(name, 0.0) + ms
+
+    def report(self, elapsed_s, queries):
+        requests = len(self.samples)
+        return {
+            'requests': requests,
+            'errors': self.errors,
+            'rejected': self.rejected,
+            'throughput_rps': round(requests / elapsed_s, 1) if elapsed_s else 0.0,
+            'latency': summarize(self.samples),
+            'queries_per_request': round(queries / requests, 2) if requests else 0.0,
+            'spans_mean_ms': {name: round(total / requests, 3) for name, total in sorted(self.span_totals.items())}
+        }
+
+def invoke(module, name, event, index):
+    _current.handler = name
+    try:
+        return module.handler(event, Context(name, name + '-' + str(index)))
+    except Exception as error:
+        print(json.dumps({'metric': 'load_test_error', 'function': name, 'error': repr(error)}))
+        return None
+    finally:
+        _current.handler = None
+
+def read_params(name, rng, users, days):
+    '''queryStringParameters типового запроса к функции: окна до 30 дней, скошенный выбор пользователя'''
+    telegram_id = str(TELEGRAM_ID_BASE + 1 + int(users * rng.random() ** 3))
+    date_to = date.today() - timedelta(days=rng.randint(0, min(days, 30)))
+    window = {'from': (date_to - timedelta(days=rng.randint(0, 29))).isoformat(), 'to': date_to.isoformat()}
+    if name == 'get-analytics':
+        return {
+            'days': str(rng.choice([1, 7, 30])),
+            'model': rng.choice(['all', 'all', 'GPT-4', 'openai/gpt-4.1-mini']),
+            'status': rng.choice(['all', 'all', 'Завершён'])
+        }
+    if name == 'get-dau':
+        return {**window, 'mode': rng.choice(['exact', 'approx'])}
+    if name in ('get-costs', 'get-quality', 'dashboard'):
+        return window
+    if name in ('get-messages', 'get-user-history'):
+        return {'telegram_id': telegram_id, 'limit': '50'}
+    if name == 'export':
+        return {'table': 'users', 'format': 'ndjson', 'after_id': str(rng.randint(0, max(users - 1000, 0))), 'limit': '1000'}
+    if name == 'metrics':
+        return {'minutes': '60'}
+    if name == 'leaderboard':
+        return {'metric': rng.choice(['tokens', 'dialogs', 'cost']), 'window': rng.choice(['0', '1', '7', '30']), 'k': '10'}
+    if name == 'search':
+        return {'q': rng.choice(['вопрос', 'ответ', 'слово']), 'source': rng.choice(['messages', 'dialogs']), 'limit': '20'}
+    return {}
+
+def run_reads(module, name, requests, concurrency, rng, users, days):
+    '''Замкнутый цикл: concurrency потоков, каждый шлёт следующий запрос сразу после ответа'''
+    stats = HandlerStats()
+    events = [{'httpMethod': 'GET', 'headers': {}, 'queryStringParameters': read_params(name, rng, users, days)} for _ in range(requests)]
+
+    def one(item):
+        index, event = item
+        start = time.perf_counter()
+        response = invoke(module, name, event, index)
+        stats.record((time.perf_counter() - start) * 1000, response)
+    
+    take_query_counts()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, enumerate(events)))
+    elapsed = time.perf_counter() - started
+    return stats.report(elapsed, take_query_counts().get(name, 0))
+
+def run_webhook(module, rps, duration, concurrency, rng, users):
+    '''Открытая модель: сообщение i отправляется в start + i / rps, латентность — от этого момента'''
+    stats = HandlerStats()
+    payloads = [json.dumps(make_payload(rng, users), ensure_ascii=False) for _ in range(int(rps * duration))]
+    start = time.perf_counter() + 0.1
+
+    def one(item):
+        index, body = item
+        scheduled = start + index / rps
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        event = {'httpMethod': 'POST', 'headers': {'Content-Type': 'application/json'}, 'body': body}
+        response = invoke(module, WEBHOOK, event, index)
+        stats.record((time.perf_counter() - scheduled) * 1000, response)
+    
+    take_query_counts()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, enumerate(payloads)))
+    elapsed = time.perf_counter() - start
+    if hasattr(module, 'flush_events'):
+        module.flush_events()
+    result = stats.report(elapsed, take_query_counts().get(WEBHOOK, 0))
+    result['target_rps'] = rps
+    return result
+
+def compare(results, baseline, tolerance):
+    '''Список регрессий относительно baseline (функции, которых нет в baseline, не сравниваются)'''
+    failures = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        if current['latency']['p95_ms'] > previous['latency']['p95_ms'] * (1 + tolerance):
+            failures.append(name + ': p95 ' + str(current['latency']['p95_ms']) + 'ms > baseline ' + str(previous['latency']['p95_ms']) + 'ms')
+        if current['throughput_rps'] < previous['throughput_rps'] * (1 - tolerance):
+            failures.append(name + ': throughput ' + str(current['throughput_rps']) + ' rps < baseline ' + str(previous['throughput_rps']) + ' rps')
+        if current['queries_per_request'] > previous['queries_per_request'] + 0.01:
+            failures.append(name + ': queries/request ' + str(current['queries_per_request']) + ' > baseline ' + str(previous['queries_per_request']))
+        if current['errors'] > previous['errors']:
+            failures.append(name + ': errors ' + str(current['errors']) + ' > baseline ' + str(previous['errors']))
+        if current['rejected'] > previous.get('rejected', 0):
+            failures.append(name + ': rejected ' + str(current['rejected']) + ' > baseline ' + str(previous.get('rejected', 0)))
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--local', action='store_true', help='поднять временный Postgres и накатить db_migrations')
+    parser.add_argument('--pg-bin', help='каталог с initdb/pg_ctl для --local')
+    parser.add_argument('--users', type=int, default=0, help='заполнить базу: пользователей (0 — не заполнять)')
+    parser.add_argument('--dialogs', type=int, default=100000)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--days', type=int, default=180)
+    parser.add_argument('--id-range', type=int, default=10000, help='диапазон telegram_id без заполнения (900000001..)')
+    parser.add_argument('--handlers', default=','.join(READ_HANDLERS + (WEBHOOK,)))
+    parser.add_argument('--requests', type=int, default=300, help='запросов на читающую функцию')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rps', type=float, default=20.0, help='частота сообщений bot-webhook')
+    parser.add_argument('--duration', type=float, default=30.0, help='длительность фазы bot-webhook, с')
+    parser.add_argument('--no-cache', action='store_true', help='CACHE_TTL=0: мерить запросы к базе, а не кэш')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--handler-log', default=os.devnull, help='куда писать stdout функций (метрики в JSON-строках)')
+    parser.add_argument('--baseline')
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+    
+    stop = None
+    if args.local:
+        args.database_url, stop = start_local_postgres(pg_bin=args.pg_bin)
+    if not args.database_url:
+        parser.error('pass --database-url (or set DATABASE_URL) or --local')
+    
+    try:
+        config = {
+            'users': args.users or args.id_range, 'dialogs': args.dialogs if args.users else None,
+            'messages': args.messages if args.users else None, 'requests': args.requests,
+            'concurrency': args.concurrency, 'rps': args.rps, 'duration': args.duration, 'no_cache': args.no_cache
+        }
+        report = {'config': config, 'migrations': apply_migrations(args.database_url)}
+        if args.users:
+            report['seed'] = seed(args.database_url, args.users, args.dialogs, args.messages, args.days, reset=True)
+        report['index_usage'] = check_index_usage(args.database_url)
+        index_regressions = ['index usage: ' + r['name'] + ' reads ' + r['relation'] + ' by ' + (', '.join(r['scans']) or 'nothing') for r in report['index_usage'] if not r['ok']]
+        
+        os.environ['DATABASE_URL'] = args.database_url
+        if args.no_cache:
+            os.environ['CACHE_TTL'] = '0'
+        install_query_counter()
+        
+        rng = random.Random(args.seed)
+        users = args.users or args.id_range
+        results = {}
+        with open(args.handler_log, 'a') as handler_log, contextlib.redirect_stdout(handler_log):
+            for name in [n.strip() for n in args.handlers.split(',') if n.strip()]:
+                module = load_function(name)
+                if name == WEBHOOK:
+                    results[name] = run_webhook(module, args.rps, args.duration, args.concurrency, rng, users)
+                else:
+                    results[name] = run_reads(module, name, args.requests, args.concurrency, rng, users, args.days)
+        report['results'] = results
+        report['background_queries'] = take_query_counts().get('background', 0)
+        
+        exit_code = 0
+        if args.baseline and args.update_baseline:
+            with open(args.baseline, 'w') as f:
+                json.dump({'config': config, 'results': results}, f, indent=2, ensure_ascii=False)
+                f.write('\n')
+        elif args.baseline and os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            if baseline.get('config') != config:
+                report['regressions'] = ['baseline was recorded with a different config: ' + json.dumps(baseline.get('config'))]
+                exit_code = 2
+            else:
+                report['regressions'] = compare(results, baseline['results'], args.tolerance)
+                exit_code = 1 if report['regressions'] else 0
+        if index_regressions:
+            report['regressions'] = index_regressions + report.get('regressions', [])
+            exit_code = exit_code or 1
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    finally:
+        if stop:
+            stop()
+    sys.exit(exit_code)
+
+if __name__ == '__main__':
+    main()
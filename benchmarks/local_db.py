@@ -0,0 +1,79 @@
+'''
+Локальная база для бенчмарков: временный кластер Postgres (initdb + pg_ctl на unix-сокете) вместо облачной
+и накатка db_migrations по порядку версий. Нужны бинарники Postgres в PATH (или --pg-bin).
+'''
+import glob
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+import psycopg2
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'db_migrations')
+
+# conversations есть в рабочей базе, но ни одна миграция её не создаёт, а V0005/V0007 в неё пишут и читают
+PRE_MIGRATION_SQL = '''
+CREATE TABLE IF NOT EXISTS conversations (
+  id SERIAL PRIMARY KEY,
+  user_id BIGINT,
+  message_text TEXT,
+  sender VARCHAR(10),
+  timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)
+'''
+
+def _pg_tool(name, pg_bin=None):
+    path = os.path.join(pg_bin, name) if pg_bin else shutil.which(name)
+    if not path or not os.path.exists(path):
+        raise RuntimeError(name + ' not found: install Postgres, pass --pg-bin or --database-url')
+    return path
+
+def start_local_postgres(port=54329, pg_bin=None):
+    '''Поднимает одноразовый кластер во временном каталоге; возвращает (DATABASE_URL, stop)'''
+    initdb, pg_ctl = _pg_tool('initdb', pg_bin), _pg_tool('pg_ctl', pg_bin)
+    data_dir = tempfile.mkdtemp(prefix='bench-pg-')
+    subprocess.run(
+        [initdb, '-D', data_dir, '-U', 'bench', '--auth=trust', '--encoding=UTF8', '--locale=C'],
+        check=True, stdout=subprocess.DEVNULL
+    )
+    subprocess.run(
+        [pg_ctl, '-D', data_dir, '-l', os.path.join(data_dir, 'postgres.log'), '-w', 'start',
+         '-o', '-p ' + str(port) + ' -k ' + data_dir + " -c listen_addresses='' -c max_connections=200"],
+        check=True, stdout=subprocess.DEVNULL
+    )
+
+    def stop():
+        subprocess.run([pg_ctl, '-D', data_dir, '-m', 'fast', '-w', 'stop'], stdout=subprocess.DEVNULL)
+        shutil.rmtree(data_dir, ignore_errors=True)
+    
+    return 'postgresql://bench@/postgres?host=' + data_dir + '&port=' + str(port), stop
+
+def migration_files():
+    '''V0001__... .sql, V0002__... .sql — в порядке номера версии'''
+    files = glob.glob(os.path.join(MIGRATIONS_DIR, 'V*__*.sql'))
+    return sorted(files, key=lambda path: int(re.match(r'V(\d+)__', os.path.basename(path)).group(1)))
+
+def apply_migrations(database_url):
+    '''Накатывает все миграции, если схемы ещё нет (нет таблицы users); каждая — в своей транзакции'''
+    conn = psycopg2.connect(database_url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('users') IS NOT NULL")
+            if cur.fetchone()[0]:
+                return []
+        with conn.cursor() as cur:
+            cur.execute(PRE_MIGRATION_SQL)
+        conn.commit()
+        applied = []
+        for path in migration_files():
+            with open(path, encoding='utf-8') as migration:
+                sql = migration.read()
+            with conn.cursor() as cur:
+                cur.execute(sql)
+            conn.commit()
+            applied.append(os.path.basename(path))
+        return applied
+    finally:
+        conn.close()
@@ -0,0 +1,148 @@
+'''
+Синтетические данные для бенчмарков прямо в Postgres через generate_series: пользователи, диалоги,
+сообщения, costs (стоимость по model_prices), token_stats, скетчи DAU, агрегаты, статистика users_enhanced
+и лидерборд. Масштаб — от 10k до 10M строк.
+
+Активность по пользователям скошена (power(random(), 3)): немногие пользователи дают большую часть
+диалогов, как в рабочих данных. Триггеры агрегатов на время вставки отключаются
+(session_replication_role = replica, нужен суперпользователь), а агрегаты пересобираются в конце.
+
+Запуск: DATABASE_URL=postgres://... python benchmarks/seed.py --users 100000 --dialogs 1000000 --messages 2000000 [--reset]
+'''
+import argparse
+import json
+import os
+import time
+
+import psycopg2
+
+SEED_TABLES = (
+    'users', 'dialogs', 'messages', 'costs', 'token_stats', 'dau_sketches', 'event_logs', 'ingest_keys',
+    'dialog_rollups', 'cost_rollups', 'user_counters', 'users_enhanced', 'ingest_events', 'user_daily_stats',
+    'leaderboard_entries'
+)
+TELEGRAM_ID_BASE = 900000000
+PARTITIONED_TABLES = ('dialogs', 'messages', 'event_logs')
+
+USERS_SQL = (
+    "INSERT INTO users (telegram_id, name, username, email, premium, total_tokens, dialogs_count, created_at, last_active) " +
+    "SELECT %(base)s + g, 'Bench ' || g, 'bench_' || g, CASE WHEN g %% 3 = 0 THEN 'bench' || g || '@example.com' END, " +
+    "random() < 0.1, 0, 0, now() - random() * make_interval(days => %(days)s), now() " +
+    "FROM generate_series(1, %(users)s) AS g"
+)
+DIALOGS_SQL = (
+    "INSERT INTO dialogs (user_id, telegram_id, username, tokens, model, status, user_message, assistant_message, interaction_type, created_at, updated_at) " +
+    "SELECT u.id, u.telegram_id, u.username, t.tokens, t.model, t.status, 'Вопрос ' || t.g, repeat('Ответ ', t.words), 'chat', t.created_at, t.created_at " +
+    "FROM (SELECT g, %(base)s + 1 + floor(%(users)s * power(random(), 3))::bigint AS telegram_id, (50 + random() * 2950)::int AS tokens, " +
+    "(ARRAY['openai/gpt-4.1-mini', 'GPT-4', 'GPT-3.5'])[1 + floor(random() * 3)::int] AS model, " +
+    "CASE WHEN random() < 0.8 THEN 'Завершён' ELSE 'Активный' END AS status, (1 + random() * 60)::int AS words, " +
+    "now() - random() * make_interval(days => %(days)s) AS created_at FROM generate_series(1, %(dialogs)s) AS g) t " +
+    "JOIN users u ON u.telegram_id = t.telegram_id"
+)
+MESSAGES_SQL = (
+    "INSERT INTO messages (user_id, message, sender, timestamp) " +
+    "SELECT %(base)s + 1 + floor(%(users)s * power(random(), 3))::bigint, repeat('слово ', (1 + random() * 30)::int), " +
+    "CASE WHEN g %% 2 = 0 THEN 'bot' ELSE 'user' END, now() - random() * make_interval(days => %(days)s) " +
+    "FROM generate_series(1, %(messages)s) AS g"
+)
+COSTS_SQL = (
+    "INSERT INTO costs (user_id, tokens_used, model, date) " +
+    "SELECT telegram_id, tokens, model, created_at::date FROM dialogs WHERE tokens > 0"
+)
+TOKEN_STATS_SQL = (
+    "INSERT INTO token_stats (date, total_tokens, active_users) " +
+    "SELECT created_at::date, SUM(tokens), COUNT(DISTINCT telegram_id) FROM dialogs GROUP BY 1 " +
+    "ON CONFLICT (date) DO UPDATE SET total_tokens = EXCLUDED.total_tokens, active_users = EXCLUDED.active_users"
+)
+USER_TOTALS_SQL = (
+    "UPDATE users u SET total_tokens = d.tokens, dialogs_count = d.dialogs, last_active = d.last_active " +
+    "FROM (SELECT user_id, SUM(tokens) AS tokens, COUNT(*) AS dialogs, MAX(created_at) AS last_active FROM dialogs GROUP BY user_id) d " +
+    "WHERE u.id = d.user_id"
+)
+# Как бэкфилл в V0013: регистр — старшие 12 бит md5(user_id), ранг — позиция первой единицы в остальных
+DAU_SKETCHES_SQL = '''
+WITH hashed AS (
+  SELECT DISTINCT timestamp::date AS day, ('x' || substr(md5(user_id::text), 1, 16))::bit(64) AS h
+  FROM messages
+), registers AS (
+  SELECT day, substring(h FROM 1 FOR 12)::bit(12)::int AS idx,
+    COALESCE(NULLIF(position(B'1' IN substring(h FROM 13)), 0), 53) AS rank
+  FROM hashed
+), maxed AS (
+  SELECT day, idx, MAX(rank) AS rank FROM registers GROUP BY day, idx
+)
+INSERT INTO dau_sketches (day, sketch)
+SELECT d.day, decode(string_agg(lpad(to_hex(COALESCE(m.rank, 0)), 2, '0'), '' ORDER BY g.idx), 'hex')
+FROM (SELECT DISTINCT day FROM maxed) d
+CROSS JOIN generate_series(0, 4095) AS g(idx)
+LEFT JOIN maxed m ON m.day = d.day AND m.idx = g.idx
+GROUP BY d.day
+ON CONFLICT (day) DO UPDATE SET sketch = EXCLUDED.sketch
+'''
+
+def seed(database_url, users, dialogs, messages, days=180, reset=False, random_seed=0.42):
+    '''Заполняет базу синтетикой; без reset отказывается работать с непустой users. Возвращает время шагов в мс'''
+    conn = psycopg2.connect(database_url)
+    timings = {}
+    params = {'base': TELEGRAM_ID_BASE, 'users': users, 'dialogs': dialogs, 'messages': messages, 'days': days}
+
+    def step(name, sql, args=None):
+        started = time.perf_counter()
+        with conn.cursor() as cur:
+            cur.execute(sql, args)
+        conn.commit()
+        timings[name + '_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT EXISTS (SELECT 1 FROM users)")
+            if cur.fetchone()[0] and not reset:
+                raise RuntimeError('users is not empty; pass --reset to truncate the benchmark tables first')
+        if reset:
+            step('truncate', "TRUNCATE " + ', '.join(SEED_TABLES) + " RESTART IDENTITY CASCADE")
+            step('checkpoint', "UPDATE projector_checkpoints SET last_event_id = 0, events_projected = 0")
+        
+        with conn.cursor() as cur:
+            try:
+                cur.execute("SET session_replication_role = replica")
+            except psycopg2.errors.InsufficientPrivilege:
+                conn.rollback()
+            cur.execute("SELECT setseed(%s)", (random_seed,))
+            for table in PARTITIONED_TABLES:
+                cur.execute("SELECT ensure_monthly_partitions(%s, 3, (now() - make_interval(days => %s))::date)", (table, days))
+        conn.commit()
+        
+        step('users', USERS_SQL, params)
+        step('dialogs', DIALOGS_SQL, params)
+        step('messages', MESSAGES_SQL, params)
+        step('costs', COSTS_SQL)
+        step('cost_prices', "SELECT recompute_costs()")
+        step('token_stats', TOKEN_STATS_SQL)
+        step('user_totals', USER_TOTALS_SQL)
+        step('dau_sketches', DAU_SKETCHES_SQL)
+        step('rollups', "SELECT rebuild_analytics_rollups()")
+        step('user_stats', "SELECT rebuild_user_stats()")
+        step('user_daily_stats', "SELECT rebuild_user_daily_stats()")
+        step('leaderboard', "SELECT refresh_leaderboard()")
+        step('data_version', "SELECT nextval('data_version_seq')")
+        
+        conn.autocommit = True
+        step('analyze', "ANALYZE")
+    finally:
+        conn.close()
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--dialogs', type=int, default=100000)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--days', type=int, default=180)
+    parser.add_argument('--reset', action='store_true', help='очистить таблицы бенчмарка перед заполнением')
+    args = parser.parse_args()
+    
+    timings = seed(os.environ['DATABASE_URL'], args.users, args.dialogs, args.messages, args.days, args.reset)
+    print(json.dumps({'users': args.users, 'dialogs': args.dialogs, 'messages': args.messages, 'timings': timings}, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,8 @@
+-- Ключи идемпотентности для буферизованной записи bot-webhook (WEBHOOK_INGEST_MODE=buffered).
+-- Повторный сброс батча из spool не должен второй раз начислять токены.
+CREATE TABLE IF NOT EXISTS ingest_keys (
+  idempotency_key VARCHAR(128) PRIMARY KEY,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_ingest_keys_created_at ON ingest_keys(created_at);
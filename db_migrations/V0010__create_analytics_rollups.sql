@@ -0,0 +1,153 @@
+-- Инкрементальные агрегаты для get-analytics вместо полных сканов users/dialogs.
+-- Обновляются триггерами в момент записи, поэтому работают для всех режимов bot-webhook
+-- (legacy, single, buffered). Полная пересборка: SELECT rebuild_analytics_rollups();
+
+-- День × модель × статус по диалогам (NULL модели/статуса хранятся как '')
+CREATE TABLE IF NOT EXISTS dialog_rollups (
+  day DATE NOT NULL,
+  model VARCHAR(50) NOT NULL,
+  status VARCHAR(50) NOT NULL,
+  dialogs_count BIGINT DEFAULT 0,
+  tokens BIGINT DEFAULT 0,
+  PRIMARY KEY (day, model, status)
+);
+
+-- Дневные суммы по таблице costs
+CREATE TABLE IF NOT EXISTS cost_rollups (
+  day DATE PRIMARY KEY,
+  tokens_used BIGINT DEFAULT 0,
+  cost_dollars DECIMAL(14, 6) DEFAULT 0,
+  records_count BIGINT DEFAULT 0
+);
+
+-- Счётчики пользователей (одна строка)
+CREATE TABLE IF NOT EXISTS user_counters (
+  id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+  total_users BIGINT DEFAULT 0,
+  premium_users BIGINT DEFAULT 0
+);
+
+CREATE OR REPLACE FUNCTION dialog_rollups_apply(p_day DATE, p_model VARCHAR, p_status VARCHAR, p_dialogs BIGINT, p_tokens BIGINT)
+RETURNS VOID AS $$
+BEGIN
+  INSERT INTO dialog_rollups (day, model, status, dialogs_count, tokens)
+  VALUES (p_day, COALESCE(p_model, ''), COALESCE(p_status, ''), p_dialogs, p_tokens)
+  ON CONFLICT (day, model, status) DO UPDATE SET
+    dialogs_count = dialog_rollups.dialogs_count + EXCLUDED.dialogs_count,
+    tokens = dialog_rollups.tokens + EXCLUDED.tokens;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION dialog_rollups_trigger()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    PERFORM dialog_rollups_apply(COALESCE(OLD.created_at, CURRENT_TIMESTAMP)::date, OLD.model, OLD.status, -1, -COALESCE(OLD.tokens, 0));
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    PERFORM dialog_rollups_apply(COALESCE(NEW.created_at, CURRENT_TIMESTAMP)::date, NEW.model, NEW.status, 1, COALESCE(NEW.tokens, 0));
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION cost_rollups_apply(p_day DATE, p_tokens BIGINT, p_cost DECIMAL, p_records BIGINT)
+RETURNS VOID AS $$
+BEGIN
+  IF p_day IS NULL THEN
+    RETURN;
+  END IF;
+  INSERT INTO cost_rollups (day, tokens_used, cost_dollars, records_count)
+  VALUES (p_day, p_tokens, p_cost, p_records)
+  ON CONFLICT (day) DO UPDATE SET
+    tokens_used = cost_rollups.tokens_used + EXCLUDED.tokens_used,
+    cost_dollars = cost_rollups.cost_dollars + EXCLUDED.cost_dollars,
+    records_count = cost_rollups.records_count + EXCLUDED.records_count;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION cost_rollups_trigger()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    PERFORM cost_rollups_apply(OLD.date, -COALESCE(OLD.tokens_used, 0), -COALESCE(OLD.cost_dollars, 0), -1);
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    PERFORM cost_rollups_apply(NEW.date, COALESCE(NEW.tokens_used, 0), COALESCE(NEW.cost_dollars, 0), 1);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Строка счётчиков трогается только при появлении пользователя или смене premium
+CREATE OR REPLACE FUNCTION user_counters_trigger()
+RETURNS TRIGGER AS $$
+DECLARE
+  d_total BIGINT := 0;
+  d_premium BIGINT := 0;
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    d_total := 1;
+    d_premium := (NEW.premium IS TRUE)::int;
+  ELSIF TG_OP = 'DELETE' THEN
+    d_total := -1;
+    d_premium := -(OLD.premium IS TRUE)::int;
+  ELSE
+    d_premium := (NEW.premium IS TRUE)::int - (OLD.premium IS TRUE)::int;
+  END IF;
+  IF d_total <> 0 OR d_premium <> 0 THEN
+    INSERT INTO user_counters (id, total_users, premium_users) VALUES (1, d_total, d_premium)
+    ON CONFLICT (id) DO UPDATE SET
+      total_users = user_counters.total_users + EXCLUDED.total_users,
+      premium_users = user_counters.premium_users + EXCLUDED.premium_users;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_dialog_rollups
+AFTER INSERT OR UPDATE OF created_at, model, status, tokens OR DELETE ON dialogs
+FOR EACH ROW EXECUTE FUNCTION dialog_rollups_trigger();
+
+CREATE TRIGGER trg_cost_rollups
+AFTER INSERT OR UPDATE OF date, tokens_used, cost_dollars OR DELETE ON costs
+FOR EACH ROW EXECUTE FUNCTION cost_rollups_trigger();
+
+CREATE TRIGGER trg_user_counters
+AFTER INSERT OR UPDATE OF premium OR DELETE ON users
+FOR EACH ROW EXECUTE FUNCTION user_counters_trigger();
+
+-- Пересборка агрегатов из истории dialogs/costs/users (backfill)
+CREATE OR REPLACE FUNCTION rebuild_analytics_rollups()
+RETURNS VOID AS $$
+BEGIN
+  LOCK TABLE dialogs, costs, users IN SHARE MODE;
+
+  DELETE FROM dialog_rollups;
+  INSERT INTO dialog_rollups (day, model, status, dialogs_count, tokens)
+  SELECT
+    COALESCE(created_at, CURRENT_TIMESTAMP)::date,
+    COALESCE(model, ''),
+    COALESCE(status, ''),
+    COUNT(*),
+    COALESCE(SUM(tokens), 0)
+  FROM dialogs
+  GROUP BY 1, 2, 3;
+
+  DELETE FROM cost_rollups;
+  INSERT INTO cost_rollups (day, tokens_used, cost_dollars, records_count)
+  SELECT date, COALESCE(SUM(tokens_used), 0), COALESCE(SUM(cost_dollars), 0), COUNT(*)
+  FROM costs
+  WHERE date IS NOT NULL
+  GROUP BY date;
+
+  DELETE FROM user_counters;
+  INSERT INTO user_counters (id, total_users, premium_users)
+  SELECT 1, COUNT(*), COUNT(*) FILTER (WHERE premium = true)
+  FROM users;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_analytics_rollups();
+
+CREATE INDEX IF NOT EXISTS idx_dialog_rollups_status ON dialog_rollups(status);
@@ -0,0 +1,8 @@
+-- Составные индексы для keyset-пагинации get-messages и get-user-history:
+-- страница истории читается одним index range scan независимо от её длины.
+CREATE INDEX IF NOT EXISTS idx_messages_user_ts_id ON messages(user_id, timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_dialogs_user_created_id ON dialogs(user_id, created_at, id);
+
+-- Одноколоночные индексы по user_id покрываются префиксом новых индексов
+DROP INDEX IF EXISTS idx_messages_user_id;
+DROP INDEX IF EXISTS idx_dialogs_user_id;
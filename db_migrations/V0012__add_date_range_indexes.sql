@@ -0,0 +1,10 @@
+-- Индексы под полуоткрытые диапазоны дат (timestamp >= from AND timestamp < to + 1 день)
+-- в get-dau, get-quality и bot-webhook. Вторая колонка даёт index-only scan
+-- для COUNT(DISTINCT user_id) и фильтра sender = 'bot'.
+CREATE INDEX IF NOT EXISTS idx_messages_timestamp_user ON messages(timestamp, user_id);
+CREATE INDEX IF NOT EXISTS idx_messages_timestamp_sender ON messages(timestamp, sender);
+CREATE INDEX IF NOT EXISTS idx_dialogs_created_telegram ON dialogs(created_at, telegram_id);
+
+-- Одноколоночные индексы по времени покрываются префиксом новых индексов
+DROP INDEX IF EXISTS idx_messages_timestamp;
+DROP INDEX IF EXISTS idx_dialogs_created_at;
@@ -0,0 +1,51 @@
+-- Дневные HyperLogLog-скетчи активных пользователей для get-dau?mode=approx.
+-- 4096 регистров по байту (точность 12 бит), ошибка ~1.6%. Регистр = старшие 12 бит
+-- первых 64 бит md5(user_id::text), ранг = позиция первой единицы в оставшихся 52 битах.
+-- bot-webhook обновляет регистр при записи; окна WAU/MAU получаются объединением скетчей.
+CREATE TABLE IF NOT EXISTS dau_sketches (
+  day DATE PRIMARY KEY,
+  sketch BYTEA NOT NULL
+);
+
+-- Объединение скетчей: побайтовый максимум (используется при пакетной записи)
+CREATE OR REPLACE FUNCTION hll_merge(a BYTEA, b BYTEA)
+RETURNS BYTEA AS $$
+DECLARE
+  result BYTEA := a;
+BEGIN
+  FOR i IN 0 .. length(b) - 1 LOOP
+    IF get_byte(b, i) > get_byte(result, i) THEN
+      result := set_byte(result, i, get_byte(b, i));
+    END IF;
+  END LOOP;
+  RETURN result;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+-- Заполняем скетчи по существующей истории messages
+WITH hashed AS (
+  SELECT DISTINCT
+    timestamp::date AS day,
+    ('x' || substr(md5(user_id::text), 1, 16))::bit(64) AS h
+  FROM messages
+  WHERE timestamp IS NOT NULL
+), registers AS (
+  SELECT
+    day,
+    substring(h FROM 1 FOR 12)::bit(12)::int AS idx,
+    COALESCE(NULLIF(position(B'1' IN substring(h FROM 13)), 0), 53) AS rank
+  FROM hashed
+), maxed AS (
+  SELECT day, idx, MAX(rank) AS rank
+  FROM registers
+  GROUP BY day, idx
+)
+INSERT INTO dau_sketches (day, sketch)
+SELECT
+  d.day,
+  decode(string_agg(lpad(to_hex(COALESCE(m.rank, 0)), 2, '0'), '' ORDER BY g.idx), 'hex')
+FROM (SELECT DISTINCT day FROM maxed) d
+CROSS JOIN generate_series(0, 4095) AS g(idx)
+LEFT JOIN maxed m ON m.day = d.day AND m.idx = g.idx
+GROUP BY d.day
+ON CONFLICT (day) DO NOTHING;
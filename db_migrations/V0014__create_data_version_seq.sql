@@ -0,0 +1,4 @@
+-- Версия данных для кэша ответов читающих функций (get-analytics, get-dau, get-costs, get-quality).
+-- bot-webhook вызывает nextval() при каждой записи; кэш с другой версией считается устаревшим.
+-- Последовательность не транзакционна и не создаёт блокировок между параллельными вебхуками.
+CREATE SEQUENCE IF NOT EXISTS data_version_seq;
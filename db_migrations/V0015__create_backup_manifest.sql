@@ -0,0 +1,22 @@
+-- Колоночные снимки (Parquet) из auto-backup: водяные знаки по id и манифест файлов.
+-- Инкрементальные таблицы выгружаются строками с id > last_id; каждый записанный файл
+-- регистрируется с диапазоном id, числом строк и sha256 для action=verify / action=restore.
+CREATE TABLE IF NOT EXISTS backup_watermarks (
+  table_name VARCHAR(64) PRIMARY KEY,
+  last_id BIGINT NOT NULL DEFAULT 0,
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS backup_files (
+  id SERIAL PRIMARY KEY,
+  table_name VARCHAR(64) NOT NULL,
+  path TEXT NOT NULL UNIQUE,
+  day DATE,
+  min_id BIGINT,
+  max_id BIGINT,
+  rows_count BIGINT NOT NULL,
+  sha256 CHAR(64) NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_backup_files_table_day ON backup_files(table_name, day);
@@ -0,0 +1,139 @@
+-- Помесячное секционирование messages (timestamp), dialogs (created_at) и event_logs (timestamp).
+-- Запросы по диапазону дат отсекают лишние секции, индексы и GIN по event_data живут в пределах месяца,
+-- а очистка истории — это DETACH/DROP секции вместо DELETE.
+-- Секции называются <table>_pYYYY_MM; строки вне созданных месяцев попадают в <table>_default.
+-- Обслуживание (вызывает auto-backup): ensure_monthly_partitions и detach_old_partitions.
+
+-- Создаёт секции от p_from (или текущего месяца) до текущего месяца + p_months_ahead.
+-- Строки нужного месяца, успевшие попасть в default-секцию, переносятся в новую секцию.
+CREATE OR REPLACE FUNCTION ensure_monthly_partitions(p_table TEXT, p_months_ahead INT DEFAULT 3, p_from DATE DEFAULT NULL)
+RETURNS INT AS $$
+DECLARE
+  v_column TEXT;
+  v_month DATE := date_trunc('month', COALESCE(p_from, CURRENT_DATE))::date;
+  v_last DATE := (date_trunc('month', CURRENT_DATE) + make_interval(months => p_months_ahead))::date;
+  v_next DATE;
+  v_name TEXT;
+  v_default TEXT := p_table || '_default';
+  v_pending BOOLEAN;
+  v_created INT := 0;
+BEGIN
+  SELECT a.attname INTO v_column
+  FROM pg_partitioned_table pt
+  JOIN pg_attribute a ON a.attrelid = pt.partrelid AND a.attnum = pt.partattrs[0]
+  WHERE pt.partrelid = p_table::regclass;
+
+  WHILE v_month <= v_last LOOP
+    v_next := (v_month + interval '1 month')::date;
+    v_name := p_table || '_p' || to_char(v_month, 'YYYY_MM');
+    IF to_regclass(v_name) IS NULL THEN
+      v_pending := FALSE;
+      IF to_regclass(v_default) IS NOT NULL THEN
+        EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE %I >= %L AND %I < %L)', v_default, v_column, v_month, v_column, v_next)
+          INTO v_pending;
+      END IF;
+      IF v_pending THEN
+        EXECUTE format('CREATE TEMP TABLE partition_moved ON COMMIT DROP AS SELECT * FROM %I WHERE %I >= %L AND %I < %L',
+          v_default, v_column, v_month, v_column, v_next);
+        EXECUTE format('DELETE FROM %I WHERE %I >= %L AND %I < %L', v_default, v_column, v_month, v_column, v_next);
+      END IF;
+      EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)', v_name, p_table, v_month, v_next);
+      IF v_pending THEN
+        EXECUTE format('INSERT INTO %I SELECT * FROM partition_moved', p_table);
+        DROP TABLE partition_moved;
+      END IF;
+      v_created := v_created + 1;
+    END IF;
+    v_month := v_next;
+  END LOOP;
+  RETURN v_created;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Отсоединяет секции старше p_keep_months полных месяцев. С p_max_id секция отсоединяется только если
+-- все её id уже не больше p_max_id (например, водяного знака auto-backup). p_drop удаляет отсоединённую секцию.
+-- Агрегаты (dialog_rollups, dau_sketches) при этом не меняются: DETACH не вызывает триггеры.
+CREATE OR REPLACE FUNCTION detach_old_partitions(p_table TEXT, p_keep_months INT, p_max_id BIGINT DEFAULT NULL, p_drop BOOLEAN DEFAULT FALSE)
+RETURNS SETOF TEXT AS $$
+DECLARE
+  v_cutoff DATE := (date_trunc('month', CURRENT_DATE) - make_interval(months => p_keep_months))::date;
+  v_name TEXT;
+  v_max_id BIGINT;
+BEGIN
+  FOR v_name IN
+    SELECT c.relname::text
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = p_table::regclass AND c.relname ~ ('^' || p_table || '_p[0-9]{4}_[0-9]{2}$')
+    ORDER BY c.relname
+  LOOP
+    CONTINUE WHEN to_date(right(v_name, 7), 'YYYY_MM') >= v_cutoff;
+    IF p_max_id IS NOT NULL THEN
+      EXECUTE format('SELECT MAX(id) FROM %I', v_name) INTO v_max_id;
+      CONTINUE WHEN v_max_id > p_max_id;
+    END IF;
+    EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', p_table, v_name);
+    IF p_drop THEN
+      EXECUTE format('DROP TABLE %I', v_name);
+    END IF;
+    RETURN NEXT v_name;
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Пересоздаёт таблицу как секционированную по p_column с переносом данных.
+-- Ключ секционирования становится NOT NULL и входит в первичный ключ (id, p_column);
+-- последовательность id сохраняется. Индексы, внешние ключи и триггеры создаются ниже.
+CREATE OR REPLACE FUNCTION convert_to_monthly_partitions(p_table TEXT, p_column TEXT, p_months_ahead INT DEFAULT 3)
+RETURNS VOID AS $$
+DECLARE
+  v_legacy TEXT := p_table || '_unpartitioned';
+  v_sequence TEXT := pg_get_serial_sequence(p_table, 'id');
+  v_start DATE;
+BEGIN
+  EXECUTE format('LOCK TABLE %I IN ACCESS EXCLUSIVE MODE', p_table);
+  EXECUTE format('UPDATE %I SET %I = CURRENT_TIMESTAMP WHERE %I IS NULL', p_table, p_column, p_column);
+  EXECUTE format('SELECT date_trunc(''month'', MIN(%I))::date FROM %I', p_column, p_table) INTO v_start;
+  EXECUTE format('ALTER TABLE %I RENAME TO %I', p_table, v_legacy);
+
+  EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE) PARTITION BY RANGE (%I)',
+    p_table, v_legacy, p_column);
+  EXECUTE format('ALTER TABLE %I ALTER COLUMN %I SET NOT NULL, ALTER COLUMN %I SET DEFAULT CURRENT_TIMESTAMP', p_table, p_column, p_column);
+  EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', p_table || '_default', p_table);
+  PERFORM ensure_monthly_partitions(p_table, p_months_ahead, v_start);
+
+  EXECUTE format('INSERT INTO %I SELECT * FROM %I', p_table, v_legacy);
+  IF v_sequence IS NOT NULL THEN
+    EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.id', v_sequence, p_table);
+  END IF;
+  EXECUTE format('DROP TABLE %I', v_legacy);
+  EXECUTE format('ALTER TABLE %I ADD PRIMARY KEY (id, %I)', p_table, p_column);
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT convert_to_monthly_partitions('messages', 'timestamp');
+SELECT convert_to_monthly_partitions('dialogs', 'created_at');
+SELECT convert_to_monthly_partitions('event_logs', 'timestamp');
+
+-- messages: индексы из V0011/V0012 (создаются на каждой секции)
+CREATE INDEX IF NOT EXISTS idx_messages_user_ts_id ON messages(user_id, timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_timestamp_user ON messages(timestamp, user_id);
+CREATE INDEX IF NOT EXISTS idx_messages_timestamp_sender ON messages(timestamp, sender);
+
+-- dialogs: индексы из V0002/V0011/V0012, внешний ключ и триггер агрегатов из V0010
+CREATE INDEX IF NOT EXISTS idx_dialogs_user_created_id ON dialogs(user_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_dialogs_created_telegram ON dialogs(created_at, telegram_id);
+CREATE INDEX IF NOT EXISTS idx_dialogs_username ON dialogs(username);
+CREATE INDEX IF NOT EXISTS idx_dialogs_interaction_type ON dialogs(interaction_type);
+ALTER TABLE dialogs ADD CONSTRAINT dialogs_user_id_fkey FOREIGN KEY (user_id) REFERENCES users(id);
+
+CREATE TRIGGER trg_dialog_rollups
+AFTER INSERT OR UPDATE OF created_at, model, status, tokens OR DELETE ON dialogs
+FOR EACH ROW EXECUTE FUNCTION dialog_rollups_trigger();
+
+-- event_logs: индексы из V0008; GIN по event_data теперь строится по месячным секциям
+CREATE INDEX IF NOT EXISTS idx_event_logs_user_id ON event_logs(user_id);
+CREATE INDEX IF NOT EXISTS idx_event_logs_type ON event_logs(event_type);
+CREATE INDEX IF NOT EXISTS idx_event_logs_timestamp ON event_logs(timestamp);
+CREATE INDEX IF NOT EXISTS idx_event_logs_success ON event_logs(success);
+CREATE INDEX IF NOT EXISTS idx_event_logs_data ON event_logs USING GIN(event_data);
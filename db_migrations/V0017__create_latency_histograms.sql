@@ -0,0 +1,29 @@
+-- Гистограммы латентности спанов (connect, sql.*, serialize, total, ...) от функций-обработчиков.
+-- Каждая функция копит гистограммы в памяти и раз в METRICS_FLUSH_INTERVAL дописывает дельту в строку
+-- своей минуты; функция metrics суммирует корзины за окно и считает по ним p50/p95/p99.
+-- Границы корзин (мс): 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000 и последняя — всё, что дольше.
+CREATE TABLE IF NOT EXISTS latency_histograms (
+  function VARCHAR(64) NOT NULL,
+  span VARCHAR(128) NOT NULL,
+  minute TIMESTAMP NOT NULL,
+  count BIGINT NOT NULL,
+  total_ms DOUBLE PRECISION NOT NULL,
+  max_ms DOUBLE PRECISION NOT NULL,
+  buckets BIGINT[] NOT NULL,
+  PRIMARY KEY (function, span, minute)
+);
+
+CREATE INDEX IF NOT EXISTS idx_latency_histograms_minute ON latency_histograms(minute);
+
+-- Поэлементная сумма массивов корзин (разной длины — недостающие считаются нулями)
+CREATE OR REPLACE FUNCTION latency_add_buckets(a BIGINT[], b BIGINT[])
+RETURNS BIGINT[] AS $$
+  SELECT array_agg(COALESCE(x, 0) + COALESCE(y, 0) ORDER BY n)
+  FROM unnest(a, b) WITH ORDINALITY AS t(x, y, n)
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Сумма корзин за окно: SELECT latency_sum_buckets(buckets) ... GROUP BY function, span
+CREATE AGGREGATE latency_sum_buckets(BIGINT[]) (
+  SFUNC = latency_add_buckets,
+  STYPE = BIGINT[]
+);
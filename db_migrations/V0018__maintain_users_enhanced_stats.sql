@@ -0,0 +1,76 @@
+-- Статистика пользователя в users_enhanced ведётся при записи: bot-webhook одним upsert'ом прибавляет
+-- сообщения, токены и сессии, а total_cost_usd следует за costs через триггер. get-user-history?summary=1
+-- читает профиль и статистику одной строкой, не трогая dialogs.
+-- Сессия — серия сообщений с перерывами не длиннее 30 минут (SESSION_GAP_MINUTES в bot-webhook).
+ALTER TABLE users_enhanced ADD COLUMN IF NOT EXISTS session_started_at TIMESTAMP;
+ALTER TABLE users_enhanced ALTER COLUMN total_tokens_used TYPE BIGINT;
+
+-- Стоимость проставляется в costs позже токенов, поэтому сумма по пользователю ведётся по дельте cost_dollars
+CREATE OR REPLACE FUNCTION users_enhanced_cost_trigger()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') AND COALESCE(OLD.cost_dollars, 0) <> 0 THEN
+    UPDATE users_enhanced SET total_cost_usd = total_cost_usd - OLD.cost_dollars WHERE telegram_user_id = OLD.user_id;
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') AND COALESCE(NEW.cost_dollars, 0) <> 0 THEN
+    UPDATE users_enhanced SET total_cost_usd = total_cost_usd + NEW.cost_dollars WHERE telegram_user_id = NEW.user_id;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_users_enhanced_cost
+AFTER INSERT OR UPDATE OF user_id, cost_dollars OR DELETE ON costs
+FOR EACH ROW EXECUTE FUNCTION users_enhanced_cost_trigger();
+
+-- Пересборка статистики из истории users/messages/dialogs/costs (backfill).
+-- Пользователи users без строки в users_enhanced добавляются; сессии считаются по перерывам между сообщениями.
+CREATE OR REPLACE FUNCTION rebuild_user_stats(p_session_gap_minutes INT DEFAULT 30)
+RETURNS VOID AS $$
+BEGIN
+  INSERT INTO users_enhanced (telegram_user_id, username, first_seen, last_seen, status)
+  SELECT telegram_id, username, created_at, last_active, CASE WHEN premium = true THEN 'premium' ELSE 'active' END
+  FROM users
+  WHERE telegram_id IS NOT NULL
+  ON CONFLICT (telegram_user_id) DO NOTHING;
+
+  UPDATE users_enhanced SET total_messages_count = 0, total_sessions = 0, session_started_at = NULL, total_tokens_used = 0, total_cost_usd = 0;
+
+  WITH gaps AS (
+    SELECT
+      user_id,
+      timestamp,
+      (lag(timestamp) OVER w IS NULL OR timestamp > lag(timestamp) OVER w + make_interval(mins => p_session_gap_minutes))::int AS new_session
+    FROM messages
+    WINDOW w AS (PARTITION BY user_id ORDER BY timestamp)
+  ), per_user AS (
+    SELECT
+      user_id,
+      COUNT(*) AS messages_count,
+      SUM(new_session) AS sessions,
+      MIN(timestamp) AS first_ts,
+      MAX(timestamp) AS last_ts,
+      MAX(timestamp) FILTER (WHERE new_session = 1) AS session_start
+    FROM gaps
+    GROUP BY user_id
+  )
+  UPDATE users_enhanced e SET
+    total_messages_count = p.messages_count,
+    total_sessions = p.sessions,
+    session_started_at = p.session_start,
+    first_seen = LEAST(e.first_seen, p.first_ts),
+    last_seen = GREATEST(e.last_seen, p.last_ts)
+  FROM per_user p
+  WHERE e.telegram_user_id = p.user_id;
+
+  UPDATE users_enhanced e SET total_tokens_used = d.tokens
+  FROM (SELECT telegram_id, SUM(tokens) AS tokens FROM dialogs WHERE telegram_id IS NOT NULL GROUP BY telegram_id) d
+  WHERE e.telegram_user_id = d.telegram_id;
+
+  UPDATE users_enhanced e SET total_cost_usd = c.cost
+  FROM (SELECT user_id, SUM(cost_dollars) AS cost FROM costs WHERE cost_dollars IS NOT NULL GROUP BY user_id) c
+  WHERE e.telegram_user_id = c.user_id;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_user_stats();
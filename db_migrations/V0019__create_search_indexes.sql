@@ -0,0 +1,67 @@
+-- Поиск по истории для функции search: полнотекстовый по messages.message и dialogs.user_message
+-- (словари russian + english, ранжирование и подсветка) и подстрочный ILIKE через триграммы.
+-- search_vector — генерируемая колонка: считается при вставке и изменении текста, отдельный бэкфилл не нужен
+-- (ADD COLUMN перезаписывает таблицы, поэтому миграцию лучше накатывать в окно низкой нагрузки).
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+  GENERATED ALWAYS AS (to_tsvector('russian', COALESCE(message, '')) || to_tsvector('english', COALESCE(message, ''))) STORED;
+ALTER TABLE dialogs ADD COLUMN IF NOT EXISTS search_vector tsvector
+  GENERATED ALWAYS AS (to_tsvector('russian', COALESCE(user_message, '')) || to_tsvector('english', COALESCE(user_message, ''))) STORED;
+
+-- Индексы создаются на каждой месячной секции
+CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (search_vector);
+CREATE INDEX IF NOT EXISTS idx_dialogs_search ON dialogs USING GIN (search_vector);
+CREATE INDEX IF NOT EXISTS idx_messages_message_trgm ON messages USING GIN (message gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_dialogs_user_message_trgm ON dialogs USING GIN (user_message gin_trgm_ops);
+
+-- ensure_monthly_partitions из V0016 переносил строки из default-секции через INSERT ... SELECT *,
+-- а в генерируемую колонку вставлять нельзя: теперь переносятся только обычные колонки
+CREATE OR REPLACE FUNCTION ensure_monthly_partitions(p_table TEXT, p_months_ahead INT DEFAULT 3, p_from DATE DEFAULT NULL)
+RETURNS INT AS $$
+DECLARE
+  v_column TEXT;
+  v_columns TEXT;
+  v_month DATE := date_trunc('month', COALESCE(p_from, CURRENT_DATE))::date;
+  v_last DATE := (date_trunc('month', CURRENT_DATE) + make_interval(months => p_months_ahead))::date;
+  v_next DATE;
+  v_name TEXT;
+  v_default TEXT := p_table || '_default';
+  v_pending BOOLEAN;
+  v_created INT := 0;
+BEGIN
+  SELECT a.attname INTO v_column
+  FROM pg_partitioned_table pt
+  JOIN pg_attribute a ON a.attrelid = pt.partrelid AND a.attnum = pt.partattrs[0]
+  WHERE pt.partrelid = p_table::regclass;
+
+  SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO v_columns
+  FROM pg_attribute
+  WHERE attrelid = p_table::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = '';
+
+  WHILE v_month <= v_last LOOP
+    v_next := (v_month + interval '1 month')::date;
+    v_name := p_table || '_p' || to_char(v_month, 'YYYY_MM');
+    IF to_regclass(v_name) IS NULL THEN
+      v_pending := FALSE;
+      IF to_regclass(v_default) IS NOT NULL THEN
+        EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE %I >= %L AND %I < %L)', v_default, v_column, v_month, v_column, v_next)
+          INTO v_pending;
+      END IF;
+      IF v_pending THEN
+        EXECUTE format('CREATE TEMP TABLE partition_moved ON COMMIT DROP AS SELECT %s FROM %I WHERE %I >= %L AND %I < %L',
+          v_columns, v_default, v_column, v_month, v_column, v_next);
+        EXECUTE format('DELETE FROM %I WHERE %I >= %L AND %I < %L', v_default, v_column, v_month, v_column, v_next);
+      END IF;
+      EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)', v_name, p_table, v_month, v_next);
+      IF v_pending THEN
+        EXECUTE format('INSERT INTO %I (%s) SELECT %s FROM partition_moved', p_table, v_columns, v_columns);
+        DROP TABLE partition_moved;
+      END IF;
+      v_created := v_created + 1;
+    END IF;
+    v_month := v_next;
+  END LOOP;
+  RETURN v_created;
+END;
+$$ LANGUAGE plpgsql;
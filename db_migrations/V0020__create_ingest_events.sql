@@ -0,0 +1,91 @@
+-- Каноническая append-only таблица входящих сообщений. В режиме WEBHOOK_INGEST_MODE=events bot-webhook
+-- делает одну вставку сюда, а users, dialogs, token_stats, users_enhanced, messages, dau_sketches и costs
+-- строит проектор батчами (bot-webhook: project_events, GET ?action=project), сдвигая чекпоинт
+-- в той же транзакции. Пересборка с нуля — GET ?action=rebuild (reset_event_projections + повторная проекция).
+CREATE TABLE IF NOT EXISTS ingest_events (
+  id BIGSERIAL PRIMARY KEY,
+  idempotency_key VARCHAR(128) NOT NULL UNIQUE,
+  received_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  telegram_id BIGINT NOT NULL,
+  name VARCHAR(255),
+  username VARCHAR(255),
+  email VARCHAR(255),
+  premium BOOLEAN DEFAULT FALSE,
+  tokens INTEGER DEFAULT 0,
+  model VARCHAR(50),
+  user_message TEXT,
+  assistant_message TEXT,
+  interaction_type VARCHAR(50) DEFAULT 'chat',
+  response_time_ms INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS idx_ingest_events_telegram_id ON ingest_events(telegram_id);
+
+-- Позиция проектора: id последнего применённого события
+CREATE TABLE IF NOT EXISTS projector_checkpoints (
+  name VARCHAR(64) PRIMARY KEY,
+  last_event_id BIGINT NOT NULL DEFAULT 0,
+  events_projected BIGINT NOT NULL DEFAULT 0,
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO projector_checkpoints (name) VALUES ('read_models') ON CONFLICT (name) DO NOTHING;
+
+-- Происхождение строк: NULL — записано напрямую (режимы legacy/single/buffered и история до событий)
+ALTER TABLE dialogs ADD COLUMN IF NOT EXISTS event_id BIGINT;
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS event_id BIGINT;
+ALTER TABLE costs ADD COLUMN IF NOT EXISTS event_id BIGINT;
+
+CREATE INDEX IF NOT EXISTS idx_dialogs_event_id ON dialogs(event_id) WHERE event_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_messages_event_id ON messages(event_id) WHERE event_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_costs_event_id ON costs(event_id) WHERE event_id IS NOT NULL;
+
+-- Первая половина пересборки: удаляет строки, построенные из событий, пересчитывает агрегаты
+-- (users, token_stats, dau_sketches, rollups, users_enhanced) по оставшейся истории и обнуляет чекпоинт.
+-- После неё проектор заново применяет все события; до конца проекции читатели видят неполные данные.
+CREATE OR REPLACE FUNCTION reset_event_projections(p_session_gap_minutes INT DEFAULT 30)
+RETURNS VOID AS $$
+BEGIN
+  PERFORM 1 FROM projector_checkpoints WHERE name = 'read_models' FOR UPDATE;
+
+  DELETE FROM dialogs WHERE event_id IS NOT NULL;
+  DELETE FROM messages WHERE event_id IS NOT NULL;
+  DELETE FROM costs WHERE event_id IS NOT NULL;
+
+  UPDATE users SET total_tokens = 0, dialogs_count = 0;
+  UPDATE users u SET total_tokens = d.tokens, dialogs_count = d.dialogs
+  FROM (SELECT user_id, SUM(tokens) AS tokens, COUNT(*) AS dialogs FROM dialogs GROUP BY user_id) d
+  WHERE u.id = d.user_id;
+
+  DELETE FROM token_stats;
+  INSERT INTO token_stats (date, total_tokens, active_users)
+  SELECT created_at::date, COALESCE(SUM(tokens), 0), COUNT(DISTINCT telegram_id)
+  FROM dialogs
+  GROUP BY 1;
+
+  -- Скетчи DAU по оставшимся messages, как бэкфилл в V0013
+  DELETE FROM dau_sketches;
+  WITH hashed AS (
+    SELECT DISTINCT timestamp::date AS day, ('x' || substr(md5(user_id::text), 1, 16))::bit(64) AS h
+    FROM messages
+  ), registers AS (
+    SELECT day, substring(h FROM 1 FOR 12)::bit(12)::int AS idx,
+      COALESCE(NULLIF(position(B'1' IN substring(h FROM 13)), 0), 53) AS rank
+    FROM hashed
+  ), maxed AS (
+    SELECT day, idx, MAX(rank) AS rank FROM registers GROUP BY day, idx
+  )
+  INSERT INTO dau_sketches (day, sketch)
+  SELECT d.day, decode(string_agg(lpad(to_hex(COALESCE(m.rank, 0)), 2, '0'), '' ORDER BY g.idx), 'hex')
+  FROM (SELECT DISTINCT day FROM maxed) d
+  CROSS JOIN generate_series(0, 4095) AS g(idx)
+  LEFT JOIN maxed m ON m.day = d.day AND m.idx = g.idx
+  GROUP BY d.day;
+
+  PERFORM rebuild_analytics_rollups();
+  PERFORM rebuild_user_stats(p_session_gap_minutes);
+
+  UPDATE projector_checkpoints SET last_event_id = 0, events_projected = 0, updated_at = now() WHERE name = 'read_models';
+  PERFORM nextval('data_version_seq');
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,278 @@
+-- Стоимость токенов по версионируемому прайсу моделей. Цена действует с valid_from до valid_from следующей
+-- версии той же модели; модель '*' — цена по умолчанию для моделей без своей строки.
+-- costs.cost_dollars считается при вставке (BEFORE-триггер, все режимы bot-webhook), а при изменении прайса
+-- пересчитывается одним UPDATE по затронутым строкам costs/token_usage: recompute_costs(p_from, p_model).
+-- cost_rollups получает измерение модели, get-costs читает диапазоны и разбивку по моделям из него.
+CREATE TABLE IF NOT EXISTS model_prices (
+  id SERIAL PRIMARY KEY,
+  model VARCHAR(50) NOT NULL,
+  valid_from DATE NOT NULL,
+  prompt_per_1k DECIMAL(12, 8) NOT NULL,
+  completion_per_1k DECIMAL(12, 8) NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  UNIQUE (model, valid_from)
+);
+
+INSERT INTO model_prices (model, valid_from, prompt_per_1k, completion_per_1k) VALUES
+  ('*', '2020-01-01', 0.0005, 0.0015),
+  ('GPT-3.5', '2020-01-01', 0.0005, 0.0015),
+  ('GPT-4', '2020-01-01', 0.03, 0.06),
+  ('openai/gpt-4.1-mini', '2020-01-01', 0.0004, 0.0016)
+ON CONFLICT (model, valid_from) DO NOTHING;
+
+-- Разбивка токенов: без неё (prompt/completion не переданы) весь tokens_used идёт по средней из двух цен
+ALTER TABLE costs ADD COLUMN IF NOT EXISTS model VARCHAR(50);
+ALTER TABLE costs ADD COLUMN IF NOT EXISTS prompt_tokens INTEGER;
+ALTER TABLE costs ADD COLUMN IF NOT EXISTS completion_tokens INTEGER;
+ALTER TABLE ingest_events ADD COLUMN IF NOT EXISTS prompt_tokens INTEGER;
+ALTER TABLE ingest_events ADD COLUMN IF NOT EXISTS completion_tokens INTEGER;
+
+CREATE INDEX IF NOT EXISTS idx_costs_model_date ON costs(model, date);
+
+-- Формула одна для вставки и для пересчёта: цены за 1k токенов, остаток без разбивки — по средней цене
+CREATE OR REPLACE FUNCTION price_tokens(p_prompt_per_1k DECIMAL, p_completion_per_1k DECIMAL, p_prompt INT, p_completion INT, p_total INT)
+RETURNS DECIMAL AS $$
+  SELECT round((
+    COALESCE(p_prompt, 0) * p_prompt_per_1k
+    + COALESCE(p_completion, 0) * p_completion_per_1k
+    + GREATEST(COALESCE(p_total, 0) - COALESCE(p_prompt, 0) - COALESCE(p_completion, 0), 0) * (p_prompt_per_1k + p_completion_per_1k) / 2
+  ) / 1000, 6);
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION compute_cost(p_model VARCHAR, p_day DATE, p_prompt INT, p_completion INT, p_total INT)
+RETURNS DECIMAL AS $$
+  SELECT price_tokens(prompt_per_1k, completion_per_1k, p_prompt, p_completion, p_total)
+  FROM model_prices
+  WHERE model IN (COALESCE(p_model, '*'), '*') AND valid_from <= COALESCE(p_day, CURRENT_DATE)
+  ORDER BY model = '*', valid_from DESC
+  LIMIT 1;
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION costs_price_trigger()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF NEW.cost_dollars IS NULL THEN
+    NEW.cost_dollars := compute_cost(NEW.model, NEW.date, NEW.prompt_tokens, NEW.completion_tokens, NEW.tokens_used);
+  END IF;
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION token_usage_price_trigger()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF NEW.cost_usd IS NULL THEN
+    NEW.cost_usd := compute_cost(NEW.model, COALESCE(NEW.timestamp, CURRENT_TIMESTAMP)::date, NEW.prompt_tokens, NEW.completion_tokens, NEW.total_tokens);
+  END IF;
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_costs_price
+BEFORE INSERT ON costs
+FOR EACH ROW EXECUTE FUNCTION costs_price_trigger();
+
+CREATE TRIGGER trg_token_usage_price
+BEFORE INSERT ON token_usage
+FOR EACH ROW EXECUTE FUNCTION token_usage_price_trigger();
+
+-- cost_rollups: день × модель (NULL модель хранится как ''), плюс разбивка prompt/completion
+ALTER TABLE cost_rollups ADD COLUMN IF NOT EXISTS model VARCHAR(50) NOT NULL DEFAULT '';
+ALTER TABLE cost_rollups ADD COLUMN IF NOT EXISTS prompt_tokens BIGINT DEFAULT 0;
+ALTER TABLE cost_rollups ADD COLUMN IF NOT EXISTS completion_tokens BIGINT DEFAULT 0;
+ALTER TABLE cost_rollups DROP CONSTRAINT IF EXISTS cost_rollups_pkey;
+ALTER TABLE cost_rollups ADD PRIMARY KEY (day, model);
+
+DROP TRIGGER IF EXISTS trg_cost_rollups ON costs;
+DROP FUNCTION IF EXISTS cost_rollups_apply(DATE, BIGINT, DECIMAL, BIGINT);
+
+CREATE OR REPLACE FUNCTION cost_rollups_apply(p_day DATE, p_model VARCHAR, p_tokens BIGINT, p_prompt BIGINT, p_completion BIGINT, p_cost DECIMAL, p_records BIGINT)
+RETURNS VOID AS $$
+BEGIN
+  IF p_day IS NULL THEN
+    RETURN;
+  END IF;
+  INSERT INTO cost_rollups (day, model, tokens_used, prompt_tokens, completion_tokens, cost_dollars, records_count)
+  VALUES (p_day, COALESCE(p_model, ''), p_tokens, p_prompt, p_completion, p_cost, p_records)
+  ON CONFLICT (day, model) DO UPDATE SET
+    tokens_used = cost_rollups.tokens_used + EXCLUDED.tokens_used,
+    prompt_tokens = cost_rollups.prompt_tokens + EXCLUDED.prompt_tokens,
+    completion_tokens = cost_rollups.completion_tokens + EXCLUDED.completion_tokens,
+    cost_dollars = cost_rollups.cost_dollars + EXCLUDED.cost_dollars,
+    records_count = cost_rollups.records_count + EXCLUDED.records_count;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Во время recompute_costs построчные триггеры молчат: агрегаты правятся одним проходом по дельтам
+CREATE OR REPLACE FUNCTION cost_rollups_trigger()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF current_setting('pricing.recompute', true) = 'on' THEN
+    RETURN NULL;
+  END IF;
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    PERFORM cost_rollups_apply(OLD.date, OLD.model, -COALESCE(OLD.tokens_used, 0), -COALESCE(OLD.prompt_tokens, 0),
+      -COALESCE(OLD.completion_tokens, 0), -COALESCE(OLD.cost_dollars, 0), -1);
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    PERFORM cost_rollups_apply(NEW.date, NEW.model, COALESCE(NEW.tokens_used, 0), COALESCE(NEW.prompt_tokens, 0),
+      COALESCE(NEW.completion_tokens, 0), COALESCE(NEW.cost_dollars, 0), 1);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_cost_rollups
+AFTER INSERT OR UPDATE OF date, model, tokens_used, prompt_tokens, completion_tokens, cost_dollars OR DELETE ON costs
+FOR EACH ROW EXECUTE FUNCTION cost_rollups_trigger();
+
+CREATE OR REPLACE FUNCTION users_enhanced_cost_trigger()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF current_setting('pricing.recompute', true) = 'on' THEN
+    RETURN NULL;
+  END IF;
+  IF TG_OP IN ('UPDATE', 'DELETE') AND COALESCE(OLD.cost_dollars, 0) <> 0 THEN
+    UPDATE users_enhanced SET total_cost_usd = total_cost_usd - OLD.cost_dollars WHERE telegram_user_id = OLD.user_id;
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') AND COALESCE(NEW.cost_dollars, 0) <> 0 THEN
+    UPDATE users_enhanced SET total_cost_usd = total_cost_usd + NEW.cost_dollars WHERE telegram_user_id = NEW.user_id;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION rebuild_analytics_rollups()
+RETURNS VOID AS $$
+BEGIN
+  LOCK TABLE dialogs, costs, users IN SHARE MODE;
+
+  DELETE FROM dialog_rollups;
+  INSERT INTO dialog_rollups (day, model, status, dialogs_count, tokens)
+  SELECT
+    COALESCE(created_at, CURRENT_TIMESTAMP)::date,
+    COALESCE(model, ''),
+    COALESCE(status, ''),
+    COUNT(*),
+    COALESCE(SUM(tokens), 0)
+  FROM dialogs
+  GROUP BY 1, 2, 3;
+
+  DELETE FROM cost_rollups;
+  INSERT INTO cost_rollups (day, model, tokens_used, prompt_tokens, completion_tokens, cost_dollars, records_count)
+  SELECT date, COALESCE(model, ''), COALESCE(SUM(tokens_used), 0), COALESCE(SUM(prompt_tokens), 0),
+    COALESCE(SUM(completion_tokens), 0), COALESCE(SUM(cost_dollars), 0), COUNT(*)
+  FROM costs
+  WHERE date IS NOT NULL
+  GROUP BY 1, 2;
+
+  DELETE FROM user_counters;
+  INSERT INTO user_counters (id, total_users, premium_users)
+  SELECT 1, COUNT(*), COUNT(*) FILTER (WHERE premium = true)
+  FROM users;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Пересчёт стоимости после изменения прайса: цены разворачиваются в интервалы [valid_from, valid_to)
+-- и соединяются с costs/token_usage целиком (hash join, без вызова compute_cost на строку).
+-- Меняются только строки, чья стоимость изменилась; их дельты одним проходом попадают в cost_rollups
+-- и users_enhanced.total_cost_usd. p_from/p_model сужают пересчёт (NULL — вся история / все модели).
+-- Возвращает число изменённых строк costs.
+CREATE OR REPLACE FUNCTION recompute_costs(p_from DATE DEFAULT NULL, p_model VARCHAR DEFAULT NULL)
+RETURNS BIGINT AS $$
+DECLARE
+  v_changed BIGINT;
+BEGIN
+  PERFORM set_config('pricing.recompute', 'on', true);
+
+  CREATE TEMP TABLE price_intervals ON COMMIT DROP AS
+  SELECT model, valid_from, lead(valid_from) OVER (PARTITION BY model ORDER BY valid_from) AS valid_to, prompt_per_1k, completion_per_1k
+  FROM model_prices;
+
+  CREATE TEMP TABLE cost_deltas (user_id BIGINT, date DATE, model VARCHAR(50), delta DECIMAL) ON COMMIT DROP;
+
+  WITH priced AS (
+    SELECT
+      c.id,
+      c.cost_dollars AS old_cost,
+      price_tokens(COALESCE(p.prompt_per_1k, d.prompt_per_1k), COALESCE(p.completion_per_1k, d.completion_per_1k),
+        c.prompt_tokens, c.completion_tokens, c.tokens_used) AS new_cost
+    FROM costs c
+    LEFT JOIN price_intervals p ON p.model = c.model AND c.date >= p.valid_from AND (p.valid_to IS NULL OR c.date < p.valid_to)
+    LEFT JOIN price_intervals d ON d.model = '*' AND c.date >= d.valid_from AND (d.valid_to IS NULL OR c.date < d.valid_to)
+    WHERE (p_from IS NULL OR c.date >= p_from)
+      AND (p_model IS NULL OR c.model = p_model)
+  ), updated AS (
+    UPDATE costs c SET cost_dollars = priced.new_cost
+    FROM priced
+    WHERE c.id = priced.id AND c.cost_dollars IS DISTINCT FROM priced.new_cost
+    RETURNING c.user_id, c.date, c.model, COALESCE(priced.new_cost, 0) - COALESCE(priced.old_cost, 0) AS delta
+  )
+  INSERT INTO cost_deltas SELECT * FROM updated;
+
+  GET DIAGNOSTICS v_changed = ROW_COUNT;
+
+  UPDATE token_usage t SET cost_usd = priced.new_cost
+  FROM (
+    SELECT
+      t.id,
+      price_tokens(COALESCE(p.prompt_per_1k, d.prompt_per_1k), COALESCE(p.completion_per_1k, d.completion_per_1k),
+        t.prompt_tokens, t.completion_tokens, t.total_tokens) AS new_cost
+    FROM token_usage t
+    LEFT JOIN price_intervals p ON p.model = t.model AND t.timestamp::date >= p.valid_from AND (p.valid_to IS NULL OR t.timestamp::date < p.valid_to)
+    LEFT JOIN price_intervals d ON d.model = '*' AND t.timestamp::date >= d.valid_from AND (d.valid_to IS NULL OR t.timestamp::date < d.valid_to)
+    WHERE (p_from IS NULL OR t.timestamp >= p_from)
+      AND (p_model IS NULL OR t.model = p_model)
+  ) priced
+  WHERE t.id = priced.id AND t.cost_usd IS DISTINCT FROM priced.new_cost;
+
+  INSERT INTO cost_rollups AS r (day, model, cost_dollars)
+  SELECT date, COALESCE(model, ''), SUM(delta)
+  FROM cost_deltas
+  WHERE date IS NOT NULL
+  GROUP BY 1, 2
+  ON CONFLICT (day, model) DO UPDATE SET cost_dollars = r.cost_dollars + EXCLUDED.cost_dollars;
+
+  UPDATE users_enhanced e SET total_cost_usd = e.total_cost_usd + d.delta
+  FROM (SELECT user_id, SUM(delta) AS delta FROM cost_deltas GROUP BY user_id) d
+  WHERE e.telegram_user_id = d.user_id;
+
+  DROP TABLE cost_deltas;
+  DROP TABLE price_intervals;
+  PERFORM set_config('pricing.recompute', 'off', true);
+  IF v_changed > 0 THEN
+    PERFORM nextval('data_version_seq');
+  END IF;
+  RETURN v_changed;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Изменение прайса сразу пересчитывает затронутые строки: с даты новой (или старой) версии,
+-- по своей модели или по всем, если менялась цена по умолчанию '*'
+CREATE OR REPLACE FUNCTION model_prices_trigger()
+RETURNS TRIGGER AS $$
+DECLARE
+  v_from DATE;
+  v_model VARCHAR;
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    v_from := NEW.valid_from;
+    v_model := NEW.model;
+  ELSIF TG_OP = 'DELETE' THEN
+    v_from := OLD.valid_from;
+    v_model := OLD.model;
+  ELSE
+    v_from := LEAST(OLD.valid_from, NEW.valid_from);
+    v_model := CASE WHEN OLD.model = NEW.model THEN NEW.model ELSE '*' END;
+  END IF;
+  PERFORM recompute_costs(v_from, NULLIF(v_model, '*'));
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_model_prices
+AFTER INSERT OR UPDATE OR DELETE ON model_prices
+FOR EACH ROW EXECUTE FUNCTION model_prices_trigger();
+
+SELECT rebuild_analytics_rollups();
+SELECT recompute_costs();
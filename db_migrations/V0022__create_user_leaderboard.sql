@@ -0,0 +1,270 @@
+-- Лидерборд пользователей по токенам, диалогам и стоимости за скользящие окна (последние N дней, 0 — всё время).
+-- user_daily_stats — день × пользователь, ведётся триггерами на dialogs и costs. leaderboard_entries хранит
+-- для каждого окна и метрики не больше capacity кандидатов: при записи пользователь попадает туда, если его сумма
+-- за окно не меньше текущего capacity-го значения. В пределах дня суммы только растут, так что настоящий top-K
+-- всегда среди кандидатов; раз в день (и после удалений или пересчёта цен) окно пересобирается
+-- refresh_leaderboard() — её лениво вызывает функция leaderboard. Чтение — LIMIT k по индексу, без users.
+CREATE TABLE IF NOT EXISTS user_daily_stats (
+  telegram_id BIGINT NOT NULL,
+  day DATE NOT NULL,
+  tokens BIGINT DEFAULT 0,
+  dialogs BIGINT DEFAULT 0,
+  cost_dollars DECIMAL(14, 6) DEFAULT 0,
+  PRIMARY KEY (telegram_id, day)
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_daily_stats_day ON user_daily_stats(day);
+
+-- Настраиваемые окна: добавить окно — INSERT INTO leaderboard_windows (window_days) VALUES (90)
+CREATE TABLE IF NOT EXISTS leaderboard_windows (
+  window_days INT PRIMARY KEY CHECK (window_days >= 0),
+  capacity INT NOT NULL DEFAULT 100 CHECK (capacity > 0),
+  refreshed_on DATE
+);
+
+INSERT INTO leaderboard_windows (window_days) VALUES (0), (1), (7), (30) ON CONFLICT (window_days) DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS leaderboard_entries (
+  metric VARCHAR(16) NOT NULL,
+  window_days INT NOT NULL REFERENCES leaderboard_windows(window_days) ON DELETE CASCADE,
+  telegram_id BIGINT NOT NULL,
+  value DECIMAL(20, 6) NOT NULL,
+  PRIMARY KEY (metric, window_days, telegram_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_leaderboard_entries_rank ON leaderboard_entries(metric, window_days, value DESC);
+
+-- Предлагает пользователя во все окна, пересобранные сегодня (устаревшие всё равно пересоберутся целиком)
+CREATE OR REPLACE FUNCTION leaderboard_offer(p_telegram_id BIGINT)
+RETURNS VOID AS $$
+BEGIN
+  WITH sums AS (
+    SELECT w.window_days, w.capacity, SUM(s.tokens) AS tokens, SUM(s.dialogs) AS dialogs, SUM(s.cost_dollars) AS cost
+    FROM leaderboard_windows w
+    JOIN user_daily_stats s ON s.telegram_id = p_telegram_id AND (w.window_days = 0 OR s.day > CURRENT_DATE - w.window_days)
+    WHERE w.refreshed_on = CURRENT_DATE
+    GROUP BY w.window_days, w.capacity
+  ), offers AS (
+    SELECT sums.window_days, sums.capacity, m.metric, m.value
+    FROM sums
+    CROSS JOIN LATERAL (VALUES ('tokens', sums.tokens::numeric), ('dialogs', sums.dialogs::numeric), ('cost', sums.cost)) AS m(metric, value)
+    WHERE m.value > 0
+  )
+  INSERT INTO leaderboard_entries (metric, window_days, telegram_id, value)
+  SELECT o.metric, o.window_days, p_telegram_id, o.value
+  FROM offers o
+  WHERE o.value >= COALESCE((
+      SELECT e.value FROM leaderboard_entries e
+      WHERE e.metric = o.metric AND e.window_days = o.window_days
+      ORDER BY e.value DESC OFFSET o.capacity - 1 LIMIT 1
+    ), 0)
+    OR EXISTS (
+      SELECT 1 FROM leaderboard_entries e
+      WHERE e.metric = o.metric AND e.window_days = o.window_days AND e.telegram_id = p_telegram_id
+    )
+  ON CONFLICT (metric, window_days, telegram_id) DO UPDATE SET value = EXCLUDED.value;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Уменьшение сумм (удаление, перенос строки) ломает инвариант кандидатов: окна помечаются устаревшими
+CREATE OR REPLACE FUNCTION user_daily_stats_apply(p_day DATE, p_telegram_id BIGINT, p_tokens BIGINT, p_dialogs BIGINT, p_cost DECIMAL)
+RETURNS VOID AS $$
+BEGIN
+  IF p_day IS NULL OR p_telegram_id IS NULL THEN
+    RETURN;
+  END IF;
+  INSERT INTO user_daily_stats (telegram_id, day, tokens, dialogs, cost_dollars)
+  VALUES (p_telegram_id, p_day, p_tokens, p_dialogs, p_cost)
+  ON CONFLICT (telegram_id, day) DO UPDATE SET
+    tokens = user_daily_stats.tokens + EXCLUDED.tokens,
+    dialogs = user_daily_stats.dialogs + EXCLUDED.dialogs,
+    cost_dollars = user_daily_stats.cost_dollars + EXCLUDED.cost_dollars;
+  IF p_tokens < 0 OR p_dialogs < 0 OR p_cost < 0 THEN
+    UPDATE leaderboard_windows SET refreshed_on = NULL WHERE refreshed_on IS NOT NULL;
+  ELSE
+    PERFORM leaderboard_offer(p_telegram_id);
+  END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION user_daily_stats_dialogs_trigger()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    PERFORM user_daily_stats_apply(COALESCE(OLD.created_at, CURRENT_TIMESTAMP)::date, OLD.telegram_id, -COALESCE(OLD.tokens, 0)::bigint, -1, 0);
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    PERFORM user_daily_stats_apply(COALESCE(NEW.created_at, CURRENT_TIMESTAMP)::date, NEW.telegram_id, COALESCE(NEW.tokens, 0)::bigint, 1, 0);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Как trg_cost_rollups, молчит во время recompute_costs: дельты стоимости вносит сама recompute_costs
+CREATE OR REPLACE FUNCTION user_daily_stats_costs_trigger()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF current_setting('pricing.recompute', true) = 'on' THEN
+    RETURN NULL;
+  END IF;
+  IF TG_OP IN ('UPDATE', 'DELETE') AND COALESCE(OLD.cost_dollars, 0) <> 0 THEN
+    PERFORM user_daily_stats_apply(OLD.date, OLD.user_id, 0, 0, -OLD.cost_dollars);
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') AND COALESCE(NEW.cost_dollars, 0) <> 0 THEN
+    PERFORM user_daily_stats_apply(NEW.date, NEW.user_id, 0, 0, NEW.cost_dollars);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_user_daily_stats
+AFTER INSERT OR UPDATE OF created_at, telegram_id, tokens OR DELETE ON dialogs
+FOR EACH ROW EXECUTE FUNCTION user_daily_stats_dialogs_trigger();
+
+CREATE TRIGGER trg_user_daily_stats_cost
+AFTER INSERT OR UPDATE OF date, user_id, cost_dollars OR DELETE ON costs
+FOR EACH ROW EXECUTE FUNCTION user_daily_stats_costs_trigger();
+
+-- Пересобирает кандидатов устаревших окон (или одного окна) из user_daily_stats; строка окна берётся FOR UPDATE,
+-- поэтому параллельный вызов дождётся первого и пропустит уже пересобранное окно. Возвращает число окон.
+CREATE OR REPLACE FUNCTION refresh_leaderboard(p_window_days INT DEFAULT NULL)
+RETURNS INT AS $$
+DECLARE
+  v_window RECORD;
+  v_refreshed INT := 0;
+BEGIN
+  FOR v_window IN
+    SELECT window_days, capacity FROM leaderboard_windows
+    WHERE (p_window_days IS NULL OR window_days = p_window_days) AND refreshed_on IS DISTINCT FROM CURRENT_DATE
+    ORDER BY window_days
+    FOR UPDATE
+  LOOP
+    DELETE FROM leaderboard_entries WHERE window_days = v_window.window_days;
+
+    WITH sums AS (
+      SELECT telegram_id, SUM(tokens) AS tokens, SUM(dialogs) AS dialogs, SUM(cost_dollars) AS cost
+      FROM user_daily_stats
+      WHERE v_window.window_days = 0 OR day > CURRENT_DATE - v_window.window_days
+      GROUP BY telegram_id
+    ), ranked AS (
+      SELECT sums.telegram_id, m.metric, m.value, row_number() OVER (PARTITION BY m.metric ORDER BY m.value DESC, sums.telegram_id) AS position
+      FROM sums
+      CROSS JOIN LATERAL (VALUES ('tokens', sums.tokens::numeric), ('dialogs', sums.dialogs::numeric), ('cost', sums.cost)) AS m(metric, value)
+      WHERE m.value > 0
+    )
+    INSERT INTO leaderboard_entries (metric, window_days, telegram_id, value)
+    SELECT metric, v_window.window_days, telegram_id, value
+    FROM ranked
+    WHERE position <= v_window.capacity;
+
+    UPDATE leaderboard_windows SET refreshed_on = CURRENT_DATE WHERE window_days = v_window.window_days;
+    v_refreshed := v_refreshed + 1;
+  END LOOP;
+  RETURN v_refreshed;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Бэкфилл из истории dialogs/costs; все окна помечаются устаревшими
+CREATE OR REPLACE FUNCTION rebuild_user_daily_stats()
+RETURNS VOID AS $$
+BEGIN
+  LOCK TABLE dialogs, costs IN SHARE MODE;
+
+  DELETE FROM user_daily_stats;
+  INSERT INTO user_daily_stats (telegram_id, day, tokens, dialogs)
+  SELECT telegram_id, COALESCE(created_at, CURRENT_TIMESTAMP)::date, COALESCE(SUM(tokens), 0), COUNT(*)
+  FROM dialogs
+  WHERE telegram_id IS NOT NULL
+  GROUP BY 1, 2;
+
+  INSERT INTO user_daily_stats AS s (telegram_id, day, cost_dollars)
+  SELECT user_id, date, SUM(cost_dollars)
+  FROM costs
+  WHERE date IS NOT NULL AND cost_dollars IS NOT NULL
+  GROUP BY 1, 2
+  ON CONFLICT (telegram_id, day) DO UPDATE SET cost_dollars = s.cost_dollars + EXCLUDED.cost_dollars;
+
+  UPDATE leaderboard_windows SET refreshed_on = NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- recompute_costs из V0021: дельты стоимости теперь попадают и в user_daily_stats, окна лидерборда устаревают
+CREATE OR REPLACE FUNCTION recompute_costs(p_from DATE DEFAULT NULL, p_model VARCHAR DEFAULT NULL)
+RETURNS BIGINT AS $$
+DECLARE
+  v_changed BIGINT;
+BEGIN
+  PERFORM set_config('pricing.recompute', 'on', true);
+
+  CREATE TEMP TABLE price_intervals ON COMMIT DROP AS
+  SELECT model, valid_from, lead(valid_from) OVER (PARTITION BY model ORDER BY valid_from) AS valid_to, prompt_per_1k, completion_per_1k
+  FROM model_prices;
+
+  CREATE TEMP TABLE cost_deltas (user_id BIGINT, date DATE, model VARCHAR(50), delta DECIMAL) ON COMMIT DROP;
+
+  WITH priced AS (
+    SELECT
+      c.id,
+      c.cost_dollars AS old_cost,
+      price_tokens(COALESCE(p.prompt_per_1k, d.prompt_per_1k), COALESCE(p.completion_per_1k, d.completion_per_1k),
+        c.prompt_tokens, c.completion_tokens, c.tokens_used) AS new_cost
+    FROM costs c
+    LEFT JOIN price_intervals p ON p.model = c.model AND c.date >= p.valid_from AND (p.valid_to IS NULL OR c.date < p.valid_to)
+    LEFT JOIN price_intervals d ON d.model = '*' AND c.date >= d.valid_from AND (d.valid_to IS NULL OR c.date < d.valid_to)
+    WHERE (p_from IS NULL OR c.date >= p_from)
+      AND (p_model IS NULL OR c.model = p_model)
+  ), updated AS (
+    UPDATE costs c SET cost_dollars = priced.new_cost
+    FROM priced
+    WHERE c.id = priced.id AND c.cost_dollars IS DISTINCT FROM priced.new_cost
+    RETURNING c.user_id, c.date, c.model, COALESCE(priced.new_cost, 0) - COALESCE(priced.old_cost, 0) AS delta
+  )
+  INSERT INTO cost_deltas SELECT * FROM updated;
+
+  GET DIAGNOSTICS v_changed = ROW_COUNT;
+
+  UPDATE token_usage t SET cost_usd = priced.new_cost
+  FROM (
+    SELECT
+      t.id,
+      price_tokens(COALESCE(p.prompt_per_1k, d.prompt_per_1k), COALESCE(p.completion_per_1k, d.completion_per_1k),
+        t.prompt_tokens, t.completion_tokens, t.total_tokens) AS new_cost
+    FROM token_usage t
+    LEFT JOIN price_intervals p ON p.model = t.model AND t.timestamp::date >= p.valid_from AND (p.valid_to IS NULL OR t.timestamp::date < p.valid_to)
+    LEFT JOIN price_intervals d ON d.model = '*' AND t.timestamp::date >= d.valid_from AND (d.valid_to IS NULL OR t.timestamp::date < d.valid_to)
+    WHERE (p_from IS NULL OR t.timestamp >= p_from)
+      AND (p_model IS NULL OR t.model = p_model)
+  ) priced
+  WHERE t.id = priced.id AND t.cost_usd IS DISTINCT FROM priced.new_cost;
+
+  INSERT INTO cost_rollups AS r (day, model, cost_dollars)
+  SELECT date, COALESCE(model, ''), SUM(delta)
+  FROM cost_deltas
+  WHERE date IS NOT NULL
+  GROUP BY 1, 2
+  ON CONFLICT (day, model) DO UPDATE SET cost_dollars = r.cost_dollars + EXCLUDED.cost_dollars;
+
+  UPDATE users_enhanced e SET total_cost_usd = e.total_cost_usd + d.delta
+  FROM (SELECT user_id, SUM(delta) AS delta FROM cost_deltas GROUP BY user_id) d
+  WHERE e.telegram_user_id = d.user_id;
+
+  INSERT INTO user_daily_stats AS s (telegram_id, day, cost_dollars)
+  SELECT user_id, date, SUM(delta)
+  FROM cost_deltas
+  WHERE date IS NOT NULL
+  GROUP BY 1, 2
+  ON CONFLICT (telegram_id, day) DO UPDATE SET cost_dollars = s.cost_dollars + EXCLUDED.cost_dollars;
+
+  DROP TABLE cost_deltas;
+  DROP TABLE price_intervals;
+  PERFORM set_config('pricing.recompute', 'off', true);
+  IF v_changed > 0 THEN
+    UPDATE leaderboard_windows SET refreshed_on = NULL;
+    PERFORM nextval('data_version_seq');
+  END IF;
+  RETURN v_changed;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_user_daily_stats();
+SELECT refresh_leaderboard();
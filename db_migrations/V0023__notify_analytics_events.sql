@@ -0,0 +1,28 @@
+-- Оповещение функции stream о новых диалогах через LISTEN/NOTIFY: одно уведомление на оператор INSERT
+-- (все режимы bot-webhook и проектор), а не на строку — батч из сотни диалогов даёт один NOTIFY.
+-- В payload только диапазон id и время: сами строки stream дочитывает одним запросом на окно коалесинга.
+CREATE OR REPLACE FUNCTION dialogs_notify_trigger()
+RETURNS TRIGGER AS $$
+DECLARE
+  v_batch RECORD;
+BEGIN
+  SELECT COUNT(*) AS dialogs, MIN(id) AS min_id, MAX(id) AS max_id, MIN(created_at) AS since, COALESCE(SUM(tokens), 0) AS tokens
+  INTO v_batch
+  FROM new_dialogs;
+  IF v_batch.dialogs > 0 THEN
+    PERFORM pg_notify('analytics_events', json_build_object(
+      'dialogs', v_batch.dialogs,
+      'tokens', v_batch.tokens,
+      'min_id', v_batch.min_id,
+      'max_id', v_batch.max_id,
+      'since', v_batch.since
+    )::text);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_dialogs_notify
+AFTER INSERT ON dialogs
+REFERENCING NEW TABLE AS new_dialogs
+FOR EACH STATEMENT EXECUTE FUNCTION dialogs_notify_trigger();
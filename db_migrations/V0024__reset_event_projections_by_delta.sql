@@ -0,0 +1,90 @@
+-- Пересборка проекций событий по дельте вместо пересчёта с нуля. Прежний reset_event_projections пересчитывал
+-- users, token_stats, dau_sketches, rollups и users_enhanced по строкам, оставшимся в dialogs/messages, поэтому
+-- после отсоединения старых секций (detach_old_partitions) одна пересборка стирала архивную историю из всех агрегатов.
+-- Теперь вычитается ровно то, что проектор добавил из ingest_events, а агрегаты из триггеров (dialog_rollups,
+-- cost_rollups, total_cost_usd, user_daily_stats) вычитаются сами при удалении строк с event_id.
+-- dau_sketches и first_seen/last_active не трогаются: повторная проекция сливает их идемпотентно (max/LEAST/GREATEST).
+CREATE OR REPLACE FUNCTION reset_event_projections(p_session_gap_minutes INT DEFAULT 30)
+RETURNS VOID AS $$
+DECLARE
+  v_checkpoint BIGINT;
+  v_events BIGINT;
+  v_dialogs BIGINT;
+BEGIN
+  SELECT last_event_id INTO v_checkpoint FROM projector_checkpoints WHERE name = 'read_models' FOR UPDATE;
+  IF COALESCE(v_checkpoint, 0) = 0 THEN
+    RETURN;
+  END IF;
+
+  -- Каждое спроецированное событие дало ровно одну строку dialogs. Если строк меньше, их секции отсоединены
+  -- по сроку хранения: повторная проекция вернула бы архив в default-секцию и задвоила агрегаты
+  SELECT COUNT(*) INTO v_events FROM ingest_events WHERE id <= v_checkpoint;
+  SELECT COUNT(*) INTO v_dialogs FROM dialogs WHERE event_id IS NOT NULL;
+  IF v_dialogs < v_events THEN
+    RAISE EXCEPTION 'reset_event_projections: % of % projected events have no dialogs row (partitions detached by retention), refusing to rebuild',
+      v_events - v_dialogs, v_events
+      USING ERRCODE = 'object_not_in_prerequisite_state';
+  END IF;
+
+  CREATE TEMP TABLE replayed_users ON COMMIT DROP AS
+  SELECT
+    telegram_id,
+    COUNT(*) AS dialogs,
+    COALESCE(SUM(tokens), 0) AS tokens,
+    SUM((user_message IS NOT NULL)::int + (assistant_message IS NOT NULL)::int) AS messages
+  FROM ingest_events
+  WHERE id <= v_checkpoint
+  GROUP BY telegram_id;
+
+  DELETE FROM dialogs WHERE event_id IS NOT NULL;
+  DELETE FROM messages WHERE event_id IS NOT NULL;
+  DELETE FROM costs WHERE event_id IS NOT NULL;
+
+  UPDATE users u SET total_tokens = u.total_tokens - r.tokens, dialogs_count = u.dialogs_count - r.dialogs
+  FROM replayed_users r
+  WHERE u.telegram_id = r.telegram_id;
+
+  UPDATE token_stats t SET total_tokens = t.total_tokens - e.tokens
+  FROM (SELECT received_at::date AS day, COALESCE(SUM(tokens), 0) AS tokens FROM ingest_events WHERE id <= v_checkpoint GROUP BY 1) e
+  WHERE t.date = e.day;
+
+  -- Сессии: из total_sessions вычитаются сессии, открытые событиями (перерывы считаются по событиям вместе
+  -- с остальными сообщениями пользователя), а last_seen и session_started_at откатываются к последней активности
+  -- не из событий. Иначе повторная проекция сравнивает события с уже сдвинутым last_seen и не открывает сессий
+  WITH activity AS (
+    SELECT m.user_id AS telegram_id, m.timestamp AS ts, FALSE AS from_event
+    FROM messages m
+    JOIN replayed_users r ON r.telegram_id = m.user_id
+    UNION ALL
+    SELECT telegram_id, received_at, TRUE FROM ingest_events WHERE id <= v_checkpoint
+  ), gaps AS (
+    SELECT
+      telegram_id,
+      ts,
+      from_event,
+      (lag(ts) OVER w IS NULL OR ts > lag(ts) OVER w + make_interval(mins => p_session_gap_minutes))::int AS new_session
+    FROM activity
+    WINDOW w AS (PARTITION BY telegram_id ORDER BY ts)
+  ), per_user AS (
+    SELECT
+      telegram_id,
+      COALESCE(SUM(new_session) FILTER (WHERE from_event), 0) AS event_sessions,
+      MAX(ts) FILTER (WHERE NOT from_event) AS last_ts,
+      MAX(ts) FILTER (WHERE NOT from_event AND new_session = 1) AS session_start
+    FROM gaps
+    GROUP BY telegram_id
+  )
+  UPDATE users_enhanced e SET
+    total_sessions = GREATEST(e.total_sessions - p.event_sessions, 0),
+    last_seen = p.last_ts,
+    session_started_at = p.session_start,
+    total_messages_count = GREATEST(e.total_messages_count - r.messages, 0),
+    total_tokens_used = GREATEST(e.total_tokens_used - r.tokens, 0)
+  FROM per_user p
+  JOIN replayed_users r ON r.telegram_id = p.telegram_id
+  WHERE e.telegram_user_id = p.telegram_id;
+
+  UPDATE projector_checkpoints SET last_event_id = 0, events_projected = 0, updated_at = now() WHERE name = 'read_models';
+  PERFORM nextval('data_version_seq');
+END;
+$$ LANGUAGE plpgsql;
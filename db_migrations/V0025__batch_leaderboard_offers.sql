@@ -0,0 +1,188 @@
+-- Лидерборд из V0022 вёлся построчными триггерами на dialogs и costs, и каждая строка пересчитывала сумму
+-- пользователя за все окна (для окна 0 — по всей истории). Теперь триггеры срабатывают раз на оператор
+-- с таблицами переходов: дельты сворачиваются по (пользователь, день), а кандидат, уже стоящий в окне,
+-- получает дельту прибавлением к value без агрегации. Сумма за окно считается только для пользователей,
+-- которых в окне ещё нет. Уменьшения по-прежнему помечают окна устаревшими.
+DROP TRIGGER IF EXISTS trg_user_daily_stats ON dialogs;
+DROP TRIGGER IF EXISTS trg_user_daily_stats_cost ON costs;
+DROP FUNCTION IF EXISTS user_daily_stats_dialogs_trigger();
+DROP FUNCTION IF EXISTS user_daily_stats_costs_trigger();
+DROP FUNCTION IF EXISTS user_daily_stats_apply(DATE, BIGINT, BIGINT, BIGINT, DECIMAL);
+DROP FUNCTION IF EXISTS leaderboard_offer(BIGINT);
+
+-- Прибавляет дельты (массивы одной длины, строка — пользователь × день) к user_daily_stats и предлагает
+-- пользователей в окна, пересобранные сегодня
+CREATE OR REPLACE FUNCTION user_daily_stats_add(p_telegram_ids BIGINT[], p_days DATE[], p_tokens BIGINT[], p_dialogs BIGINT[], p_cost DECIMAL[])
+RETURNS VOID AS $$
+BEGIN
+  IF COALESCE(array_length(p_telegram_ids, 1), 0) = 0 THEN
+    RETURN;
+  END IF;
+
+  INSERT INTO user_daily_stats AS s (telegram_id, day, tokens, dialogs, cost_dollars)
+  SELECT * FROM unnest(p_telegram_ids, p_days, p_tokens, p_dialogs, p_cost)
+  ON CONFLICT (telegram_id, day) DO UPDATE SET
+    tokens = s.tokens + EXCLUDED.tokens,
+    dialogs = s.dialogs + EXCLUDED.dialogs,
+    cost_dollars = s.cost_dollars + EXCLUDED.cost_dollars;
+
+  IF EXISTS (SELECT 1 FROM unnest(p_tokens, p_dialogs, p_cost) AS d(tokens, dialogs, cost) WHERE d.tokens < 0 OR d.dialogs < 0 OR d.cost < 0) THEN
+    UPDATE leaderboard_windows SET refreshed_on = NULL WHERE refreshed_on IS NOT NULL;
+    RETURN;
+  END IF;
+
+  WITH deltas AS (
+    SELECT * FROM unnest(p_telegram_ids, p_days, p_tokens, p_dialogs, p_cost) AS d(telegram_id, day, tokens, dialogs, cost)
+  ), window_deltas AS (
+    SELECT w.window_days, w.capacity, d.telegram_id, m.metric, SUM(m.value) AS delta
+    FROM leaderboard_windows w
+    JOIN deltas d ON w.window_days = 0 OR d.day > CURRENT_DATE - w.window_days
+    CROSS JOIN LATERAL (VALUES ('tokens', d.tokens::numeric), ('dialogs', d.dialogs::numeric), ('cost', d.cost)) AS m(metric, value)
+    WHERE w.refreshed_on = CURRENT_DATE AND m.value > 0
+    GROUP BY w.window_days, w.capacity, d.telegram_id, m.metric
+  ), bumped AS (
+    UPDATE leaderboard_entries e SET value = e.value + wd.delta
+    FROM window_deltas wd
+    WHERE e.metric = wd.metric AND e.window_days = wd.window_days AND e.telegram_id = wd.telegram_id
+    RETURNING e.metric, e.window_days, e.telegram_id
+  ), sums AS (
+    SELECT wd.metric, wd.window_days, wd.capacity, wd.telegram_id,
+      SUM(CASE wd.metric WHEN 'tokens' THEN s.tokens::numeric WHEN 'dialogs' THEN s.dialogs::numeric ELSE s.cost_dollars END) AS value
+    FROM window_deltas wd
+    JOIN user_daily_stats s ON s.telegram_id = wd.telegram_id AND (wd.window_days = 0 OR s.day > CURRENT_DATE - wd.window_days)
+    WHERE NOT EXISTS (
+      SELECT 1 FROM bumped b
+      WHERE b.metric = wd.metric AND b.window_days = wd.window_days AND b.telegram_id = wd.telegram_id
+    )
+    GROUP BY wd.metric, wd.window_days, wd.capacity, wd.telegram_id
+  )
+  INSERT INTO leaderboard_entries (metric, window_days, telegram_id, value)
+  SELECT s.metric, s.window_days, s.telegram_id, s.value
+  FROM sums s
+  WHERE s.value >= COALESCE((
+      SELECT e.value FROM leaderboard_entries e
+      WHERE e.metric = s.metric AND e.window_days = s.window_days
+      ORDER BY e.value DESC OFFSET s.capacity - 1 LIMIT 1
+    ), 0)
+  ON CONFLICT (metric, window_days, telegram_id) DO UPDATE SET value = EXCLUDED.value;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Один вызов на оператор: INSERT — новые строки, DELETE — старые с минусом, UPDATE — чистая разница
+CREATE OR REPLACE FUNCTION user_daily_stats_dialogs_trigger()
+RETURNS TRIGGER AS $$
+DECLARE
+  v_ids BIGINT[];
+  v_days DATE[];
+  v_tokens BIGINT[];
+  v_dialogs BIGINT[];
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    SELECT array_agg(telegram_id), array_agg(day), array_agg(tokens), array_agg(dialogs)
+    INTO v_ids, v_days, v_tokens, v_dialogs
+    FROM (
+      SELECT telegram_id, COALESCE(created_at, CURRENT_TIMESTAMP)::date AS day, SUM(COALESCE(tokens, 0))::bigint AS tokens, COUNT(*) AS dialogs
+      FROM new_dialogs
+      WHERE telegram_id IS NOT NULL
+      GROUP BY 1, 2
+    ) d;
+  ELSIF TG_OP = 'DELETE' THEN
+    SELECT array_agg(telegram_id), array_agg(day), array_agg(tokens), array_agg(dialogs)
+    INTO v_ids, v_days, v_tokens, v_dialogs
+    FROM (
+      SELECT telegram_id, COALESCE(created_at, CURRENT_TIMESTAMP)::date AS day, -SUM(COALESCE(tokens, 0))::bigint AS tokens, -COUNT(*) AS dialogs
+      FROM old_dialogs
+      WHERE telegram_id IS NOT NULL
+      GROUP BY 1, 2
+    ) d;
+  ELSE
+    SELECT array_agg(telegram_id), array_agg(day), array_agg(tokens), array_agg(dialogs)
+    INTO v_ids, v_days, v_tokens, v_dialogs
+    FROM (
+      SELECT telegram_id, day, SUM(tokens)::bigint AS tokens, SUM(dialogs)::bigint AS dialogs
+      FROM (
+        SELECT telegram_id, COALESCE(created_at, CURRENT_TIMESTAMP)::date AS day, COALESCE(tokens, 0) AS tokens, 1 AS dialogs FROM new_dialogs
+        UNION ALL
+        SELECT telegram_id, COALESCE(created_at, CURRENT_TIMESTAMP)::date, -COALESCE(tokens, 0), -1 FROM old_dialogs
+      ) changes
+      WHERE telegram_id IS NOT NULL
+      GROUP BY 1, 2
+      HAVING SUM(tokens) <> 0 OR SUM(dialogs) <> 0
+    ) d;
+  END IF;
+  PERFORM user_daily_stats_add(v_ids, v_days, v_tokens, v_dialogs, array_fill(0::decimal, ARRAY[COALESCE(array_length(v_ids, 1), 0)]));
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Как trg_cost_rollups, молчит во время recompute_costs: дельты стоимости вносит сама recompute_costs
+CREATE OR REPLACE FUNCTION user_daily_stats_costs_trigger()
+RETURNS TRIGGER AS $$
+DECLARE
+  v_ids BIGINT[];
+  v_days DATE[];
+  v_cost DECIMAL[];
+BEGIN
+  IF current_setting('pricing.recompute', true) = 'on' THEN
+    RETURN NULL;
+  END IF;
+  IF TG_OP = 'INSERT' THEN
+    SELECT array_agg(user_id), array_agg(date), array_agg(cost) INTO v_ids, v_days, v_cost
+    FROM (SELECT user_id, date, SUM(cost_dollars) AS cost FROM new_costs WHERE user_id IS NOT NULL AND date IS NOT NULL AND cost_dollars <> 0 GROUP BY 1, 2) d;
+  ELSIF TG_OP = 'DELETE' THEN
+    SELECT array_agg(user_id), array_agg(date), array_agg(cost) INTO v_ids, v_days, v_cost
+    FROM (SELECT user_id, date, -SUM(cost_dollars) AS cost FROM old_costs WHERE user_id IS NOT NULL AND date IS NOT NULL AND cost_dollars <> 0 GROUP BY 1, 2) d;
+  ELSE
+    SELECT array_agg(user_id), array_agg(date), array_agg(cost) INTO v_ids, v_days, v_cost
+    FROM (
+      SELECT user_id, date, SUM(cost) AS cost
+      FROM (
+        SELECT user_id, date, cost_dollars AS cost FROM new_costs
+        UNION ALL
+        SELECT user_id, date, -cost_dollars FROM old_costs
+      ) changes
+      WHERE user_id IS NOT NULL AND date IS NOT NULL AND cost <> 0
+      GROUP BY 1, 2
+      HAVING SUM(cost) <> 0
+    ) d;
+  END IF;
+  PERFORM user_daily_stats_add(
+    v_ids, v_days,
+    array_fill(0::bigint, ARRAY[COALESCE(array_length(v_ids, 1), 0)]),
+    array_fill(0::bigint, ARRAY[COALESCE(array_length(v_ids, 1), 0)]),
+    v_cost
+  );
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Таблицы переходов допускают одно событие на триггер, поэтому по триггеру на INSERT, UPDATE и DELETE
+CREATE TRIGGER trg_user_daily_stats_insert
+AFTER INSERT ON dialogs
+REFERENCING NEW TABLE AS new_dialogs
+FOR EACH STATEMENT EXECUTE FUNCTION user_daily_stats_dialogs_trigger();
+
+CREATE TRIGGER trg_user_daily_stats_update
+AFTER UPDATE ON dialogs
+REFERENCING OLD TABLE AS old_dialogs NEW TABLE AS new_dialogs
+FOR EACH STATEMENT EXECUTE FUNCTION user_daily_stats_dialogs_trigger();
+
+CREATE TRIGGER trg_user_daily_stats_delete
+AFTER DELETE ON dialogs
+REFERENCING OLD TABLE AS old_dialogs
+FOR EACH STATEMENT EXECUTE FUNCTION user_daily_stats_dialogs_trigger();
+
+CREATE TRIGGER trg_user_daily_stats_cost_insert
+AFTER INSERT ON costs
+REFERENCING NEW TABLE AS new_costs
+FOR EACH STATEMENT EXECUTE FUNCTION user_daily_stats_costs_trigger();
+
+CREATE TRIGGER trg_user_daily_stats_cost_update
+AFTER UPDATE ON costs
+REFERENCING OLD TABLE AS old_costs NEW TABLE AS new_costs
+FOR EACH STATEMENT EXECUTE FUNCTION user_daily_stats_costs_trigger();
+
+CREATE TRIGGER trg_user_daily_stats_cost_delete
+AFTER DELETE ON costs
+REFERENCING OLD TABLE AS old_costs
+FOR EACH STATEMENT EXECUTE FUNCTION user_daily_stats_costs_trigger();
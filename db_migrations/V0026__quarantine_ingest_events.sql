@@ -0,0 +1,26 @@
+-- ingest_events принимал то, чего не примут read-модели: name без NOT NULL (users.name — NOT NULL), tokens,
+-- premium и interaction_type допускали NULL. Такое событие валило каждый батч проектора, и чекпоинт стоял.
+-- Ограничения приводятся к read-моделям, а старые строки — к значениям по умолчанию из bot-webhook
+UPDATE ingest_events SET name = 'Пользователь' WHERE name IS NULL;
+UPDATE ingest_events SET tokens = 0 WHERE tokens IS NULL OR tokens < 0;
+UPDATE ingest_events SET premium = FALSE WHERE premium IS NULL;
+UPDATE ingest_events SET interaction_type = 'chat' WHERE interaction_type IS NULL;
+
+ALTER TABLE ingest_events ALTER COLUMN name SET DEFAULT 'Пользователь';
+ALTER TABLE ingest_events ALTER COLUMN name SET NOT NULL;
+ALTER TABLE ingest_events ALTER COLUMN tokens SET NOT NULL;
+ALTER TABLE ingest_events ALTER COLUMN premium SET NOT NULL;
+ALTER TABLE ingest_events ALTER COLUMN interaction_type SET NOT NULL;
+ALTER TABLE ingest_events ADD CONSTRAINT ingest_events_tokens_check
+  CHECK (tokens >= 0 AND (prompt_tokens IS NULL OR prompt_tokens >= 0) AND (completion_tokens IS NULL OR completion_tokens >= 0));
+
+-- Событие, которое проектор так и не смог применить: переносится сюда из ingest_events целиком (event — строка
+-- в JSON) вместе с ошибкой, а чекпоинт сдвигается за него. Оставшиеся ingest_events по-прежнему один к одному
+-- соответствуют строкам dialogs с event_id, на чём держится проверка reset_event_projections
+CREATE TABLE IF NOT EXISTS ingest_events_quarantine (
+  event_id BIGINT PRIMARY KEY,
+  idempotency_key VARCHAR(128) NOT NULL,
+  event JSONB NOT NULL,
+  error TEXT,
+  quarantined_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
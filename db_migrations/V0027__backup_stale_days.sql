@@ -0,0 +1,48 @@
+-- Снимки auto-backup инкрементальны по id: строку, уже выгруженную в Parquet, повторно не читают. recompute_costs
+-- (и любая другая правка истории) переписывает cost_dollars / cost_usd у старых строк, и снимок вместе с
+-- offline_analytics расходится с базой, а verify сверяет только число строк. Дни с изменёнными строками не выше
+-- водяного знака попадают сюда, и следующий snapshot перевыгружает их целиком, заменяя файлы дня в манифесте
+CREATE TABLE IF NOT EXISTS backup_stale_days (
+  table_name VARCHAR(64) NOT NULL,
+  day DATE NOT NULL,
+  marked_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (table_name, day)
+);
+
+CREATE OR REPLACE FUNCTION backup_stale_days_trigger()
+RETURNS TRIGGER AS $$
+BEGIN
+  -- Оба дня строки: при правке даты старый день в снимке тоже устарел. DO UPDATE, а не DO NOTHING: если snapshot
+  -- сейчас перевыгружает этот день, вставка дождётся его коммита и вернёт день в очередь
+  IF TG_TABLE_NAME = 'costs' THEN
+    INSERT INTO backup_stale_days (table_name, day)
+    SELECT DISTINCT 'costs', d.day
+    FROM old_rows o
+    JOIN new_rows n ON n.id = o.id
+    CROSS JOIN LATERAL (VALUES (o.date), (n.date)) AS d(day)
+    WHERE (o.*) IS DISTINCT FROM (n.*) AND d.day IS NOT NULL
+      AND o.id <= (SELECT last_id FROM backup_watermarks WHERE table_name = 'costs')
+    ON CONFLICT (table_name, day) DO UPDATE SET marked_at = EXCLUDED.marked_at;
+  ELSE
+    INSERT INTO backup_stale_days (table_name, day)
+    SELECT DISTINCT 'token_usage', d.day
+    FROM old_rows o
+    JOIN new_rows n ON n.id = o.id
+    CROSS JOIN LATERAL (VALUES (o.timestamp::date), (n.timestamp::date)) AS d(day)
+    WHERE (o.*) IS DISTINCT FROM (n.*) AND d.day IS NOT NULL
+      AND o.id <= (SELECT last_id FROM backup_watermarks WHERE table_name = 'token_usage')
+    ON CONFLICT (table_name, day) DO UPDATE SET marked_at = EXCLUDED.marked_at;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_costs_backup_stale
+AFTER UPDATE ON costs
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION backup_stale_days_trigger();
+
+CREATE TRIGGER trg_token_usage_backup_stale
+AFTER UPDATE ON token_usage
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION backup_stale_days_trigger();
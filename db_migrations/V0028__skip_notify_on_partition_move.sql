@@ -0,0 +1,77 @@
+-- ensure_monthly_partitions переносит строки из default-секции повторным INSERT в родительскую таблицу, и
+-- trg_dialogs_notify (V0023) отправлял старые диалоги в stream как новые. На время переноса функция ставит
+-- partitions.moving = on (до конца транзакции или до сброса), и триггер оповещения такой INSERT пропускает
+CREATE OR REPLACE FUNCTION ensure_monthly_partitions(p_table TEXT, p_months_ahead INT DEFAULT 3, p_from DATE DEFAULT NULL)
+RETURNS INT AS $$
+DECLARE
+  v_column TEXT;
+  v_columns TEXT;
+  v_month DATE := date_trunc('month', COALESCE(p_from, CURRENT_DATE))::date;
+  v_last DATE := (date_trunc('month', CURRENT_DATE) + make_interval(months => p_months_ahead))::date;
+  v_next DATE;
+  v_name TEXT;
+  v_default TEXT := p_table || '_default';
+  v_pending BOOLEAN;
+  v_created INT := 0;
+BEGIN
+  SELECT a.attname INTO v_column
+  FROM pg_partitioned_table pt
+  JOIN pg_attribute a ON a.attrelid = pt.partrelid AND a.attnum = pt.partattrs[0]
+  WHERE pt.partrelid = p_table::regclass;
+
+  SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO v_columns
+  FROM pg_attribute
+  WHERE attrelid = p_table::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = '';
+
+  WHILE v_month <= v_last LOOP
+    v_next := (v_month + interval '1 month')::date;
+    v_name := p_table || '_p' || to_char(v_month, 'YYYY_MM');
+    IF to_regclass(v_name) IS NULL THEN
+      v_pending := FALSE;
+      IF to_regclass(v_default) IS NOT NULL THEN
+        EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE %I >= %L AND %I < %L)', v_default, v_column, v_month, v_column, v_next)
+          INTO v_pending;
+      END IF;
+      IF v_pending THEN
+        EXECUTE format('CREATE TEMP TABLE partition_moved ON COMMIT DROP AS SELECT %s FROM %I WHERE %I >= %L AND %I < %L',
+          v_columns, v_default, v_column, v_month, v_column, v_next);
+        EXECUTE format('DELETE FROM %I WHERE %I >= %L AND %I < %L', v_default, v_column, v_month, v_column, v_next);
+      END IF;
+      EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)', v_name, p_table, v_month, v_next);
+      IF v_pending THEN
+        PERFORM set_config('partitions.moving', 'on', true);
+        EXECUTE format('INSERT INTO %I (%s) SELECT %s FROM partition_moved', p_table, v_columns, v_columns);
+        PERFORM set_config('partitions.moving', 'off', true);
+        DROP TABLE partition_moved;
+      END IF;
+      v_created := v_created + 1;
+    END IF;
+    v_month := v_next;
+  END LOOP;
+  RETURN v_created;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION dialogs_notify_trigger()
+RETURNS TRIGGER AS $$
+DECLARE
+  v_batch RECORD;
+BEGIN
+  IF current_setting('partitions.moving', true) = 'on' THEN
+    RETURN NULL;
+  END IF;
+  SELECT COUNT(*) AS dialogs, MIN(id) AS min_id, MAX(id) AS max_id, MIN(created_at) AS since, COALESCE(SUM(tokens), 0) AS tokens
+  INTO v_batch
+  FROM new_dialogs;
+  IF v_batch.dialogs > 0 THEN
+    PERFORM pg_notify('analytics_events', json_build_object(
+      'dialogs', v_batch.dialogs,
+      'tokens', v_batch.tokens,
+      'min_id', v_batch.min_id,
+      'max_id', v_batch.max_id,
+      'since', v_batch.since
+    )::text);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,168 @@
+-- nextval('data_version_seq') нетранзакционен: внутри recompute_costs и reset_event_projections версия сдвигалась
+-- до коммита, и get-* успевали закэшировать старые данные под новой версией до конца транзакции. Как и в
+-- bump_data_version из bot-webhook, версию сдвигает вызывающий — отдельным SELECT nextval('data_version_seq')
+-- после COMMIT (bot-webhook rebuild_projections и benchmarks/seed.py так уже делают).
+-- Правка model_prices пересчитывает стоимость через model_prices_trigger в транзакции правки: после её COMMIT
+-- нужно так же выполнить SELECT nextval('data_version_seq'), иначе кэши get-* отдадут старую стоимость до TTL.
+
+-- recompute_costs из V0022 без сдвига версии
+CREATE OR REPLACE FUNCTION recompute_costs(p_from DATE DEFAULT NULL, p_model VARCHAR DEFAULT NULL)
+RETURNS BIGINT AS $$
+DECLARE
+  v_changed BIGINT;
+BEGIN
+  PERFORM set_config('pricing.recompute', 'on', true);
+
+  CREATE TEMP TABLE price_intervals ON COMMIT DROP AS
+  SELECT model, valid_from, lead(valid_from) OVER (PARTITION BY model ORDER BY valid_from) AS valid_to, prompt_per_1k, completion_per_1k
+  FROM model_prices;
+
+  CREATE TEMP TABLE cost_deltas (user_id BIGINT, date DATE, model VARCHAR(50), delta DECIMAL) ON COMMIT DROP;
+
+  WITH priced AS (
+    SELECT
+      c.id,
+      c.cost_dollars AS old_cost,
+      price_tokens(COALESCE(p.prompt_per_1k, d.prompt_per_1k), COALESCE(p.completion_per_1k, d.completion_per_1k),
+        c.prompt_tokens, c.completion_tokens, c.tokens_used) AS new_cost
+    FROM costs c
+    LEFT JOIN price_intervals p ON p.model = c.model AND c.date >= p.valid_from AND (p.valid_to IS NULL OR c.date < p.valid_to)
+    LEFT JOIN price_intervals d ON d.model = '*' AND c.date >= d.valid_from AND (d.valid_to IS NULL OR c.date < d.valid_to)
+    WHERE (p_from IS NULL OR c.date >= p_from)
+      AND (p_model IS NULL OR c.model = p_model)
+  ), updated AS (
+    UPDATE costs c SET cost_dollars = priced.new_cost
+    FROM priced
+    WHERE c.id = priced.id AND c.cost_dollars IS DISTINCT FROM priced.new_cost
+    RETURNING c.user_id, c.date, c.model, COALESCE(priced.new_cost, 0) - COALESCE(priced.old_cost, 0) AS delta
+  )
+  INSERT INTO cost_deltas SELECT * FROM updated;
+
+  GET DIAGNOSTICS v_changed = ROW_COUNT;
+
+  UPDATE token_usage t SET cost_usd = priced.new_cost
+  FROM (
+    SELECT
+      t.id,
+      price_tokens(COALESCE(p.prompt_per_1k, d.prompt_per_1k), COALESCE(p.completion_per_1k, d.completion_per_1k),
+        t.prompt_tokens, t.completion_tokens, t.total_tokens) AS new_cost
+    FROM token_usage t
+    LEFT JOIN price_intervals p ON p.model = t.model AND t.timestamp::date >= p.valid_from AND (p.valid_to IS NULL OR t.timestamp::date < p.valid_to)
+    LEFT JOIN price_intervals d ON d.model = '*' AND t.timestamp::date >= d.valid_from AND (d.valid_to IS NULL OR t.timestamp::date < d.valid_to)
+    WHERE (p_from IS NULL OR t.timestamp >= p_from)
+      AND (p_model IS NULL OR t.model = p_model)
+  ) priced
+  WHERE t.id = priced.id AND t.cost_usd IS DISTINCT FROM priced.new_cost;
+
+  INSERT INTO cost_rollups AS r (day, model, cost_dollars)
+  SELECT date, COALESCE(model, ''), SUM(delta)
+  FROM cost_deltas
+  WHERE date IS NOT NULL
+  GROUP BY 1, 2
+  ON CONFLICT (day, model) DO UPDATE SET cost_dollars = r.cost_dollars + EXCLUDED.cost_dollars;
+
+  UPDATE users_enhanced e SET total_cost_usd = e.total_cost_usd + d.delta
+  FROM (SELECT user_id, SUM(delta) AS delta FROM cost_deltas GROUP BY user_id) d
+  WHERE e.telegram_user_id = d.user_id;
+
+  INSERT INTO user_daily_stats AS s (telegram_id, day, cost_dollars)
+  SELECT user_id, date, SUM(delta)
+  FROM cost_deltas
+  WHERE date IS NOT NULL
+  GROUP BY 1, 2
+  ON CONFLICT (telegram_id, day) DO UPDATE SET cost_dollars = s.cost_dollars + EXCLUDED.cost_dollars;
+
+  DROP TABLE cost_deltas;
+  DROP TABLE price_intervals;
+  PERFORM set_config('pricing.recompute', 'off', true);
+  IF v_changed > 0 THEN
+    UPDATE leaderboard_windows SET refreshed_on = NULL;
+  END IF;
+  RETURN v_changed;
+END;
+$$ LANGUAGE plpgsql;
+
+-- reset_event_projections из V0024 без сдвига версии
+CREATE OR REPLACE FUNCTION reset_event_projections(p_session_gap_minutes INT DEFAULT 30)
+RETURNS VOID AS $$
+DECLARE
+  v_checkpoint BIGINT;
+  v_events BIGINT;
+  v_dialogs BIGINT;
+BEGIN
+  SELECT last_event_id INTO v_checkpoint FROM projector_checkpoints WHERE name = 'read_models' FOR UPDATE;
+  IF COALESCE(v_checkpoint, 0) = 0 THEN
+    RETURN;
+  END IF;
+
+  -- Каждое спроецированное событие дало ровно одну строку dialogs. Если строк меньше, их секции отсоединены
+  -- по сроку хранения: повторная проекция вернула бы архив в default-секцию и задвоила агрегаты
+  SELECT COUNT(*) INTO v_events FROM ingest_events WHERE id <= v_checkpoint;
+  SELECT COUNT(*) INTO v_dialogs FROM dialogs WHERE event_id IS NOT NULL;
+  IF v_dialogs < v_events THEN
+    RAISE EXCEPTION 'reset_event_projections: % of % projected events have no dialogs row (partitions detached by retention), refusing to rebuild',
+      v_events - v_dialogs, v_events
+      USING ERRCODE = 'object_not_in_prerequisite_state';
+  END IF;
+
+  CREATE TEMP TABLE replayed_users ON COMMIT DROP AS
+  SELECT
+    telegram_id,
+    COUNT(*) AS dialogs,
+    COALESCE(SUM(tokens), 0) AS tokens,
+    SUM((user_message IS NOT NULL)::int + (assistant_message IS NOT NULL)::int) AS messages
+  FROM ingest_events
+  WHERE id <= v_checkpoint
+  GROUP BY telegram_id;
+
+  DELETE FROM dialogs WHERE event_id IS NOT NULL;
+  DELETE FROM messages WHERE event_id IS NOT NULL;
+  DELETE FROM costs WHERE event_id IS NOT NULL;
+
+  UPDATE users u SET total_tokens = u.total_tokens - r.tokens, dialogs_count = u.dialogs_count - r.dialogs
+  FROM replayed_users r
+  WHERE u.telegram_id = r.telegram_id;
+
+  UPDATE token_stats t SET total_tokens = t.total_tokens - e.tokens
+  FROM (SELECT received_at::date AS day, COALESCE(SUM(tokens), 0) AS tokens FROM ingest_events WHERE id <= v_checkpoint GROUP BY 1) e
+  WHERE t.date = e.day;
+
+  -- Сессии: из total_sessions вычитаются сессии, открытые событиями (перерывы считаются по событиям вместе
+  -- с остальными сообщениями пользователя), а last_seen и session_started_at откатываются к последней активности
+  -- не из событий. Иначе повторная проекция сравнивает события с уже сдвинутым last_seen и не открывает сессий
+  WITH activity AS (
+    SELECT m.user_id AS telegram_id, m.timestamp AS ts, FALSE AS from_event
+    FROM messages m
+    JOIN replayed_users r ON r.telegram_id = m.user_id
+    UNION ALL
+    SELECT telegram_id, received_at, TRUE FROM ingest_events WHERE id <= v_checkpoint
+  ), gaps AS (
+    SELECT
+      telegram_id,
+      ts,
+      from_event,
+      (lag(ts) OVER w IS NULL OR ts > lag(ts) OVER w + make_interval(mins => p_session_gap_minutes))::int AS new_session
+    FROM activity
+    WINDOW w AS (PARTITION BY telegram_id ORDER BY ts)
+  ), per_user AS (
+    SELECT
+      telegram_id,
+      COALESCE(SUM(new_session) FILTER (WHERE from_event), 0) AS event_sessions,
+      MAX(ts) FILTER (WHERE NOT from_event) AS last_ts,
+      MAX(ts) FILTER (WHERE NOT from_event AND new_session = 1) AS session_start
+    FROM gaps
+    GROUP BY telegram_id
+  )
+  UPDATE users_enhanced e SET
+    total_sessions = GREATEST(e.total_sessions - p.event_sessions, 0),
+    last_seen = p.last_ts,
+    session_started_at = p.session_start,
+    total_messages_count = GREATEST(e.total_messages_count - r.messages, 0),
+    total_tokens_used = GREATEST(e.total_tokens_used - r.tokens, 0)
+  FROM per_user p
+  JOIN replayed_users r ON r.telegram_id = p.telegram_id
+  WHERE e.telegram_user_id = p.telegram_id;
+
+  UPDATE projector_checkpoints SET last_event_id = 0, events_projected = 0, updated_at = now() WHERE name = 'read_models';
+END;
+$$ LANGUAGE plpgsql;
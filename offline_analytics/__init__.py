@@ -0,0 +1,21 @@
+'''
+Офлайн-аналитика по Parquet-снимкам auto-backup: удержание, когорты, стоимость по когортам,
+воронки по utm_source / first_question_category и сводка get-analytics без запросов к рабочей базе.
+
+Запуск: python -m offline_analytics --uri /tmp/snapshots retention --period week --by utm_source
+'''
+from .metrics import cohort_matrix, cost_per_cohort, funnel, retention, segments, summary, user_activity
+from .snapshots import list_files, load_table, open_snapshots
+
+__all__ = [
+    'cohort_matrix',
+    'cost_per_cohort',
+    'funnel',
+    'list_files',
+    'load_table',
+    'open_snapshots',
+    'retention',
+    'segments',
+    'summary',
+    'user_activity'
+]
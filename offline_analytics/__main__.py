@@ -0,0 +1,70 @@
+'''CLI: python -m offline_analytics [--uri URI] [--from YYYY-MM-DD] [--to YYYY-MM-DD] <команда> [параметры]'''
+import argparse
+import json
+import sys
+import time
+from datetime import date
+
+from .metrics import PERIODS, cohort_matrix, cost_per_cohort, funnel, retention, summary, user_activity
+from .snapshots import DEFAULT_URI, load_table
+
+SEGMENT_COLUMNS = ('utm_source', 'utm_campaign', 'first_question_category', 'status')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='offline_analytics', description=__doc__)
+    parser.add_argument('--uri', default=DEFAULT_URI, help='корень снимков (BACKUP_URI auto-backup)')
+    parser.add_argument('--from', dest='date_from', type=date.fromisoformat)
+    parser.add_argument('--to', dest='date_to', type=date.fromisoformat)
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    command = commands.add_parser('retention', help='кривые удержания')
+    command.add_argument('--period', choices=PERIODS, default='week')
+    command.add_argument('--periods', type=int, default=12)
+    command.add_argument('--by', choices=SEGMENT_COLUMNS)
+    
+    command = commands.add_parser('cohorts', help='когортная матрица')
+    command.add_argument('--period', choices=PERIODS, default='week')
+    command.add_argument('--periods', type=int, default=12)
+    
+    command = commands.add_parser('costs', help='токены и стоимость по когортам или сегментам')
+    command.add_argument('--period', choices=PERIODS, default='week')
+    command.add_argument('--by', choices=SEGMENT_COLUMNS)
+    
+    command = commands.add_parser('funnel', help='воронка по сегменту')
+    command.add_argument('--by', choices=SEGMENT_COLUMNS, default='utm_source')
+    command.add_argument('--thresholds', default='1,10', help='пороги числа сообщений через запятую')
+    
+    command = commands.add_parser('summary', help='сводка get-analytics')
+    command.add_argument('--days', type=int, default=7)
+    
+    args = parser.parse_args(argv)
+    started = time.perf_counter()
+
+    def table(name, columns):
+        return load_table(args.uri, name, columns, args.date_from, args.date_to)
+    
+    messages = table('messages', ['user_id', 'timestamp'])
+    needs_profile = args.command in ('funnel', 'summary') or getattr(args, 'by', None)
+    users_enhanced = load_table(args.uri, 'users_enhanced', ['telegram_user_id', 'status'] + list(SEGMENT_COLUMNS[:3])) if needs_profile else None
+    
+    if args.command == 'summary':
+        dialogs = table('dialogs', ['created_at', 'tokens', 'model', 'status'])
+        result = summary(dialogs, users_enhanced, messages, args.days, args.date_to)
+    else:
+        activity = user_activity(messages)
+        if args.command == 'retention':
+            result = retention(activity, args.period, args.periods, users_enhanced, args.by)
+        elif args.command == 'cohorts':
+            result = cohort_matrix(activity, args.period, args.periods)
+        elif args.command == 'costs':
+            costs = table('costs', ['user_id', 'tokens_used', 'cost_dollars'])
+            result = cost_per_cohort(activity, costs, args.period, users_enhanced, args.by)
+        else:
+            result = funnel(activity, users_enhanced, args.by, tuple(int(t) for t in args.thresholds.split(',')))
+    
+    result['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+'''Векторные метрики поверх снимков: удержание, когорты, стоимость по когортам, воронки, сводка get-analytics'''
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+PERIODS = ('day', 'week', 'month')
+
+def _days(column):
+    '''timestamp/date колонка -> номер дня от 1970-01-01 (int64), null -> -1'''
+    days = pc.cast(pc.cast(column, pa.date32()), pa.int32())
+    return pc.fill_null(days, -1).to_numpy().astype(np.int64)
+
+def _period_index(days, period):
+    '''Номер календарного периода: неделя с понедельника (1970-01-01 — четверг), месяц — календарный'''
+    if period == 'day':
+        return days
+    if period == 'week':
+        return (days + 3) // 7
+    if period == 'month':
+        return days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    raise ValueError('period must be one of ' + ', '.join(PERIODS))
+
+def _period_start(index, period):
+    if period == 'day':
+        return str(np.datetime64(int(index), 'D'))
+    if period == 'week':
+        return str(np.datetime64(int(index) * 7 - 3, 'D'))
+    return str(np.datetime64(int(index), 'M').astype('datetime64[D]'))
+
+def _numbers(column, dtype=np.float64):
+    return pc.fill_null(pc.cast(column, pa.float64()), 0).to_numpy().astype(dtype)
+
+def user_activity(messages):
+    '''
+    Активность пользователей по messages (user_id, timestamp): для каждой строки — индекс пользователя и день,
+    для каждого пользователя — день первого сообщения и число сообщений. user_ids отсортированы.
+    '''
+    users = messages.column('user_id').to_numpy().astype(np.int64)
+    days = _days(messages.column('timestamp'))
+    known = days >= 0
+    users, days = users[known], days[known]
+    user_ids, index = np.unique(users, return_inverse=True)
+    first_day = np.full(len(user_ids), np.iinfo(np.int64).max)
+    np.minimum.at(first_day, index, days)
+    return {
+        'user_ids': user_ids,
+        'index': index,
+        'day': days,
+        'first_day': first_day,
+        'messages': np.bincount(index, minlength=len(user_ids))
+    }
+
+def segments(activity, users_enhanced, column):
+    '''Код сегмента (utm_source, first_question_category, ...) для каждого пользователя активности; без профиля — unknown'''
+    ids = users_enhanced.column('telegram_user_id').to_numpy().astype(np.int64)
+    values = pc.fill_null(users_enhanced.column(column).combine_chunks(), 'unknown')
+    encoded = pc.dictionary_encode(values)
+    labels = encoded.dictionary.to_pylist()
+    codes = encoded.indices.to_numpy().astype(np.int64)
+    if 'unknown' not in labels:
+        labels.append('unknown')
+    unknown = labels.index('unknown')
+    
+    order = np.argsort(ids, kind='stable')
+    ids, codes = ids[order], codes[order]
+    position = np.clip(np.searchsorted(ids, activity['user_ids']), 0, max(len(ids) - 1, 0))
+    found = (ids[position] == activity['user_ids']) if len(ids) else np.zeros(len(activity['user_ids']), dtype=bool)
+    return np.where(found, codes[position] if len(ids) else unknown, unknown), labels
+
+def _active_matrix(activity, codes, groups, period, periods):
+    '''
+    Число уникальных пользователей группы, активных в периоде k после периода первого сообщения (k = 0..periods).
+    Уникальность — через битовую матрицу пользователь × период вместо сортировки пар.
+    '''
+    width = periods + 1
+    first_period = _period_index(activity['first_day'], period)
+    offset = _period_index(activity['day'], period) - first_period[activity['index']]
+    keep = offset <= periods
+    seen = np.zeros((len(activity['user_ids']), width), dtype=bool)
+    seen[activity['index'][keep], offset[keep]] = True
+    active = np.stack([np.bincount(codes, weights=seen[:, k], minlength=groups) for k in range(width)], axis=1)
+    sizes = np.bincount(codes, minlength=groups)
+    return active.astype(np.int64), sizes
+
+def _rates(active, size):
+    return [round(float(value) / size, 4) if size else 0.0 for value in active]
+
+def retention(activity, period='week', periods=12, users_enhanced=None, by=None):
+    '''Кривая удержания (доля пользователей, активных через k периодов), целиком или по сегментам профиля'''
+    if by:
+        codes, labels = segments(activity, users_enhanced, by)
+    else:
+        codes, labels = np.zeros(len(activity['user_ids']), dtype=np.int64), ['all']
+    active, sizes = _active_matrix(activity, codes, len(labels), period, periods)
+    return {
+        'period': period,
+        'by': by,
+        'segments': [
+            {'segment': label, 'users': int(sizes[i]), 'retention': _rates(active[i], sizes[i])}
+            for i, label in enumerate(labels) if sizes[i]
+        ]
+    }
+
+def cohorts(activity, period='week'):
+    '''Номер когорты (периода первого сообщения) для каждого пользователя и даты начала когорт'''
+    cohort_index, codes = np.unique(_period_index(activity['first_day'], period), return_inverse=True)
+    return codes, [_period_start(index, period) for index in cohort_index]
+
+def cohort_matrix(activity, period='week', periods=12):
+    '''Когортная матрица: когорта по периоду первого сообщения × номер периода после него'''
+    codes, labels = cohorts(activity, period)
+    active, sizes = _active_matrix(activity, codes, len(labels), period, periods)
+    return {
+        'period': period,
+        'cohorts': [
+            {'cohort': label, 'users': int(sizes[i]), 'active': active[i].tolist(), 'retention': _rates(active[i], sizes[i])}
+            for i, label in enumerate(labels)
+        ]
+    }
+
+def cost_per_cohort(activity, costs, period='week', users_enhanced=None, by=None):
+    '''Токены и стоимость (costs) на когорту или сегмент профиля; строки пользователей без сообщений считаются отдельно'''
+    if by:
+        codes, labels = segments(activity, users_enhanced, by)
+    else:
+        codes, labels = cohorts(activity, period)
+    
+    cost_users = costs.column('user_id').to_numpy().astype(np.int64)
+    position = np.clip(np.searchsorted(activity['user_ids'], cost_users), 0, max(len(activity['user_ids']) - 1, 0))
+    matched = activity['user_ids'][position] == cost_users if len(activity['user_ids']) else np.zeros(len(cost_users), dtype=bool)
+    group = codes[position[matched]]
+    tokens = np.bincount(group, weights=_numbers(costs.column('tokens_used'))[matched], minlength=len(labels))
+    dollars = np.bincount(group, weights=_numbers(costs.column('cost_dollars'))[matched], minlength=len(labels))
+    sizes = np.bincount(codes, minlength=len(labels))
+    return {
+        'period': None if by else period,
+        'by': by,
+        'unmatched_rows': int((~matched).sum()),
+        'groups': [
+            {
+                'group': label,
+                'users': int(sizes[i]),
+                'tokens': int(tokens[i]),
+                'cost_usd': round(float(dollars[i]), 6),
+                'tokens_per_user': round(float(tokens[i]) / sizes[i], 2) if sizes[i] else 0.0,
+                'cost_per_user': round(float(dollars[i]) / sizes[i], 6) if sizes[i] else 0.0
+            }
+            for i, label in enumerate(labels) if sizes[i] or tokens[i]
+        ]
+    }
+
+def funnel(activity, users_enhanced, by='utm_source', thresholds=(1, 10)):
+    '''Воронка по сегменту: пользователи с >= N сообщений для каждого порога и с premium-статусом'''
+    codes, labels = segments(activity, users_enhanced, by)
+    premium_codes, premium_labels = segments(activity, users_enhanced, 'status')
+    premium = premium_codes == premium_labels.index('premium') if 'premium' in premium_labels else np.zeros(len(codes), dtype=bool)
+    
+    stages = [(str(t) + '+ messages', activity['messages'] >= t) for t in thresholds] + [('premium', premium)]
+    counts = np.stack([np.bincount(codes[mask], minlength=len(labels)) for name, mask in stages])
+    result = []
+    for i, label in enumerate(labels):
+        top = counts[0, i]
+        if not top:
+            continue
+        result.append({
+            'segment': label,
+            'stages': [
+                {'stage': name, 'count': int(counts[s, i]), 'percent': round(100.0 * counts[s, i] / top, 2)}
+                for s, (name, mask) in enumerate(stages)
+            ]
+        })
+    return {'by': by, 'segments': result}
+
+def summary(dialogs, users_enhanced, messages=None, days=7, today=None):
+    '''Сводка как в get-analytics (summary, modelDistribution, tokenStats) по снимкам dialogs/users_enhanced/messages'''
+    status = users_enhanced.column('status')
+    dialog_days = _days(dialogs.column('created_at'))
+    tokens = _numbers(dialogs.column('tokens'), np.int64)
+    last_day = int(today.toordinal() - 719163) if today else int(dialog_days.max(initial=0))
+    first_day = last_day - days + 1
+    
+    models = pc.value_counts(pc.fill_null(dialogs.column('model').combine_chunks(), 'Unknown')).to_pylist()
+    total_dialogs = sum(item['counts'] for item in models)
+    
+    window = (dialog_days >= first_day) & (dialog_days <= last_day)
+    day_tokens = np.bincount(dialog_days[window] - first_day, weights=tokens[window], minlength=days)
+    day_users = np.zeros(days, dtype=np.int64)
+    if messages is not None:
+        activity = user_activity(messages)
+        in_window = (activity['day'] >= first_day) & (activity['day'] <= last_day)
+        seen = np.zeros((len(activity['user_ids']), days), dtype=bool)
+        seen[activity['index'][in_window], activity['day'][in_window] - first_day] = True
+        day_users = seen.sum(axis=0)
+    
+    return {
+        'summary': {
+            'totalUsers': users_enhanced.num_rows,
+            'premiumUsers': int(pc.sum(pc.equal(status, 'premium')).as_py() or 0),
+            'activeDialogs': int(pc.sum(pc.equal(dialogs.column('status'), 'Активный')).as_py() or 0),
+            'totalTokens': int(tokens.sum())
+        },
+        'modelDistribution': [
+            {'name': item['values'], 'value': round(item['counts'] * 100 / total_dialogs) if total_dialogs else 0, 'count': item['counts']}
+            for item in sorted(models, key=lambda item: -item['counts'])
+        ],
+        'tokenStats': [
+            {'date': str(np.datetime64(first_day + i, 'D')), 'total_tokens': int(day_tokens[i]), 'active_users': int(day_users[i])}
+            for i in range(days)
+        ]
+    }
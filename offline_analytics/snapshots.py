@@ -0,0 +1,60 @@
+'''Чтение Parquet-снимков auto-backup: <table>/date=YYYY-MM-DD/*.parquet и <table>/snapshot=YYYY-MM-DD/*.parquet'''
+import os
+
+import pyarrow as pa
+import pyarrow.fs
+import pyarrow.parquet as pq
+
+DEFAULT_URI = os.environ.get('BACKUP_URI', '/tmp/snapshots')
+
+def open_snapshots(uri=DEFAULT_URI):
+    '''Файловая система и корень снимков; локальные пути приводятся к абсолютным'''
+    if '://' not in uri:
+        uri = os.path.abspath(uri)
+    return pyarrow.fs.FileSystem.from_uri(uri)
+
+def _partition(path):
+    for part in path.split('/'):
+        key, _, value = part.partition('=')
+        if key in ('date', 'snapshot') and value:
+            return key, value
+    return None, None
+
+def list_files(uri, table):
+    '''Файлы снимка таблицы: [(путь, тип партиции, значение)] в порядке путей'''
+    fs, base = open_snapshots(uri)
+    selector = pyarrow.fs.FileSelector(base + '/' + table, recursive=True, allow_not_found=True)
+    files = []
+    for info in fs.get_file_info(selector):
+        if info.type == pyarrow.fs.FileType.File and info.path.endswith('.parquet'):
+            files.append((info.path,) + _partition(info.path))
+    return sorted(files)
+
+def load_table(uri, table, columns=None, date_from=None, date_to=None):
+    '''
+    Читает снимок таблицы в один pyarrow.Table.
+    Дневные партиции отбираются по date_from/date_to (YYYY-MM-DD, включительно) без чтения файлов,
+    из полных снимков берётся последний. Локальные файлы читаются через memory map.
+    '''
+    fs, base = open_snapshots(uri)
+    files = list_files(uri, table)
+    snapshots = [value for path, kind, value in files if kind == 'snapshot']
+    latest = max(snapshots) if snapshots else None
+    
+    selected = []
+    for path, kind, value in files:
+        if kind == 'snapshot' and value != latest:
+            continue
+        if kind == 'date' and (date_from or date_to):
+            if value == 'unknown' or (date_from and value < str(date_from)) or (date_to and value > str(date_to)):
+                continue
+        selected.append(path)
+    if not selected:
+        raise FileNotFoundError('No snapshot files for ' + table + ' under ' + uri)
+    
+    local = isinstance(fs, pyarrow.fs.LocalFileSystem)
+    tables = [
+        pq.read_table(path, columns=columns, memory_map=True) if local else pq.read_table(path, columns=columns, filesystem=fs)
+        for path in selected
+    ]
+    return pa.concat_tables(tables)
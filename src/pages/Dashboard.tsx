@@ -4,6 +4,10 @@ import { Badge } from '@/components/ui/badge';
 import Icon from '@/components/ui/icon';
 import { Button } from '@/components/ui/button';
 import { LineChart, Line, XAxis, YAxis, CartesianGrid, Tooltip, ResponsiveContainer } from 'recharts';
+import func2url from '../../backend/func2url.json';
+
+// URL функции stream появляется в func2url.json после деплоя; до этого дашборд обновляется только кнопкой
+const STREAM_URL = (func2url as Record<string, string>)['stream'];
 
 interface DashboardData {
   dau: number;
@@ -15,6 +19,12 @@ interface DashboardData {
   costWeek: number;
 }
 
+interface StreamCounters {
+  dau: number;
+  cost_usd: number;
+  quality: number;
+}
+
 interface HistoryPoint {
   time: string;
   dau: number;
@@ -36,6 +46,25 @@ export default function Dashboard() {
   const [loading, setLoading] = useState(true);
   const [lastUpdate, setLastUpdate] = useState<Date | null>(null);
 
+  const applyData = (newData: DashboardData) => {
+    setData(newData);
+
+    const now = new Date();
+    const timeString = now.toLocaleTimeString('ru-RU', { hour: '2-digit', minute: '2-digit' });
+    
+    setHistory(prev => {
+      const newHistory = [...prev, {
+        time: timeString,
+        dau: newData.dau,
+        cost: newData.costToday,
+        quality: newData.quality
+      }];
+      return newHistory.slice(-10);
+    });
+
+    setLastUpdate(now);
+  };
+
   const fetchDashboardData = async () => {
     setLoading(true);
     try {
@@ -59,22 +88,7 @@ export default function Dashboard() {
         costWeek: (costsData.cost_usd || 0) * 7
       };
 
-      setData(newData);
-
-      const now = new Date();
-      const timeString = now.toLocaleTimeString('ru-RU', { hour: '2-digit', minute: '2-digit' });
-      
-      setHistory(prev => {
-        const newHistory = [...prev, {
-          time: timeString,
-          dau: newData.dau,
-          cost: newData.costToday,
-          quality: newData.quality
-        }];
-        return newHistory.slice(-10);
-      });
-
-      setLastUpdate(now);
+      applyData(newData);
       setLoading(false);
     } catch (error) {
       console.error('Ошибка загрузки данных:', error);
@@ -84,6 +98,30 @@ export default function Dashboard() {
 
   useEffect(() => {
     fetchDashboardData();
+    if (!STREAM_URL) {
+      return;
+    }
+
+    // Счётчики за сегодня приходят push-событиями update/resync; EventSource сам переподключается с Last-Event-ID
+    const source = new EventSource(STREAM_URL);
+    const onCounters = (event: MessageEvent) => {
+      const counters: StreamCounters | undefined = JSON.parse(event.data).counters;
+      if (!counters) {
+        return;
+      }
+      applyData({
+        dau: counters.dau,
+        messagesCount: counters.dau * 15,
+        costToday: counters.cost_usd,
+        quality: counters.quality,
+        csat: 4.2,
+        nps: 8,
+        costWeek: counters.cost_usd * 7
+      });
+    };
+    source.addEventListener('update', onCounters);
+    source.addEventListener('resync', onCounters);
+    return () => source.close();
   }, []);
 
   const funnelData = [